@@ -1,9 +1,12 @@
 from flask import Flask, render_template, request, redirect, url_for, Response
-import json, os, re, unicodedata, math, time
+from flask import g, has_app_context, has_request_context, stream_with_context
+import json, os, re, unicodedata, math, time, marshal, heapq
 import html as html_lib
-from PIL import Image
+import csv, io, zipfile
+from PIL import Image, ImageOps
 from google import genai
 import uuid
+import sqlite3
 from datetime import datetime
 from flask import session
 import random
@@ -12,7 +15,11 @@ import fitz  # PyMuPDF
 from flask import flash
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
-from threading import Lock
+from threading import Lock, RLock, Condition, Event, Thread, get_ident, local
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict, Counter
+from bisect import bisect_left, bisect_right
 
 load_dotenv()
 app = Flask(__name__)
@@ -108,9 +115,8 @@ def add_global_back_button(response):
     response.headers["Content-Length"] = str(len(response.get_data()))
     return response
 
-api_key = os.environ.get("GOOGLE_API_KEY")  # ← SỬA DÒNG NÀY
-if not api_key:  
-    raise ValueError(" Thiếu GOOGLE_API_KEY trong file .env")
+# Thiếu key chỉ báo lỗi khi gọi Gemini lần đầu, để các script chỉ dùng phần lưu trữ không cần key.
+GEMINI_MISSING_KEY_MESSAGE = " Thiếu GOOGLE_API_KEY trong file .env"
 
 
 def get_google_api_keys():
@@ -144,13 +150,82 @@ class GeminiKeyRotationError(Exception):
     pass
 
 
+class GeminiBudgetTimeout(GeminiKeyRotationError):
+    pass
+
+
+GEMINI_ALL_KEYS_FAILED_MESSAGE = (
+    "Tri-hand chua goi duoc Gemini vi tat ca API key hien co dang het quota, "
+    "bi khoa/suspended hoac khong hop le. Hay doi quota reset hoac them API key moi vao GOOGLE_API_KEYS trong .env."
+)
+
+GEMINI_BUDGET_TIMEOUT_MESSAGE = (
+    "Tri-hand dang xu ly qua nhieu yeu cau AI cung luc nen chua goi duoc Gemini. Hay thu lai sau it phut."
+)
+
+
+class TokenBucket:
+    """Bucket nạp lại đều theo thời gian; số dư có thể âm khi lời gọi tốn nhiều token hơn ước tính."""
+
+    def __init__(self, capacity, per_second):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def wait_seconds(self, amount, reserve=0):
+        # Lời gọi lớn hơn cả dung lượng bucket chỉ cần chờ bucket đầy; reserve là phần để dành cho luồng ưu tiên hơn.
+        missing = min(amount + reserve * self.capacity, self.capacity) - self.level
+        if missing <= 0:
+            return 0
+        return missing / self.per_second
+
+    def fill_ratio(self):
+        return self.level / self.capacity
+
+
+# Luồng ưu tiên của lời gọi AI: luồng thấp hơn chừa lại một phần ngân sách/slot của mỗi key (reserve)
+# và nhường khi có luồng cao hơn đang chờ, để phân loại khẩn cấp không phải xếp sau việc chấm bài hàng loạt.
+# overdraw: hết thời gian chờ thì vẫn gửi dù ngân sách phút chưa đủ (không bao giờ vượt số slot đồng thời);
+# các luồng khác báo GeminiBudgetTimeout thay vì gửi vượt ngân sách.
+AI_PRIORITY_LANES = {
+    'triage': {'rank': 0, 'reserve': 0.0, 'max_wait': 5, 'overdraw': True},
+    'interactive': {'rank': 1, 'reserve': 0.1, 'max_wait': None, 'overdraw': False},
+    'grading': {'rank': 2, 'reserve': 0.25, 'max_wait': None, 'overdraw': False},
+    'batch': {'rank': 3, 'reserve': 0.4, 'max_wait': None, 'overdraw': False},
+}
+
+
 class RotatingGeminiModel:
-    def __init__(self, model_name, api_keys):
+    def __init__(self, model_name, api_keys, max_concurrency_per_key=4,
+                 requests_per_minute=0, tokens_per_minute=0, max_wait_seconds=20):
         self.model_name = model_name
         self.api_keys = api_keys
         self.current_key_index = 0
         self.key_blocked_until = [0] * len(api_keys)
+        # Ngân sách theo phút của từng key (0 = không giới hạn) để chủ động giữ dưới quota thay vì chờ lỗi 429.
+        self.request_buckets = [
+            TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute > 0 else None
+            for _ in api_keys
+        ]
+        self.token_buckets = [
+            TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute > 0 else None
+            for _ in api_keys
+        ]
+        self.max_wait_seconds = max_wait_seconds
+        # Giới hạn số lời gọi đồng thời trên mỗi key để chạy song song không làm key dính rate limit.
+        self.max_concurrency_per_key = max(1, max_concurrency_per_key)
+        self.key_in_flight = [0] * len(api_keys)
+        self.lane_waiting = [0] * len(AI_PRIORITY_LANES)
+        # Mỗi key giữ một client lâu dài để dùng lại kết nối keep-alive/TLS giữa các lần gọi.
+        self.clients = [None] * len(api_keys)
+        self.clients_pid = os.getpid()
         self.lock = Lock()
+        self.budget_changed = Condition(self.lock)
 
     def _normalized_model_name(self):
         if self.model_name.startswith("models/"):
@@ -181,10 +256,6 @@ class RotatingGeminiModel:
             or "invalid_argument" in message
         )
 
-    def _set_current_key(self, key_index):
-        with self.lock:
-            self.current_key_index = key_index % len(self.api_keys)
-
     def _block_key_after_error(self, key_index, error):
         message = str(error).lower()
         status_name = str(getattr(error, "status", "")).lower()
@@ -205,19 +276,144 @@ class RotatingGeminiModel:
 
         with self.lock:
             self.key_blocked_until[key_index] = now + block_seconds
+            # Khi key hết bị khóa sẽ tạo client mới thay vì dùng lại kết nối cũ.
+            self.clients[key_index] = None
 
-    def _available_key_indices(self, start_key_index):
-        now = time.time()
-        indices = [(start_key_index + attempt) % len(self.api_keys) for attempt in range(len(self.api_keys))]
-        available = [index for index in indices if self.key_blocked_until[index] <= now]
-        return available or indices
+    def _client_for_key(self, key_index):
+        with self.lock:
+            if self.clients_pid != os.getpid():
+                # Kết nối HTTP không dùng chung được giữa process cha và con sau fork.
+                self.clients = [None] * len(self.api_keys)
+                self.clients_pid = os.getpid()
+            client = self.clients[key_index]
+            if client is None:
+                client = genai.Client(api_key=self.api_keys[key_index])
+                self.clients[key_index] = client
+            return client
+
+    def _estimate_tokens(self, contents):
+        # Ước lượng thô: ~4 ký tự/token, mỗi ảnh 258 token, cộng phần trả lời dự kiến.
+        total = GEMINI_EXPECTED_OUTPUT_TOKENS
+        for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+            total += len(part) // 4 + 1 if isinstance(part, str) else 258
+        return total
+
+    def _buckets(self, key_index):
+        return [
+            (bucket, amount)
+            for bucket, amount in ((self.request_buckets[key_index], 1), (self.token_buckets[key_index], None))
+            if bucket is not None
+        ]
 
-    def generate_content(self, *args, **kwargs):
-        last_error = None
+    def _lane_slot_limit(self, reserve):
+        if not reserve:
+            return self.max_concurrency_per_key
+        # Luồng có reserve luôn chừa ít nhất một slot cho luồng cao hơn; với 1 slot/key thì không chừa được.
+        limit = int(self.max_concurrency_per_key * (1 - reserve))
+        if self.max_concurrency_per_key >= 2:
+            limit = min(limit, self.max_concurrency_per_key - 1)
+        return max(1, limit)
+
+    def _reserve_key(self, estimated_tokens, tried, priority):
+        """Chọn key còn nhiều ngân sách nhất cho luồng priority; nếu chưa được gửi thì chờ tối đa max_wait."""
+        lane = AI_PRIORITY_LANES[priority]
+        rank, reserve = lane['rank'], lane['reserve']
+        slot_limit = self._lane_slot_limit(reserve)
         total_keys = len(self.api_keys)
+        deadline = time.monotonic() + min(self.max_wait_seconds, lane['max_wait'] or self.max_wait_seconds)
+        with self.lock:
+            self.lane_waiting[rank] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    untried = [index for index in range(total_keys) if index not in tried]
+                    if not untried:
+                        return None
+                    available = [index for index in untried if self.key_blocked_until[index] <= time.time()]
+                    # Khi mọi key đều đang bị khóa vẫn thử lần lượt như trước.
+                    candidates = available or untried
+
+                    best_index, best_rank = None, None
+                    for offset in range(total_keys):
+                        index = (self.current_key_index + offset) % total_keys
+                        if index not in candidates:
+                            continue
+                        # Hết slot thì chờ đến khi có lời gọi khác trả slot (được notify).
+                        wait = 0 if self.key_in_flight[index] < slot_limit else float('inf')
+                        ratio = 1
+                        for bucket, amount in self._buckets(index):
+                            bucket.refill(now)
+                            wait = max(wait, bucket.wait_seconds(amount or estimated_tokens, reserve))
+                            ratio = min(ratio, bucket.fill_ratio())
+                        key_rank = (wait, -ratio)
+                        if best_rank is None or key_rank < best_rank:
+                            best_index, best_rank = index, key_rank
+
+                    wait = best_rank[0]
+                    higher_waiting = any(self.lane_waiting[:rank])
+                    timed_out = now >= deadline
+                    if timed_out and (wait == float('inf') or not lane['overdraw']):
+                        # Không gửi vượt số slot của key, và chỉ luồng overdraw được gửi khi thiếu ngân sách.
+                        raise GeminiBudgetTimeout(GEMINI_BUDGET_TIMEOUT_MESSAGE)
+                    if (wait <= 0 and not higher_waiting) or timed_out:
+                        # Luồng overdraw hết thời gian chờ thì vẫn gửi, lỗi quota (nếu có) được xử lý như trước.
+                        for bucket, amount in self._buckets(best_index):
+                            bucket.level -= amount or estimated_tokens
+                        self.key_in_flight[best_index] += 1
+                        self.current_key_index = (best_index + 1) % total_keys
+                        return best_index
+                    timeout = deadline - now
+                    if not higher_waiting:
+                        timeout = min(wait, timeout)
+                    self.budget_changed.wait(timeout)
+            finally:
+                self.lane_waiting[rank] -= 1
+                # Luồng thấp hơn đang nhường có thể chạy tiếp.
+                self.budget_changed.notify_all()
+
+    def _release_key(self, key_index):
+        with self.lock:
+            self.key_in_flight[key_index] -= 1
+            self.budget_changed.notify_all()
+
+    def _settle_tokens(self, key_index, estimated_tokens, usage):
+        bucket = self.token_buckets[key_index]
+        actual_tokens = getattr(usage, "total_token_count", None)
+        if bucket is None or not isinstance(actual_tokens, int):
+            return
+        with self.lock:
+            bucket.refill(time.monotonic())
+            bucket.level = min(bucket.capacity, bucket.level + estimated_tokens - actual_tokens)
+            self.budget_changed.notify_all()
 
+    def get_budgets(self):
+        now = time.monotonic()
+        budgets = []
+        with self.lock:
+            for index in range(len(self.api_keys)):
+                row = {
+                    'key': index + 1,
+                    'blocked_seconds': max(0, round(self.key_blocked_until[index] - time.time())),
+                }
+                for name, bucket in (('requests', self.request_buckets[index]), ('tokens', self.token_buckets[index])):
+                    if bucket is not None:
+                        bucket.refill(now)
+                    row[f'{name}_available'] = round(bucket.level, 1) if bucket is not None else None
+                    row[f'{name}_per_minute'] = bucket.capacity if bucket is not None else None
+                row['in_flight'] = self.key_in_flight[index]
+                budgets.append(row)
+        return budgets
+
+    def get_lane_waiting(self):
         with self.lock:
-            start_key_index = self.current_key_index
+            return {name: self.lane_waiting[lane['rank']] for name, lane in AI_PRIORITY_LANES.items()}
+
+    def generate_content(self, *args, priority='interactive', **kwargs):
+        total_keys = len(self.api_keys)
+        if not total_keys:
+            raise ValueError(GEMINI_MISSING_KEY_MESSAGE)
+        if priority not in AI_PRIORITY_LANES:
+            raise ValueError(f"Unknown AI priority lane: {priority}")
 
         if args:
             contents = args[0]
@@ -226,38 +422,439 @@ class RotatingGeminiModel:
         else:
             contents = kwargs.pop("contents")
 
-        for key_index in self._available_key_indices(start_key_index):
-            api_key = self.api_keys[key_index]
-
-            client = genai.Client(api_key=api_key)
+        estimated_tokens = self._estimate_tokens(contents)
+        tried = set()
+        while True:
+            key_index = self._reserve_key(estimated_tokens, tried, priority)
+            if key_index is None:
+                break
+            tried.add(key_index)
 
             try:
+                client = self._client_for_key(key_index)
                 response = client.models.generate_content(
                     model=self._normalized_model_name(),
                     contents=contents,
                     **kwargs
                 )
-                self._set_current_key(key_index + 1)
+                self._settle_tokens(key_index, estimated_tokens, getattr(response, "usage_metadata", None))
                 return response
             except Exception as error:
-                last_error = error
                 if total_keys == 1 or not self._is_limit_error(error):
                     raise
 
                 self._block_key_after_error(key_index, error)
-                self._set_current_key(key_index + 1)
+            finally:
+                self._release_key(key_index)
 
-        raise GeminiKeyRotationError(
-            "Tri-hand chua goi duoc Gemini vi tat ca API key hien co dang het quota, "
-            "bi khoa/suspended hoac khong hop le. Hay doi quota reset hoac them API key moi vao GOOGLE_API_KEYS trong .env."
-        )
+        raise GeminiKeyRotationError(GEMINI_ALL_KEYS_FAILED_MESSAGE)
+
+    def generate_content_stream(self, contents, priority='interactive', **kwargs):
+        """Sinh từng chunk của câu trả lời; chỉ đổi key khi lỗi xảy ra trước chunk đầu tiên."""
+        total_keys = len(self.api_keys)
+        if not total_keys:
+            raise ValueError(GEMINI_MISSING_KEY_MESSAGE)
+        if priority not in AI_PRIORITY_LANES:
+            raise ValueError(f"Unknown AI priority lane: {priority}")
+
+        estimated_tokens = self._estimate_tokens(contents)
+        tried = set()
+        while True:
+            key_index = self._reserve_key(estimated_tokens, tried, priority)
+            if key_index is None:
+                break
+            tried.add(key_index)
+
+            started = False
+            usage = None
+            try:
+                client = self._client_for_key(key_index)
+                for chunk in client.models.generate_content_stream(
+                    model=self._normalized_model_name(),
+                    contents=contents,
+                    **kwargs
+                ):
+                    started = True
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    yield chunk
+                self._settle_tokens(key_index, estimated_tokens, usage)
+                return
+            except Exception as error:
+                if started or total_keys == 1 or not self._is_limit_error(error):
+                    raise
+
+                self._block_key_after_error(key_index, error)
+            finally:
+                self._release_key(key_index)
+
+        raise GeminiKeyRotationError(GEMINI_ALL_KEYS_FAILED_MESSAGE)
 
 
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "models/gemini-2.5-flash")
+GEMINI_MAX_CONCURRENCY_PER_KEY = int(os.environ.get("GEMINI_MAX_CONCURRENCY_PER_KEY", "4"))
+GEMINI_RPM_PER_KEY = int(os.environ.get("GEMINI_RPM_PER_KEY", "10"))
+GEMINI_TPM_PER_KEY = int(os.environ.get("GEMINI_TPM_PER_KEY", "250000"))
+GEMINI_RATE_LIMIT_WAIT_SECONDS = float(os.environ.get("GEMINI_RATE_LIMIT_WAIT_SECONDS", "20"))
+GEMINI_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("GEMINI_EXPECTED_OUTPUT_TOKENS", "800"))
+AI_CALL_MAX_WORKERS = int(os.environ.get("AI_CALL_MAX_WORKERS", "8"))
+if GEMINI_MAX_CONCURRENCY_PER_KEY < 2:
+    print("Warning: GEMINI_MAX_CONCURRENCY_PER_KEY < 2; AI priority lanes cannot reserve slots for higher lanes.")
 GOOGLE_API_KEYS = get_google_api_keys()
-model = RotatingGeminiModel(GEMINI_MODEL, GOOGLE_API_KEYS)
+if not GOOGLE_API_KEYS:
+    print("Warning: GOOGLE_API_KEY is not set; AI calls will fail until it is configured.")
+model = RotatingGeminiModel(
+    GEMINI_MODEL,
+    GOOGLE_API_KEYS,
+    max_concurrency_per_key=GEMINI_MAX_CONCURRENCY_PER_KEY,
+    requests_per_minute=GEMINI_RPM_PER_KEY,
+    tokens_per_minute=GEMINI_TPM_PER_KEY,
+    max_wait_seconds=GEMINI_RATE_LIMIT_WAIT_SECONDS
+)
 analysis_model = model
 
+_ai_call_executor = None
+_ai_call_executor_pid = None
+_ai_call_executor_lock = Lock()
+
+
+def get_ai_call_executor():
+    global _ai_call_executor, _ai_call_executor_pid, _ai_call_executor_lock
+    if _ai_call_executor_pid != os.getpid():
+        # Thread của executor không đi theo process con sau fork, tạo executor mới.
+        _ai_call_executor_lock = Lock()
+        _ai_call_executor = None
+        _ai_call_executor_pid = os.getpid()
+    if _ai_call_executor is None:
+        with _ai_call_executor_lock:
+            if _ai_call_executor is None:
+                _ai_call_executor = ThreadPoolExecutor(
+                    max_workers=max(1, AI_CALL_MAX_WORKERS),
+                    thread_name_prefix="ai-call"
+                )
+    return _ai_call_executor
+
+
+def iter_ai_calls(func, items):
+    """Gọi func(item) song song trên executor chung; trả về (vị trí, kết quả, lỗi) theo thứ tự xong trước."""
+    items = list(items)
+    if len(items) <= 1:
+        for position, item in enumerate(items):
+            try:
+                yield position, func(item), None
+            except Exception as error:
+                yield position, None, error
+        return
+
+    executor = get_ai_call_executor()
+    futures = {executor.submit(func, item): position for position, item in enumerate(items)}
+    for future in as_completed(futures):
+        error = future.exception()
+        yield futures[future], (None if error else future.result()), error
+
+
+# Cache câu trả lời AI theo nội dung prompt: prompt giống hệt (cùng model, cùng ảnh) thì dùng lại kết quả.
+AI_RESPONSE_CACHE_SIZE = int(os.environ.get("AI_RESPONSE_CACHE_SIZE", "512"))
+# TTL áp dụng cho cả hai tầng, 0 = không hết hạn; tầng bộ nhớ bật/tắt bằng AI_RESPONSE_CACHE_SIZE (0 = tắt),
+# tầng lưu bền (file/bảng DB) bằng AI_RESPONSE_STORE_ENABLED.
+AI_RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("AI_RESPONSE_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+AI_RESPONSE_STORE_ENABLED = os.environ.get("AI_RESPONSE_STORE_ENABLED", "1") == "1"
+AI_RESPONSE_CACHE_DIR = os.path.join('data', 'ai_response_cache')
+# Giới hạn số bản lưu bền (file/dòng DB) và khoảng cách tối thiểu giữa hai lần dọn trong một process.
+AI_RESPONSE_STORE_MAX_ENTRIES = int(os.environ.get("AI_RESPONSE_STORE_MAX_ENTRIES", "5000"))
+AI_RESPONSE_STORE_PRUNE_SECONDS = float(os.environ.get("AI_RESPONSE_STORE_PRUNE_SECONDS", "600"))
+_ai_response_store_pruned_at = 0.0
+_ai_response_store_prune_lock = Lock()
+AI_RESPONSE_CACHE = OrderedDict()
+AI_RESPONSE_CACHE_LOCK = Lock()
+AI_RESPONSE_CACHE_STATS = {'memory_hits': 0, 'stored_hits': 0, 'misses': 0}
+
+
+def normalize_ai_prompt(text):
+    return '\n'.join(line.rstrip() for line in str(text).strip().splitlines())
+
+
+def ai_response_cache_key(contents):
+    parts = [GEMINI_MODEL]
+    for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+        if isinstance(part, Image.Image):
+            digest = hashlib.sha256(part.tobytes()).hexdigest()
+            parts.append(['image', part.mode, list(part.size), digest])
+        else:
+            parts.append(['text', normalize_ai_prompt(part)])
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def is_ai_response_fresh(created_at, now):
+    return AI_RESPONSE_CACHE_TTL_SECONDS <= 0 or now - created_at <= AI_RESPONSE_CACHE_TTL_SECONDS
+
+
+def count_ai_response_cache(field):
+    with AI_RESPONSE_CACHE_LOCK:
+        AI_RESPONSE_CACHE_STATS[field] += 1
+
+
+def remember_ai_response(key, text):
+    if AI_RESPONSE_CACHE_SIZE <= 0:
+        return
+    with AI_RESPONSE_CACHE_LOCK:
+        AI_RESPONSE_CACHE[key] = (time.time(), text)
+        AI_RESPONSE_CACHE.move_to_end(key)
+        while len(AI_RESPONSE_CACHE) > AI_RESPONSE_CACHE_SIZE:
+            AI_RESPONSE_CACHE.popitem(last=False)
+
+
+def read_stored_ai_response(key):
+    # Tầng lưu bền (bảng DB hoặc file trong data/) để cache còn sau khi restart và dùng chung giữa các worker.
+    if not exam_db_enabled():
+        entry = read_json_file(os.path.join(AI_RESPONSE_CACHE_DIR, f"{key}.json"), None)
+        if not isinstance(entry, dict):
+            return None
+        return entry.get('created_at', 0), entry.get('text')
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT EXTRACT(EPOCH FROM created_at), response FROM ai_response_cache WHERE key = %s",
+                (key,)
+            )
+            row = cur.fetchone()
+    return (float(row[0]), row[1]) if row else None
+
+
+def write_stored_ai_response(key, text):
+    if not exam_db_enabled():
+        write_json_file(
+            os.path.join(AI_RESPONSE_CACHE_DIR, f"{key}.json"),
+            {'model': GEMINI_MODEL, 'created_at': time.time(), 'text': text}
+        )
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO ai_response_cache (key, model, response) VALUES (%s, %s, %s)
+                ON CONFLICT (key) DO UPDATE
+                SET model = EXCLUDED.model, response = EXCLUDED.response, created_at = NOW()
+                """,
+                (key, GEMINI_MODEL, text)
+            )
+
+
+def prune_stored_ai_responses(force=False):
+    """Xóa bản lưu bền quá TTL rồi cắt bớt bản cũ nhất khi vượt AI_RESPONSE_STORE_MAX_ENTRIES.
+
+    Gọi sau mỗi lần ghi nhưng mỗi process chỉ thực sự dọn tối đa một lần mỗi AI_RESPONSE_STORE_PRUNE_SECONDS."""
+    global _ai_response_store_pruned_at
+    now = time.time()
+    with _ai_response_store_prune_lock:
+        if not force and now - _ai_response_store_pruned_at < AI_RESPONSE_STORE_PRUNE_SECONDS:
+            return
+        _ai_response_store_pruned_at = now
+
+    if not exam_db_enabled():
+        try:
+            entries = [
+                (entry.stat().st_mtime, entry.path)
+                for entry in os.scandir(AI_RESPONSE_CACHE_DIR)
+                if entry.name.endswith('.json') and entry.is_file()
+            ]
+        except FileNotFoundError:
+            return
+        entries.sort(reverse=True)
+        for index, (modified_at, path) in enumerate(entries):
+            expired = AI_RESPONSE_CACHE_TTL_SECONDS > 0 and now - modified_at > AI_RESPONSE_CACHE_TTL_SECONDS
+            if expired or (AI_RESPONSE_STORE_MAX_ENTRIES > 0 and index >= AI_RESPONSE_STORE_MAX_ENTRIES):
+                remove_temp_file(path)
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            if AI_RESPONSE_CACHE_TTL_SECONDS > 0:
+                cur.execute(
+                    "DELETE FROM ai_response_cache WHERE created_at < NOW() - %s * INTERVAL '1 second'",
+                    (AI_RESPONSE_CACHE_TTL_SECONDS,)
+                )
+            if AI_RESPONSE_STORE_MAX_ENTRIES > 0:
+                cur.execute(
+                    """
+                    DELETE FROM ai_response_cache WHERE key IN (
+                        SELECT key FROM ai_response_cache ORDER BY created_at DESC OFFSET %s
+                    )
+                    """,
+                    (AI_RESPONSE_STORE_MAX_ENTRIES,)
+                )
+
+
+def generate_cached_ai_text(contents, validate=None, priority='interactive', cache_key=None):
+    """Trả về response.text của model, dùng lại kết quả đã có cho cùng nội dung.
+
+    validate(text) có thể raise để kết quả hỏng (VD JSON sai) không bị lưu vào cache.
+    Khi truyền cache_key, contents có thể là hàm dựng nội dung, chỉ được gọi khi cache miss.
+    """
+    key = cache_key or ai_response_cache_key(contents)
+    now = time.time()
+    with AI_RESPONSE_CACHE_LOCK:
+        cached = AI_RESPONSE_CACHE.get(key)
+        if cached and is_ai_response_fresh(cached[0], now):
+            AI_RESPONSE_CACHE.move_to_end(key)
+            AI_RESPONSE_CACHE_STATS['memory_hits'] += 1
+            return cached[1]
+
+    if AI_RESPONSE_STORE_ENABLED:
+        try:
+            stored = read_stored_ai_response(key)
+        except Exception as error:
+            print(f"AI response cache read error: {error}")
+            stored = None
+        if stored and stored[1] is not None and is_ai_response_fresh(stored[0], now):
+            remember_ai_response(key, stored[1])
+            count_ai_response_cache('stored_hits')
+            return stored[1]
+
+    count_ai_response_cache('misses')
+    if callable(contents):
+        contents = contents()
+    text = model.generate_content(contents, priority=priority).text
+    if validate is not None:
+        validate(text)
+    remember_ai_response(key, text)
+    if AI_RESPONSE_STORE_ENABLED:
+        try:
+            write_stored_ai_response(key, text)
+            prune_stored_ai_responses()
+        except Exception as error:
+            print(f"AI response cache write error: {error}")
+    return text
+
+
+def get_ai_response_cache_stats():
+    with AI_RESPONSE_CACHE_LOCK:
+        stats = dict(AI_RESPONSE_CACHE_STATS)
+        stats['memory_entries'] = len(AI_RESPONSE_CACHE)
+    lookups = stats['memory_hits'] + stats['stored_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['memory_hits'] + stats['stored_hits']) / lookups, 4) if lookups else None
+    return stats
+
+
+# Ảnh gửi Gemini được xoay theo EXIF, thu nhỏ và nén JPEG trước; kết quả nhớ theo hash nội dung file
+# để ảnh được phân tích lại (VD báo cáo các tổ) không phải giải mã/nén lại.
+AI_IMAGE_MAX_EDGE = int(os.environ.get("AI_IMAGE_MAX_EDGE", "1600"))
+AI_IMAGE_JPEG_QUALITY = int(os.environ.get("AI_IMAGE_JPEG_QUALITY", "80"))
+AI_IMAGE_GRAYSCALE = os.environ.get("AI_IMAGE_GRAYSCALE", "1") == "1"
+AI_IMAGE_CACHE_SIZE = int(os.environ.get("AI_IMAGE_CACHE_SIZE", "64"))
+AI_IMAGE_CACHE = OrderedDict()
+AI_IMAGE_CACHE_LOCK = Lock()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def preprocess_ai_image(path, grayscale=False):
+    """Trả về bytes JPEG đã xoay đúng chiều, cạnh dài tối đa AI_IMAGE_MAX_EDGE."""
+    mode = 'L' if grayscale else 'RGB'
+    with Image.open(path) as img:
+        if AI_IMAGE_MAX_EDGE > 0:
+            # Với JPEG, draft cho phép giải mã thẳng ở độ phân giải nhỏ hơn (nhanh hơn nhiều với ảnh 4000px).
+            img.draft(mode, (AI_IMAGE_MAX_EDGE, AI_IMAGE_MAX_EDGE))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            # Nền trong suốt chuyển thành nền trắng thay vì đen.
+            img = img.convert('RGBA')
+            background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(background, img)
+        img = img.convert(mode)
+        if AI_IMAGE_MAX_EDGE > 0:
+            img.thumbnail((AI_IMAGE_MAX_EDGE, AI_IMAGE_MAX_EDGE), Image.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=AI_IMAGE_JPEG_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+def load_ai_image(path, document=False):
+    """document=True cho ảnh chụp bài làm/đề/tài liệu: chuyển xám nếu bật AI_IMAGE_GRAYSCALE; ảnh khác giữ màu."""
+    grayscale = document and AI_IMAGE_GRAYSCALE
+    key = (hash_file(path), grayscale)
+    with AI_IMAGE_CACHE_LOCK:
+        data = AI_IMAGE_CACHE.get(key)
+        if data is not None:
+            AI_IMAGE_CACHE.move_to_end(key)
+
+    if data is None:
+        data = preprocess_ai_image(path, grayscale)
+        if AI_IMAGE_CACHE_SIZE > 0:
+            with AI_IMAGE_CACHE_LOCK:
+                AI_IMAGE_CACHE[key] = data
+                while len(AI_IMAGE_CACHE) > AI_IMAGE_CACHE_SIZE:
+                    AI_IMAGE_CACHE.popitem(last=False)
+    return Image.open(io.BytesIO(data))
+
+
+# Ảnh/file học sinh tải lên được lưu theo hash SHA-256 của nội dung: tải lại cùng một ảnh chỉ thêm
+# một tham chiếu (đếm trong UPLOAD_REFS_FILE), file vật lý chỉ bị xóa khi không còn tham chiếu nào.
+UPLOAD_REFS_FILE = os.path.join('data', 'upload_refs.json')
+# Tăng khi sửa prompt phân tích ảnh/file tải lên để không dùng lại nhận xét theo prompt cũ.
+UPLOAD_ANALYSIS_PROMPT_VERSION = 1
+
+
+def store_upload(uploaded_file, folder):
+    """Lưu file tải lên vào folder theo hash nội dung; trả về (tên file, hash)."""
+    # Lấy đuôi từ tên gốc: secure_filename bỏ hết ký tự không phải ASCII ('照片.jpg' thành 'jpg'). Tên file trên
+    # đĩa chỉ gồm hash và đuôi nằm trong ALLOWED_EXTENSIONS nên không cần làm sạch thêm.
+    original_name = uploaded_file.filename or ''
+    ext = original_name.rsplit('.', 1)[1].lower() if '.' in original_name else ''
+    if ext not in ALLOWED_EXTENSIONS:
+        ext = ''
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f".upload_{uuid.uuid4().hex}.tmp")
+    uploaded_file.save(tmp_path)
+    content_hash = hash_file(tmp_path)
+    filename = f"{content_hash}.{ext}" if ext else content_hash
+    path = os.path.join(folder, filename)
+    ref_key = f"{folder}/{filename}"
+
+    with json_file_lock(UPLOAD_REFS_FILE):
+        refs = read_json_file(UPLOAD_REFS_FILE, {})
+        if os.path.exists(path):
+            remove_temp_file(tmp_path)
+            refs[ref_key] = refs.get(ref_key, 1) + 1
+        else:
+            os.replace(tmp_path, path)
+            refs[ref_key] = 1
+        write_json_file(UPLOAD_REFS_FILE, refs)
+    return filename, content_hash
+
+
+def release_upload(folder, filename):
+    # File cũ (trước khi lưu theo hash) không có trong bảng đếm nên được xóa ngay như trước.
+    path = os.path.join(folder, filename)
+    ref_key = f"{folder}/{filename}"
+    with json_file_lock(UPLOAD_REFS_FILE):
+        refs = read_json_file(UPLOAD_REFS_FILE, {})
+        remaining = refs.get(ref_key, 1) - 1
+        if remaining > 0:
+            refs[ref_key] = remaining
+        else:
+            refs.pop(ref_key, None)
+            remove_temp_file(path)
+        write_json_file(UPLOAD_REFS_FILE, refs)
+
+
+def upload_analysis_cache_key(content_hash, kind):
+    return ai_response_cache_key([
+        f"upload-analysis:{kind}:v{UPLOAD_ANALYSIS_PROMPT_VERSION}",
+        f"sha256:{content_hash}"
+    ])
+
 
 
 
@@ -285,8 +882,45 @@ EXAM_EXAMS_FILE = os.path.join('data', 'exam_system_exams.json')
 EXAM_SUBMISSIONS_FILE = os.path.join('data', 'exam_system_submissions.json')
 EXAM_MATERIALS_FILE = os.path.join('data', 'exam_system_materials.json')
 EXAM_CLASSES_FILE = os.path.join('data', 'exam_system_classes.json')
+EXAM_CLASS_STATS_FILE = os.path.join('data', 'exam_system_class_stats.json')
+EXAM_GRADING_JOBS_FILE = os.path.join('data', 'exam_system_grading_jobs.json')
 DATABASE_URL = os.environ.get("DATABASE_URL") or os.environ.get("SUPABASE_DATABASE_URL")
 DATABASE_SSLMODE = os.environ.get("DATABASE_SSLMODE", "require")
+DATABASE_POOL_MAX_SIZE = int(os.environ.get("DATABASE_POOL_MAX_SIZE", "5"))
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "10"))
+DATABASE_POOL_IDLE_SECONDS = float(os.environ.get("DATABASE_POOL_IDLE_SECONDS", "300"))
+DATABASE_POOL_HEALTHCHECK_SECONDS = float(os.environ.get("DATABASE_POOL_HEALTHCHECK_SECONDS", "30"))
+# json | postgres | sqlite; mặc định dùng PostgreSQL khi có DATABASE_URL, ngược lại là file JSON.
+EXAM_STORE_BACKENDS = ('json', 'postgres', 'sqlite')
+EXAM_STORE_BACKEND = (
+    os.environ.get("EXAM_STORE_BACKEND") or ("postgres" if DATABASE_URL else "json")
+).strip().lower()
+# Giá trị sai không được lặng lẽ chuyển về JSON (dữ liệu sẽ ghi nhầm chỗ), nên dừng ngay khi khởi động.
+if EXAM_STORE_BACKEND not in EXAM_STORE_BACKENDS:
+    raise ValueError(
+        f"EXAM_STORE_BACKEND={EXAM_STORE_BACKEND!r} không hợp lệ, chỉ nhận: {', '.join(EXAM_STORE_BACKENDS)}"
+    )
+if EXAM_STORE_BACKEND == 'postgres' and not DATABASE_URL:
+    raise ValueError("EXAM_STORE_BACKEND=postgres cần DATABASE_URL hoặc SUPABASE_DATABASE_URL")
+EXAM_SQLITE_PATH = os.environ.get("EXAM_SQLITE_PATH", os.path.join('data', 'exam_system.sqlite3'))
+EXAM_SQLITE_BUSY_TIMEOUT = float(os.environ.get("EXAM_SQLITE_BUSY_TIMEOUT", "10"))
+EXAM_UPDATE_MAX_ATTEMPTS = int(os.environ.get("EXAM_UPDATE_MAX_ATTEMPTS", "5"))
+EXAM_SUBMISSIONS_PAGE_SIZE = int(os.environ.get("EXAM_SUBMISSIONS_PAGE_SIZE", "30"))
+EXAM_SUBMISSIONS_MAX_PAGE_SIZE = 200
+EXAM_SUBMISSION_SORTS = ('time_desc', 'time_asc', 'score_desc', 'score_asc')
+EXAM_SUBMISSION_ORDER_CACHE_SIZE = 64
+# Nhóm điểm trên trang danh sách bài nộp: (điểm từ, điểm dưới), None là không giới hạn.
+EXAM_SUBMISSION_SCORE_BANDS = {
+    'excellent': (8, None),
+    'good': (6.5, 8),
+    'average': (5, 6.5),
+    'poor': (None, 5),
+}
+ESSAY_GRADING_WORKERS = int(os.environ.get("ESSAY_GRADING_WORKERS", "2"))
+ESSAY_GRADING_MAX_ATTEMPTS = int(os.environ.get("ESSAY_GRADING_MAX_ATTEMPTS", "4"))
+ESSAY_GRADING_RETRY_SECONDS = float(os.environ.get("ESSAY_GRADING_RETRY_SECONDS", "10"))
+ESSAY_GRADING_LEASE_SECONDS = float(os.environ.get("ESSAY_GRADING_LEASE_SECONDS", "300"))
+ESSAY_GRADING_POLL_SECONDS = float(os.environ.get("ESSAY_GRADING_POLL_SECONDS", "5"))
 ADMIN_USERNAME = os.environ.get("EXAM_ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD_HASH = generate_password_hash(
     os.environ.get("EXAM_ADMIN_PASSWORD", "admin2026")
@@ -294,10 +928,378 @@ ADMIN_PASSWORD_HASH = generate_password_hash(
 
 _exam_store_initialized = False
 
+# Mỗi collection của hệ thống kiểm tra được lưu thành bảng riêng, mỗi bản ghi một dòng.
+# "columns" là các khóa được tách ra cột để lọc/đánh index, phần còn lại nằm trong data JSONB.
+# "indexes" là các trường được dựng index trong bộ nhớ cho find_exam_records.
+EXAM_COLLECTIONS = {
+    'users': {
+        'path': EXAM_USERS_FILE,
+        'fallback': {},
+        'type': dict,
+        'table': 'exam_users',
+        'columns': ('role', 'username'),
+        'indexes': ('id', 'username', 'class_id'),
+    },
+    'classes': {
+        'path': EXAM_CLASSES_FILE,
+        'fallback': [],
+        'type': list,
+        'table': 'exam_classes',
+        'columns': ('teacher_id', 'class_code'),
+        'indexes': ('id', 'teacher_id', 'class_code', 'student_ids'),
+        'members_field': 'student_ids',
+    },
+    'lessons': {
+        'path': EXAM_LESSONS_FILE,
+        'fallback': [],
+        'type': list,
+        'table': 'exam_lessons',
+        'columns': ('class_id', 'teacher_id'),
+        'indexes': ('id', 'class_id', 'teacher_id'),
+    },
+    'exams': {
+        'path': EXAM_EXAMS_FILE,
+        'fallback': [],
+        'type': list,
+        'table': 'exam_exams',
+        'columns': ('class_id', 'teacher_id'),
+        'indexes': ('id', 'class_id', 'teacher_id'),
+        'child_table': 'exam_questions',
+        'child_key': 'exam_id',
+        'child_fields': ('questions', 'essay_questions'),
+    },
+    'submissions': {
+        'path': EXAM_SUBMISSIONS_FILE,
+        'fallback': [],
+        'type': list,
+        'table': 'exam_submissions',
+        'columns': ('exam_id', 'class_id', 'student_id'),
+        'indexes': ('id', 'exam_id', 'class_id', 'student_id'),
+        'child_table': 'exam_submission_results',
+        'child_key': 'submission_id',
+        'child_fields': ('detailed_results',),
+    },
+    'materials': {
+        'path': EXAM_MATERIALS_FILE,
+        'fallback': [],
+        'type': list,
+        'table': 'exam_materials',
+        'columns': ('class_id', 'teacher_id'),
+        'indexes': ('id', 'class_id', 'teacher_id'),
+    },
+}
+EXAM_USER_ROLES = ('students', 'teachers', 'parents')
+EXAM_SORT_KEY_STEP = 1024
+
+# Cache cấp process: collection -> (version, payload marshal)
+EXAM_PROCESS_CACHE = {}
+EXAM_PROCESS_CACHE_LOCK = Lock()
+
+EXAM_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exam_store_collections (
+    collection TEXT PRIMARY KEY,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS exam_users (
+    id TEXT PRIMARY KEY,
+    role TEXT NOT NULL,
+    username TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_users_role_idx ON exam_users (role, sort_key);
+CREATE INDEX IF NOT EXISTS exam_users_username_idx ON exam_users (username);
+
+CREATE TABLE IF NOT EXISTS exam_classes (
+    id TEXT PRIMARY KEY,
+    teacher_id TEXT,
+    class_code TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_classes_teacher_idx ON exam_classes (teacher_id);
+CREATE INDEX IF NOT EXISTS exam_classes_code_idx ON exam_classes (class_code);
+
+CREATE TABLE IF NOT EXISTS exam_class_members (
+    class_id TEXT NOT NULL REFERENCES exam_classes (id) ON DELETE CASCADE,
+    student_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (class_id, student_id)
+);
+CREATE INDEX IF NOT EXISTS exam_class_members_student_idx ON exam_class_members (student_id);
+
+CREATE TABLE IF NOT EXISTS exam_lessons (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_lessons_class_idx ON exam_lessons (class_id);
+CREATE INDEX IF NOT EXISTS exam_lessons_teacher_idx ON exam_lessons (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_exams (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_exams_class_idx ON exam_exams (class_id);
+CREATE INDEX IF NOT EXISTS exam_exams_teacher_idx ON exam_exams (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_questions (
+    exam_id TEXT NOT NULL REFERENCES exam_exams (id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data JSONB NOT NULL,
+    PRIMARY KEY (exam_id, field, position)
+);
+
+CREATE TABLE IF NOT EXISTS exam_submissions (
+    id TEXT PRIMARY KEY,
+    exam_id TEXT,
+    class_id TEXT,
+    student_id TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_submissions_exam_idx ON exam_submissions (exam_id);
+CREATE INDEX IF NOT EXISTS exam_submissions_class_idx ON exam_submissions (class_id);
+CREATE INDEX IF NOT EXISTS exam_submissions_student_idx ON exam_submissions (student_id);
+
+CREATE TABLE IF NOT EXISTS exam_submission_results (
+    submission_id TEXT NOT NULL REFERENCES exam_submissions (id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data JSONB NOT NULL,
+    PRIMARY KEY (submission_id, field, position)
+);
+
+CREATE TABLE IF NOT EXISTS exam_materials (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key BIGINT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS exam_materials_class_idx ON exam_materials (class_id);
+CREATE INDEX IF NOT EXISTS exam_materials_teacher_idx ON exam_materials (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_class_stats (
+    class_id TEXT PRIMARY KEY,
+    student_count INTEGER NOT NULL DEFAULT 0,
+    lesson_count INTEGER NOT NULL DEFAULT 0,
+    exam_count INTEGER NOT NULL DEFAULT 0,
+    material_count INTEGER NOT NULL DEFAULT 0,
+    submission_count INTEGER NOT NULL DEFAULT 0,
+    score_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    last_activity TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS ai_response_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS ai_response_cache_created_idx ON ai_response_cache (created_at);
+
+CREATE TABLE IF NOT EXISTS chat_turns (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    user_text TEXT NOT NULL,
+    bot_text TEXT NOT NULL,
+    timestamp TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS chat_turns_chat_idx ON chat_turns (chat_id, id);
+CREATE INDEX IF NOT EXISTS chat_turns_created_idx ON chat_turns (created_at);
+
+CREATE TABLE IF NOT EXISTS chat_summaries (
+    chat_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    upto_seq BIGINT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS exam_grading_jobs (
+    submission_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    locked_until TIMESTAMPTZ,
+    last_error TEXT,
+    graded INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+ALTER TABLE exam_grading_jobs ADD COLUMN IF NOT EXISTS graded INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS exam_grading_jobs_due_idx ON exam_grading_jobs (status, next_attempt_at);
+"""
+
+# Cùng cấu trúc bảng với EXAM_STORE_SCHEMA cho các collection của hệ thống kiểm tra; data lưu JSON dạng TEXT.
+# exam_store_collections.revision tăng sau mỗi lần ghi và được dùng làm version cho cache cấp process.
+EXAM_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exam_store_collections (
+    collection TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+);
+
+CREATE TABLE IF NOT EXISTS exam_users (
+    id TEXT PRIMARY KEY,
+    role TEXT NOT NULL,
+    username TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_users_role_idx ON exam_users (role, sort_key);
+CREATE INDEX IF NOT EXISTS exam_users_username_idx ON exam_users (username);
+
+CREATE TABLE IF NOT EXISTS exam_classes (
+    id TEXT PRIMARY KEY,
+    teacher_id TEXT,
+    class_code TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_classes_teacher_idx ON exam_classes (teacher_id);
+CREATE INDEX IF NOT EXISTS exam_classes_code_idx ON exam_classes (class_code);
+
+CREATE TABLE IF NOT EXISTS exam_class_members (
+    class_id TEXT NOT NULL REFERENCES exam_classes (id) ON DELETE CASCADE,
+    student_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (class_id, student_id)
+);
+CREATE INDEX IF NOT EXISTS exam_class_members_student_idx ON exam_class_members (student_id);
+
+CREATE TABLE IF NOT EXISTS exam_lessons (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_lessons_class_idx ON exam_lessons (class_id);
+CREATE INDEX IF NOT EXISTS exam_lessons_teacher_idx ON exam_lessons (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_exams (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_exams_class_idx ON exam_exams (class_id);
+CREATE INDEX IF NOT EXISTS exam_exams_teacher_idx ON exam_exams (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_questions (
+    exam_id TEXT NOT NULL REFERENCES exam_exams (id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (exam_id, field, position)
+);
+
+CREATE TABLE IF NOT EXISTS exam_submissions (
+    id TEXT PRIMARY KEY,
+    exam_id TEXT,
+    class_id TEXT,
+    student_id TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_submissions_exam_idx ON exam_submissions (exam_id);
+CREATE INDEX IF NOT EXISTS exam_submissions_class_idx ON exam_submissions (class_id);
+CREATE INDEX IF NOT EXISTS exam_submissions_student_idx ON exam_submissions (student_id);
+
+CREATE TABLE IF NOT EXISTS exam_submission_results (
+    submission_id TEXT NOT NULL REFERENCES exam_submissions (id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (submission_id, field, position)
+);
+
+CREATE TABLE IF NOT EXISTS exam_materials (
+    id TEXT PRIMARY KEY,
+    class_id TEXT,
+    teacher_id TEXT,
+    sort_key INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS exam_materials_class_idx ON exam_materials (class_id);
+CREATE INDEX IF NOT EXISTS exam_materials_teacher_idx ON exam_materials (teacher_id);
+
+CREATE TABLE IF NOT EXISTS exam_class_stats (
+    class_id TEXT PRIMARY KEY,
+    student_count INTEGER NOT NULL DEFAULT 0,
+    lesson_count INTEGER NOT NULL DEFAULT 0,
+    exam_count INTEGER NOT NULL DEFAULT 0,
+    material_count INTEGER NOT NULL DEFAULT 0,
+    submission_count INTEGER NOT NULL DEFAULT 0,
+    score_sum REAL NOT NULL DEFAULT 0,
+    last_activity TEXT,
+    updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Thống kê lớp được cộng dồn mỗi khi ghi bản ghi liên quan, thay vì đếm lại toàn bộ collection.
+EXAM_CLASS_STATS_FIELDS = (
+    'student_count', 'lesson_count', 'exam_count', 'material_count', 'submission_count', 'score_sum'
+)
+EXAM_CLASS_STATS_COUNTERS = {
+    'lessons': 'lesson_count',
+    'exams': 'exam_count',
+    'materials': 'material_count',
+}
+EXAM_CLASS_STATS_COLLECTIONS = ('classes', 'lessons', 'exams', 'materials', 'submissions')
+
 
 # Helper functions
 def exam_db_enabled():
-    return bool(DATABASE_URL)
+    return EXAM_STORE_BACKEND == 'postgres' and bool(DATABASE_URL)
+
+
+def exam_sqlite_enabled():
+    return EXAM_STORE_BACKEND == 'sqlite'
+
+
+def exam_storage_backend_label():
+    if exam_db_enabled():
+        return 'PostgreSQL/Supabase'
+    if exam_sqlite_enabled():
+        return 'SQLite local'
+    return 'JSON local'
 
 
 def normalize_database_url(url):
@@ -315,31 +1317,272 @@ def get_exam_db_connection():
         ) from exc
 
     dsn = normalize_database_url(DATABASE_URL)
-    kwargs = {"connect_timeout": 10}
+    kwargs = {
+        "connect_timeout": 10,
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3
+    }
     if "sslmode=" not in dsn:
         kwargs["sslmode"] = DATABASE_SSLMODE
     return psycopg2.connect(dsn, **kwargs)
 
 
+class ExamDbPoolTimeout(RuntimeError):
+    pass
+
+
+class ExamDbConnectionPool:
+    """Pool kết nối dùng chung cho cả process, an toàn với gunicorn threads và pre-fork."""
+
+    def __init__(self, connect, max_size, acquire_timeout, idle_seconds, healthcheck_seconds):
+        self.connect = connect
+        self.max_size = max(1, max_size)
+        self.acquire_timeout = acquire_timeout
+        self.idle_seconds = idle_seconds
+        self.healthcheck_seconds = healthcheck_seconds
+        self.condition = Condition()
+        self.idle_connections = []
+        self.in_use = 0
+        self.pid = os.getpid()
+        # Kết nối thừa kế từ process cha: giữ tham chiếu để GC không đóng socket dùng chung.
+        self.inherited_connections = []
+
+    def reset_after_fork(self):
+        self.inherited_connections.extend(conn for conn, _ in self.idle_connections)
+        self.condition = Condition()
+        self.idle_connections = []
+        self.in_use = 0
+        self.pid = os.getpid()
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle_locked(self, now):
+        keep = []
+        for conn, last_used in self.idle_connections:
+            if conn.closed or now - last_used > self.idle_seconds:
+                self._close_quietly(conn)
+            else:
+                keep.append((conn, last_used))
+        self.idle_connections = keep
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        if self.pid != os.getpid():
+            self.reset_after_fork()
+
+        deadline = time.monotonic() + self.acquire_timeout
+        conn, last_used = None, None
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._evict_idle_locked(now)
+                if self.idle_connections:
+                    conn, last_used = self.idle_connections.pop()
+                    break
+                if self.in_use < self.max_size:
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise ExamDbPoolTimeout(
+                        f"Không lấy được kết nối database sau {self.acquire_timeout:g} giây "
+                        f"(pool tối đa {self.max_size} kết nối)."
+                    )
+                self.condition.wait(remaining)
+            self.in_use += 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except Exception:
+            with self.condition:
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        if self.pid != os.getpid():
+            return
+
+        if not discard and not conn.closed:
+            try:
+                # Không trả về pool một kết nối còn đang dở transaction.
+                conn.rollback()
+            except Exception:
+                discard = True
+        with self.condition:
+            self.in_use -= 1
+            if discard or conn.closed:
+                self._close_quietly(conn)
+            else:
+                self.idle_connections.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    def close_all(self):
+        with self.condition:
+            for conn, _ in self.idle_connections:
+                self._close_quietly(conn)
+            self.idle_connections = []
+
+
+_exam_db_pool = None
+_exam_db_pool_lock = Lock()
+
+
+def get_exam_db_pool():
+    global _exam_db_pool
+    if _exam_db_pool is None:
+        with _exam_db_pool_lock:
+            if _exam_db_pool is None:
+                _exam_db_pool = ExamDbConnectionPool(
+                    get_exam_db_connection,
+                    DATABASE_POOL_MAX_SIZE,
+                    DATABASE_POOL_TIMEOUT,
+                    DATABASE_POOL_IDLE_SECONDS,
+                    DATABASE_POOL_HEALTHCHECK_SECONDS
+                )
+    return _exam_db_pool
+
+
+def reset_exam_db_pool_after_fork():
+    global _exam_db_pool_lock
+    _exam_db_pool_lock = Lock()
+    if _exam_db_pool is not None:
+        _exam_db_pool.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_exam_db_pool_after_fork)
+
+
+@contextmanager
+def exam_db_connection():
+    """Mượn một kết nối từ pool; commit khi thành công, rollback khi lỗi."""
+    import psycopg2
+
+    pool = get_exam_db_pool()
+    conn = pool.acquire()
+    discard = False
+    try:
+        with conn:
+            yield conn
+    except Exception as error:
+        discard = isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
+
 def ensure_exam_store_table():
     global _exam_store_initialized
     if _exam_store_initialized or not exam_db_enabled():
         return
 
-    with get_exam_db_connection() as conn:
+    with exam_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS exam_system_store (
-                    collection TEXT PRIMARY KEY,
-                    payload JSONB NOT NULL,
-                    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                )
-                """
-            )
+            # Nhiều worker có thể khởi động cùng lúc: khóa trước cả bước tạo bảng (CREATE ... IF NOT EXISTS chạy
+            # song song vẫn có thể lỗi trùng tên trong catalog), chỉ một worker tạo schema và bootstrap dữ liệu.
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('exam_store_bootstrap'))")
+            cur.execute(EXAM_STORE_SCHEMA)
+            bootstrap_exam_store(cur)
     _exam_store_initialized = True
 
 
+def bootstrap_exam_store(cur):
+    cur.execute("SELECT collection FROM exam_store_collections")
+    ready = {row[0] for row in cur.fetchall()}
+    missing = [collection for collection in EXAM_COLLECTIONS if collection not in ready]
+    if not missing:
+        return
+
+    # Ưu tiên dữ liệu từ bảng JSONB cũ exam_system_store, sau đó mới đến file JSON local.
+    legacy_payloads = {}
+    cur.execute("SELECT to_regclass('exam_system_store')")
+    if cur.fetchone()[0]:
+        cur.execute(
+            "SELECT collection, payload FROM exam_system_store WHERE collection = ANY(%s)",
+            (missing,)
+        )
+        legacy_payloads = dict(cur.fetchall())
+
+    for collection in missing:
+        spec = EXAM_COLLECTIONS[collection]
+        if collection in legacy_payloads:
+            data = legacy_payloads[collection]
+        else:
+            data = read_exam_collection_file(collection, spec['path'], spec['fallback'], spec['type'])
+        data = normalize_collection_payload(data, spec['fallback'], spec['type'])
+        sync_exam_collection_rows(cur, collection, data)
+
+
+# ---------------- FILE STORE ----------------
+# Mọi dữ liệu lưu bằng file JSON đi qua các hàm dưới đây: ghi ra file tạm + fsync rồi os.replace
+# (không bao giờ để lại file ghi dở), và khóa theo từng file cả giữa các thread lẫn giữa các worker
+# gunicorn (fcntl trên file .lock bên cạnh) để các lần đọc-sửa-ghi không ghi đè lên nhau.
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ còn khóa trong process.
+    fcntl = None
+
+_json_file_locks = {}
+_json_file_locks_guard = Lock()
+
+
+def reset_json_file_locks_after_fork():
+    global _json_file_locks, _json_file_locks_guard
+    _json_file_locks = {}
+    _json_file_locks_guard = Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_json_file_locks_after_fork)
+
+
+@contextmanager
+def json_file_lock(path):
+    """Giữ quyền ghi độc quyền trên path; gọi lồng nhau trong cùng thread được."""
+    key = os.path.abspath(path)
+    with _json_file_locks_guard:
+        state = _json_file_locks.setdefault(key, {'lock': RLock(), 'depth': 0, 'handle': None})
+
+    with state['lock']:
+        if state['depth'] == 0 and fcntl is not None:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            handle = open(f"{key}.lock", 'a')
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            state['handle'] = handle
+        state['depth'] += 1
+        try:
+            yield
+        finally:
+            state['depth'] -= 1
+            if state['depth'] == 0 and state['handle'] is not None:
+                fcntl.flock(state['handle'].fileno(), fcntl.LOCK_UN)
+                state['handle'].close()
+                state['handle'] = None
+
+
 def read_json_file(path, fallback):
     try:
         with open(path, 'r', encoding='utf-8') as f:
@@ -347,14 +1590,47 @@ def read_json_file(path, fallback):
             return data if data is not None else fallback
     except FileNotFoundError:
         return fallback
-    except json.JSONDecodeError:
+    except json.JSONDecodeError as error:
+        print(f"JSON read error in {path}: {error}")
         return fallback
 
 
 def write_json_file(path, data):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Ghi nguyên tử; muốn đọc-sửa-ghi an toàn thì gọi trong json_file_lock(path) hoặc dùng update_json_file."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove_temp_file(tmp_path)
+        raise
+    try:
+        # fsync thư mục để thao tác đổi tên cũng bền qua sự cố mất điện.
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def update_json_file(path, fallback, mutate):
+    """Đọc - sửa - ghi trong khóa của file. mutate(data) sửa tại chỗ hoặc trả về dữ liệu mới; trả về dữ liệu đã ghi."""
+    with json_file_lock(path):
+        data = read_json_file(path, fallback)
+        result = mutate(data)
+        if result is not None:
+            data = result
+        write_json_file(path, data)
+    return data
 
 
 def normalize_collection_payload(data, fallback, expected_type=None):
@@ -363,54 +1639,1190 @@ def normalize_collection_payload(data, fallback, expected_type=None):
     return data
 
 
-def load_exam_collection(collection, path, fallback, expected_type=None):
-    fallback_data = read_json_file(path, fallback)
-    fallback_data = normalize_collection_payload(fallback_data, fallback, expected_type)
+def exam_record_fingerprint(record, role=None):
+    raw = json.dumps([role, record], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def iter_exam_records(collection, data):
+    if collection == 'users':
+        for role, records in (data or {}).items():
+            for record in records or []:
+                if isinstance(record, dict):
+                    yield role, record
+        return
+    for record in data or []:
+        if isinstance(record, dict):
+            yield None, record
+
+
+def split_exam_record(collection, record):
+    spec = EXAM_COLLECTIONS[collection]
+    data = dict(record)
+    children = {}
+    for field in spec.get('child_fields', ()):
+        if isinstance(data.get(field), list):
+            children[field] = data[field]
+            # Giữ khóa rỗng để lúc đọc biết bản ghi có trường này.
+            data[field] = []
+    members = None
+    members_field = spec.get('members_field')
+    if members_field and isinstance(data.get(members_field), list):
+        members = list(dict.fromkeys(data[members_field]))
+        data[members_field] = []
+    return data, children, members
+
+
+def exam_row_columns(collection, record, role=None):
+    values = []
+    for column in EXAM_COLLECTIONS[collection]['columns']:
+        if column == 'role':
+            values.append(role or 'students')
+        else:
+            value = record.get(column)
+            values.append(str(value) if value is not None else None)
+    return values
+
+
+def prepare_exam_row_values(collection, rows, encode):
+    """Tách rows thành giá trị cho bảng cha, bảng con và bảng thành viên; encode bọc phần JSON theo driver."""
+    parent_values = []
+    child_values = []
+    member_values = []
+    record_ids = []
+    for role, record, sort_key in rows:
+        record_id = str(record['id'])
+        record_ids.append(record_id)
+        data, children, members = split_exam_record(collection, record)
+        parent_values.append((
+            record_id,
+            *exam_row_columns(collection, record, role),
+            sort_key,
+            exam_record_fingerprint(record, role),
+            encode(data)
+        ))
+        for field, items in children.items():
+            for position, item in enumerate(items):
+                child_values.append((record_id, field, position, encode(item)))
+        for position, student_id in enumerate(members or []):
+            member_values.append((record_id, str(student_id), position))
+    return record_ids, parent_values, child_values, member_values
+
+
+def write_exam_rows(cur, collection, rows):
+    """rows: danh sách (role, record, sort_key); ghi đè dòng cha và toàn bộ dòng con."""
+    if not rows:
+        return
+
+    from psycopg2.extras import Json, execute_values
+    spec = EXAM_COLLECTIONS[collection]
+    table = spec['table']
+    columns = spec['columns']
+    record_ids, parent_values, child_values, member_values = prepare_exam_row_values(collection, rows, Json)
+    column_list = ', '.join(('id',) + columns + ('sort_key', 'fingerprint', 'data'))
+    update_list = ', '.join(
+        f"{column} = EXCLUDED.{column}"
+        for column in columns + ('sort_key', 'fingerprint', 'data')
+    )
+    placeholders = ', '.join(['%s'] * (len(columns) + 4))
+    execute_values(
+        cur,
+        f"""
+        INSERT INTO {table} ({column_list}, updated_at)
+        VALUES %s
+        ON CONFLICT (id)
+        DO UPDATE SET {update_list}, updated_at = NOW()
+        """,
+        parent_values,
+        template=f"({placeholders}, NOW())"
+    )
+
+    child_table = spec.get('child_table')
+    if child_table:
+        child_key = spec['child_key']
+        cur.execute(f"DELETE FROM {child_table} WHERE {child_key} = ANY(%s)", (record_ids,))
+        if child_values:
+            execute_values(
+                cur,
+                f"INSERT INTO {child_table} ({child_key}, field, position, data) VALUES %s",
+                child_values
+            )
+    if spec.get('members_field'):
+        cur.execute("DELETE FROM exam_class_members WHERE class_id = ANY(%s)", (record_ids,))
+        if member_values:
+            execute_values(
+                cur,
+                "INSERT INTO exam_class_members (class_id, student_id, position) VALUES %s",
+                member_values
+            )
+
+
+def delete_exam_rows(cur, collection, record_ids):
+    if record_ids:
+        table = EXAM_COLLECTIONS[collection]['table']
+        cur.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", (list(record_ids),))
+
+
+def touch_exam_collection(cur, collection):
+    cur.execute(
+        """
+        INSERT INTO exam_store_collections (collection, updated_at)
+        VALUES (%s, NOW())
+        ON CONFLICT (collection)
+        DO UPDATE SET updated_at = NOW()
+        """,
+        (collection,)
+    )
+
+
+def assign_exam_sort_keys(existing_keys):
+    """Gán sort_key theo thứ tự mới, chỉ đổi khóa của dòng mới khi còn khoảng trống."""
+    known = [key for key in existing_keys if key is not None]
+    if any(left >= right for left, right in zip(known, known[1:])):
+        return [index * EXAM_SORT_KEY_STEP for index in range(len(existing_keys))]
+
+    keys = list(existing_keys)
+    index = 0
+    while index < len(keys):
+        if keys[index] is not None:
+            index += 1
+            continue
+        run_end = index
+        while run_end < len(keys) and keys[run_end] is None:
+            run_end += 1
+        run_length = run_end - index
+        left = keys[index - 1] if index > 0 else None
+        right = keys[run_end] if run_end < len(keys) else None
+        if left is None and right is None:
+            new_keys = [offset * EXAM_SORT_KEY_STEP for offset in range(run_length)]
+        elif left is None:
+            new_keys = [right - EXAM_SORT_KEY_STEP * (run_length - offset) for offset in range(run_length)]
+        elif right is None:
+            new_keys = [left + EXAM_SORT_KEY_STEP * (offset + 1) for offset in range(run_length)]
+        elif right - left > run_length:
+            new_keys = [left + (right - left) * (offset + 1) // (run_length + 1) for offset in range(run_length)]
+        else:
+            return [position * EXAM_SORT_KEY_STEP for position in range(len(existing_keys))]
+        keys[index:run_end] = new_keys
+        index = run_end
+    return keys
+
+
+def plan_exam_collection_sync(collection, data, existing):
+    """existing: id -> (fingerprint, sort_key) đang lưu; trả về (dòng cần ghi, id cần xóa)."""
+    records = []
+    seen_ids = set()
+    for role, record in iter_exam_records(collection, data):
+        record.setdefault('id', str(uuid.uuid4()))
+        record_id = str(record['id'])
+        if record_id in seen_ids:
+            continue
+        seen_ids.add(record_id)
+        records.append((role, record, record_id))
+
+    sort_keys = assign_exam_sort_keys([
+        existing[record_id][1] if record_id in existing else None
+        for _, _, record_id in records
+    ])
+    changed_rows = []
+    for (role, record, record_id), sort_key in zip(records, sort_keys):
+        old = existing.get(record_id)
+        if old and old[0] == exam_record_fingerprint(record, role) and old[1] == sort_key:
+            continue
+        changed_rows.append((role, record, sort_key))
+    return changed_rows, set(existing) - seen_ids
+
+
+def sync_exam_collection_rows(cur, collection, data):
+    """Đồng bộ cả collection nhưng chỉ ghi những dòng mới, bị sửa, đổi vị trí hoặc bị xóa."""
+    table = EXAM_COLLECTIONS[collection]['table']
+    cur.execute(f"SELECT id, fingerprint, sort_key FROM {table}")
+    existing = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    changed_rows, removed_ids = plan_exam_collection_sync(collection, data, existing)
+    write_exam_rows(cur, collection, changed_rows)
+    delete_exam_rows(cur, collection, removed_ids)
+    touch_exam_collection(cur, collection)
+
+
+def fetch_exam_collection_rows(cur, collection, record_ids=None):
+    """Đọc cả collection, hoặc chỉ các bản ghi trong record_ids (khóa dòng để ghi đè ngay sau đó)."""
+    spec = EXAM_COLLECTIONS[collection]
+    table = spec['table']
+    role_column = 'role' if collection == 'users' else 'NULL'
+    if record_ids is None:
+        cur.execute(f"SELECT id, {role_column}, data FROM {table} ORDER BY sort_key, id")
+    else:
+        record_ids = [str(record_id) for record_id in record_ids]
+        cur.execute(
+            f"SELECT id, {role_column}, data FROM {table} WHERE id = ANY(%s) "
+            f"ORDER BY sort_key, id FOR UPDATE",
+            (record_ids,)
+        )
+    rows = cur.fetchall()
+
+    child_rows = {}
+    child_table = spec.get('child_table')
+    if child_table:
+        child_key = spec['child_key']
+        child_filter = f"WHERE {child_key} = ANY(%s) " if record_ids is not None else ""
+        cur.execute(
+            f"SELECT {child_key}, field, data FROM {child_table} {child_filter}"
+            f"ORDER BY {child_key}, field, position",
+            (record_ids,) if record_ids is not None else None
+        )
+        for record_id, field, item in cur.fetchall():
+            child_rows.setdefault(record_id, {}).setdefault(field, []).append(item)
+
+    member_rows = {}
+    members_field = spec.get('members_field')
+    if members_field:
+        if record_ids is None:
+            cur.execute("SELECT class_id, student_id FROM exam_class_members ORDER BY class_id, position")
+        else:
+            cur.execute(
+                "SELECT class_id, student_id FROM exam_class_members "
+                "WHERE class_id = ANY(%s) ORDER BY class_id, position",
+                (record_ids,)
+            )
+        for class_id, student_id in cur.fetchall():
+            member_rows.setdefault(class_id, []).append(student_id)
+    return assemble_exam_collection(collection, rows, child_rows, member_rows)
+
+
+def assemble_exam_collection(collection, rows, child_rows, member_rows):
+    """Ghép dòng cha (id, role, data) với dòng con và danh sách thành viên thành payload của collection."""
+    spec = EXAM_COLLECTIONS[collection]
+    members_field = spec.get('members_field')
+    if collection == 'users':
+        result = {role: [] for role in EXAM_USER_ROLES}
+    else:
+        result = []
+    for record_id, role, record in rows:
+        for field in spec.get('child_fields', ()):
+            if field in record:
+                record[field] = child_rows.get(record_id, {}).get(field, [])
+        if members_field and members_field in record:
+            record[members_field] = member_rows.get(record_id, [])
+        if collection == 'users':
+            result.setdefault(role, []).append(record)
+        else:
+            result.append(record)
+    return result
+
+
+# ---------------- SQLITE STORE ----------------
+# Chế độ EXAM_STORE_BACKEND=sqlite: các collection của hệ thống kiểm tra nằm trong một file SQLite (WAL,
+# nhiều thread/worker đọc song song, một người ghi), cùng bảng và cùng cách ghi từng dòng như PostgreSQL.
+# Thống kê lớp, cache AI, hàng đợi chấm bài và lịch sử chat vẫn dùng file JSON như chế độ JSON.
+_exam_sqlite_local = local()
+_exam_sqlite_inherited = []
+_exam_sqlite_initialized = False
+_exam_sqlite_init_lock = Lock()
+
+
+def get_exam_sqlite_connection():
+    """Mỗi thread một kết nối (sqlite3 không cho dùng chung kết nối giữa các thread), mở lại sau fork."""
+    conn = getattr(_exam_sqlite_local, 'conn', None)
+    if conn is not None and _exam_sqlite_local.pid == os.getpid():
+        return conn
+    if conn is not None:
+        # Kết nối thừa kế từ process cha: không đóng để SQLite không checkpoint/xóa WAL thay cho process cha.
+        _exam_sqlite_inherited.append(conn)
+
+    os.makedirs(os.path.dirname(EXAM_SQLITE_PATH) or '.', exist_ok=True)
+    conn = sqlite3.connect(
+        EXAM_SQLITE_PATH,
+        timeout=EXAM_SQLITE_BUSY_TIMEOUT,
+        isolation_level=None,
+        cached_statements=256
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    _exam_sqlite_local.conn = conn
+    _exam_sqlite_local.pid = os.getpid()
+    return conn
+
+
+def ensure_exam_sqlite_store(conn):
+    global _exam_sqlite_initialized
+    if _exam_sqlite_initialized:
+        return
+
+    with _exam_sqlite_init_lock:
+        if _exam_sqlite_initialized:
+            return
+        conn.executescript(EXAM_SQLITE_SCHEMA)
+        # BEGIN IMMEDIATE: nhiều worker khởi động cùng lúc, chỉ một worker được bootstrap dữ liệu.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ready = {row[0] for row in conn.execute("SELECT collection FROM exam_store_collections")}
+            for collection, spec in EXAM_COLLECTIONS.items():
+                if collection in ready:
+                    continue
+                data = read_exam_collection_file(collection, spec['path'], spec['fallback'], spec['type'])
+                sync_exam_sqlite_rows(conn, collection, data)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        _exam_sqlite_initialized = True
+
+
+@contextmanager
+def exam_sqlite_transaction(write=False):
+    """Đọc trong một snapshot của WAL; ghi dùng BEGIN IMMEDIATE để giữ khóa ghi ngay từ đầu."""
+    conn = get_exam_sqlite_connection()
+    ensure_exam_sqlite_store(conn)
+    conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def encode_exam_sqlite_json(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def write_exam_sqlite_rows(conn, collection, rows):
+    """Như write_exam_rows nhưng cho SQLite; các câu lệnh được chuẩn bị một lần và dùng lại qua executemany."""
+    if not rows:
+        return
+
+    spec = EXAM_COLLECTIONS[collection]
+    table = spec['table']
+    columns = spec['columns']
+    record_ids, parent_values, child_values, member_values = prepare_exam_row_values(
+        collection, rows, encode_exam_sqlite_json
+    )
+    column_list = ', '.join(('id',) + columns + ('sort_key', 'fingerprint', 'data'))
+    update_list = ', '.join(
+        f"{column} = excluded.{column}"
+        for column in columns + ('sort_key', 'fingerprint', 'data')
+    )
+    placeholders = ', '.join(['?'] * (len(columns) + 4))
+    conn.executemany(
+        f"INSERT INTO {table} ({column_list}, updated_at) VALUES ({placeholders}, CURRENT_TIMESTAMP) "
+        f"ON CONFLICT (id) DO UPDATE SET {update_list}, updated_at = CURRENT_TIMESTAMP",
+        parent_values
+    )
+
+    id_params = [(record_id,) for record_id in record_ids]
+    child_table = spec.get('child_table')
+    if child_table:
+        child_key = spec['child_key']
+        conn.executemany(f"DELETE FROM {child_table} WHERE {child_key} = ?", id_params)
+        conn.executemany(
+            f"INSERT INTO {child_table} ({child_key}, field, position, data) VALUES (?, ?, ?, ?)",
+            child_values
+        )
+    if spec.get('members_field'):
+        conn.executemany("DELETE FROM exam_class_members WHERE class_id = ?", id_params)
+        conn.executemany(
+            "INSERT INTO exam_class_members (class_id, student_id, position) VALUES (?, ?, ?)",
+            member_values
+        )
+
+
+def touch_exam_sqlite_collection(conn, collection):
+    conn.execute(
+        """
+        INSERT INTO exam_store_collections (collection, revision, updated_at)
+        VALUES (?, 1, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        ON CONFLICT (collection)
+        DO UPDATE SET revision = revision + 1, updated_at = excluded.updated_at
+        """,
+        (collection,)
+    )
+
+
+def get_exam_sqlite_collection_version(conn, collection):
+    return conn.execute(
+        "SELECT revision, updated_at FROM exam_store_collections WHERE collection = ?",
+        (collection,)
+    ).fetchone()
+
+
+def sync_exam_sqlite_rows(conn, collection, data):
+    table = EXAM_COLLECTIONS[collection]['table']
+    existing = {
+        row[0]: (row[1], row[2])
+        for row in conn.execute(f"SELECT id, fingerprint, sort_key FROM {table}")
+    }
+    changed_rows, removed_ids = plan_exam_collection_sync(collection, data, existing)
+    write_exam_sqlite_rows(conn, collection, changed_rows)
+    conn.executemany(f"DELETE FROM {table} WHERE id = ?", [(record_id,) for record_id in removed_ids])
+    touch_exam_sqlite_collection(conn, collection)
+
+
+def fetch_exam_sqlite_rows(conn, collection, record_ids=None):
+    """Đọc cả collection, hoặc chỉ các bản ghi trong record_ids."""
+    spec = EXAM_COLLECTIONS[collection]
+    table = spec['table']
+    role_column = 'role' if collection == 'users' else 'NULL'
+    if record_ids is None:
+        id_filter, params = '', ()
+    else:
+        params = tuple(str(record_id) for record_id in record_ids)
+        id_filter = f"WHERE {{column}} IN ({', '.join(['?'] * len(params))}) "
+    rows = [
+        (record_id, role, json.loads(data))
+        for record_id, role, data in conn.execute(
+            f"SELECT id, {role_column}, data FROM {table} {id_filter.format(column='id')}"
+            f"ORDER BY sort_key, id",
+            params
+        )
+    ]
+
+    child_rows = {}
+    child_table = spec.get('child_table')
+    if child_table:
+        child_key = spec['child_key']
+        for record_id, field, item in conn.execute(
+            f"SELECT {child_key}, field, data FROM {child_table} {id_filter.format(column=child_key)}"
+            f"ORDER BY {child_key}, field, position",
+            params
+        ):
+            child_rows.setdefault(record_id, {}).setdefault(field, []).append(json.loads(item))
+
+    member_rows = {}
+    if spec.get('members_field'):
+        for class_id, student_id in conn.execute(
+            f"SELECT class_id, student_id FROM exam_class_members {id_filter.format(column='class_id')}"
+            f"ORDER BY class_id, position",
+            params
+        ):
+            member_rows.setdefault(class_id, []).append(student_id)
+    return assemble_exam_collection(collection, rows, child_rows, member_rows)
+
+
+@contextmanager
+def exam_cache_scope():
+    """Bật cache collection/index/thống kê trên flask.g cho việc chạy nền ngoài request (một scope mỗi việc)."""
+    with app.app_context():
+        g.exam_cache_scope = True
+        yield
+
+
+def exam_cache_active():
+    return has_request_context() or (has_app_context() and g.get('exam_cache_scope', False))
+
+
+def get_exam_request_cache():
+    """Cache theo request trên flask.g: mỗi collection chỉ đọc tối đa một lần mỗi request."""
+    if not exam_cache_active():
+        return None
+    if 'exam_collection_cache' not in g:
+        g.exam_collection_cache = {}
+    return g.exam_collection_cache
+
+
+def copy_exam_collection(data):
+    # Chỉ sao chép lớp danh sách để route thêm/xóa phần tử không làm hỏng bản trong cache.
+    if isinstance(data, dict):
+        return {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in data.items()
+        }
+    if isinstance(data, list):
+        return list(data)
+    return data
+
+
+def get_exam_file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def get_process_cached_exam_collection(collection, version):
+    # Payload được lưu dạng marshal: mỗi lần lấy ra là một bản độc lập, route sửa tại chỗ không ảnh hưởng cache.
+    if version is None:
+        return None
+    with EXAM_PROCESS_CACHE_LOCK:
+        entry = EXAM_PROCESS_CACHE.get(collection)
+    if not entry or entry[0] != version:
+        return None
+    return marshal.loads(entry[1])
+
+
+def store_process_cached_exam_collection(collection, version, data):
+    if version is None:
+        return
+    try:
+        blob = marshal.dumps(data)
+    except ValueError:
+        return
+    with EXAM_PROCESS_CACHE_LOCK:
+        EXAM_PROCESS_CACHE[collection] = (version, blob)
+
+
+def invalidate_process_cached_exam_collection(collection):
+    with EXAM_PROCESS_CACHE_LOCK:
+        EXAM_PROCESS_CACHE.pop(collection, None)
+    if exam_cache_active() and collection in g.get('exam_collection_versions', {}):
+        # Dữ liệu của request đã gồm lần ghi này nên không còn khớp version đã đọc.
+        g.exam_collection_versions = {
+            name: version for name, version in g.exam_collection_versions.items() if name != collection
+        }
+
+
+# Ở chế độ JSON, thêm/sửa/xóa một bản ghi chỉ nối một dòng vào <file>.log (JSON lines) thay vì ghi lại
+# cả file; khi đọc thì lấy snapshot rồi phát lại log. Log quá EXAM_JSON_LOG_COMPACT_BYTES được gộp vào
+# snapshot ở thread nền.
+EXAM_JSON_LOG_COMPACT_BYTES = int(os.environ.get("EXAM_JSON_LOG_COMPACT_BYTES", str(1024 * 1024)))
+_exam_log_compacting = set()
+_exam_log_compacting_lock = Lock()
+
+
+def exam_collection_log_path(path):
+    return f"{path}.log"
+
+
+def get_exam_collection_file_version(path):
+    version = get_exam_file_version(path)
+    log_version = get_exam_file_version(exam_collection_log_path(path))
+    if version is None and log_version is None:
+        return None
+    return (version, log_version)
+
+
+def apply_exam_log_entry(collection, data, entry):
+    # Phát lại phải idempotent: nếu dừng giữa lúc gộp, log cũ sẽ được phát lại lên snapshot đã chứa nó.
+    if entry.get('op') == 'delete':
+        remove_from_exam_collection(collection, data, entry.get('id'))
+        return
+    record = entry.get('record') or {}
+    if not replace_in_exam_collection(collection, data, record, entry.get('role')) and entry.get('op') == 'insert':
+        insert_into_exam_collection(collection, data, record, entry.get('role'), entry.get('at_start', True))
+
+
+def read_exam_collection_file(collection, path, fallback, expected_type=None):
+    data = read_json_file(path, None)
+    data = normalize_collection_payload(data, copy_exam_collection(fallback), expected_type)
+    try:
+        with open(exam_collection_log_path(path), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Dòng ghi dở khi process bị dừng giữa chừng.
+                    continue
+                apply_exam_log_entry(collection, data, entry)
+    except FileNotFoundError:
+        pass
+    return data
+
+
+def append_exam_collection_log(collection, path, data, entry):
+    """Gọi trong json_file_lock(path); data là collection sau khi đã áp dụng entry."""
+    log_path = exam_collection_log_path(path)
+    with open(log_path, 'a', encoding='utf-8') as f:
+        # Xuống dòng trước mỗi bản ghi để dòng ghi dở (nếu có) không dính vào dòng mới.
+        f.write('\n' + json.dumps(entry, ensure_ascii=False))
+        f.flush()
+        os.fsync(f.fileno())
+        log_size = f.tell()
+    store_process_cached_exam_collection(collection, get_exam_collection_file_version(path), data)
+    if EXAM_JSON_LOG_COMPACT_BYTES > 0 and log_size > EXAM_JSON_LOG_COMPACT_BYTES:
+        schedule_exam_log_compaction(collection)
+
+
+def compact_exam_collection_log(collection):
+    spec = EXAM_COLLECTIONS[collection]
+    log_path = exam_collection_log_path(spec['path'])
+    with json_file_lock(spec['path']):
+        if not os.path.exists(log_path):
+            return
+        data = read_exam_collection_file(collection, spec['path'], spec['fallback'], spec['type'])
+        write_json_file(spec['path'], data)
+        remove_temp_file(log_path)
+    invalidate_process_cached_exam_collection(collection)
+
+
+def schedule_exam_log_compaction(collection):
+    with _exam_log_compacting_lock:
+        if collection in _exam_log_compacting:
+            return
+        _exam_log_compacting.add(collection)
+
+    def run():
+        try:
+            compact_exam_collection_log(collection)
+        except Exception as error:
+            print(f"Exam log compaction error for {collection}: {error}")
+        finally:
+            with _exam_log_compacting_lock:
+                _exam_log_compacting.discard(collection)
+
+    Thread(target=run, name=f"exam-log-compact-{collection}", daemon=True).start()
+
+
+def read_exam_collection(collection, path, fallback, expected_type=None):
+    return read_exam_collection_with_version(collection, path, fallback, expected_type)[1]
+
+
+def read_exam_collection_with_version(collection, path, fallback, expected_type=None):
+    """Đọc collection kèm version, dùng lại bản trong process nếu updated_at (DB), revision (SQLite) hoặc
+    mtime/size của file + log (JSON) chưa đổi. Version luôn được đọc trước dữ liệu nên không bao giờ mới hơn nó."""
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction() as conn:
+            version = get_exam_sqlite_collection_version(conn, collection)
+            cached = get_process_cached_exam_collection(collection, version)
+            if cached is not None:
+                return version, cached
+            data = fetch_exam_sqlite_rows(conn, collection)
+        data = normalize_collection_payload(data, fallback, expected_type)
+        store_process_cached_exam_collection(collection, version, data)
+        return version, data
+
     if not exam_db_enabled():
-        return fallback_data
+        version = get_exam_collection_file_version(path)
+        cached = get_process_cached_exam_collection(collection, version)
+        if cached is not None:
+            return version, cached
+        data = read_exam_collection_file(collection, path, fallback, expected_type)
+        store_process_cached_exam_collection(collection, version, data)
+        return version, data
 
     ensure_exam_store_table()
-    with get_exam_db_connection() as conn:
+    with exam_db_connection() as conn:
         with conn.cursor() as cur:
+            # Đọc version trước dữ liệu: nếu có ghi xen giữa thì lần sau chỉ tải lại thừa một lần.
             cur.execute(
-                "SELECT payload FROM exam_system_store WHERE collection = %s",
+                "SELECT updated_at FROM exam_store_collections WHERE collection = %s",
                 (collection,)
             )
             row = cur.fetchone()
-            if row:
-                return normalize_collection_payload(row[0], fallback, expected_type)
+            version = row[0] if row else None
+            cached = get_process_cached_exam_collection(collection, version)
+            if cached is not None:
+                return version, cached
+            data = fetch_exam_collection_rows(cur, collection)
+    data = normalize_collection_payload(data, fallback, expected_type)
+    store_process_cached_exam_collection(collection, version, data)
+    return version, data
 
-            from psycopg2.extras import Json
-            cur.execute(
-                """
-                INSERT INTO exam_system_store (collection, payload, updated_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (collection)
-                DO UPDATE SET payload = EXCLUDED.payload, updated_at = NOW()
-                """,
-                (collection, Json(fallback_data))
-            )
-            return fallback_data
+
+def load_exam_collection(collection, path, fallback, expected_type=None):
+    cache = get_exam_request_cache()
+    if cache is not None and collection in cache:
+        return copy_exam_collection(cache[collection])
+
+    version, data = read_exam_collection_with_version(collection, path, fallback, expected_type)
+    if cache is not None:
+        cache[collection] = data
+        # Version của bản đã đọc: ghi sau đó (kể cả của chính request này) sẽ làm nó khác version trên kho.
+        g.exam_collection_versions = {**g.get('exam_collection_versions', {}), collection: version}
+    return copy_exam_collection(data)
 
 
 def save_exam_collection(collection, path, data):
-    if not exam_db_enabled():
-        write_json_file(path, data)
+    invalidate_process_cached_exam_collection(collection)
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction(write=True) as conn:
+            sync_exam_sqlite_rows(conn, collection, data)
+            if collection in EXAM_CLASS_STATS_COLLECTIONS:
+                clear_class_stats(conn)
+    elif not exam_db_enabled():
+        with json_file_lock(path):
+            write_json_file(path, data)
+            # Snapshot mới đã chứa mọi thay đổi trong log.
+            remove_temp_file(exam_collection_log_path(path))
+            if collection in EXAM_CLASS_STATS_COLLECTIONS:
+                clear_class_stats()
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                sync_exam_collection_rows(cur, collection, data)
+                if collection in EXAM_CLASS_STATS_COLLECTIONS:
+                    clear_class_stats(cur)
+
+    cache = get_exam_request_cache()
+    if cache is not None:
+        cache[collection] = copy_exam_collection(data)
+    drop_exam_collection_index(collection)
+
+
+class ExamStoreConflict(RuntimeError):
+    pass
+
+
+def diff_exam_collection(collection, before, after):
+    """Các cặp (bản cũ, bản mới) bị thêm/sửa/xóa; None nếu collection không đổi gì, kể cả thứ tự."""
+    old_rows = [
+        (role, str(record.get('id')), exam_record_fingerprint(record, role), record)
+        for role, record in iter_exam_records(collection, before)
+    ]
+    new_rows = [
+        (role, str(record.get('id')), exam_record_fingerprint(record, role), record)
+        for role, record in iter_exam_records(collection, after)
+    ]
+    if [row[:3] for row in old_rows] == [row[:3] for row in new_rows]:
+        return None
+
+    old_by_id = {row[1]: row for row in old_rows}
+    new_by_id = {row[1]: row for row in new_rows}
+    changes = []
+    for record_id in dict.fromkeys(list(old_by_id) + list(new_by_id)):
+        old = old_by_id.get(record_id)
+        new = new_by_id.get(record_id)
+        if old and new and old[:3] == new[:3]:
+            continue
+        changes.append((old[3] if old else None, new[3] if new else None))
+    return changes
+
+
+def commit_exam_collection(collection, version, data, stats_deltas):
+    """Ghi cả collection nếu version trên kho vẫn là version đã đọc; trả về False khi có người ghi xen giữa."""
+    path = EXAM_COLLECTIONS[collection]['path']
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction(write=True) as conn:
+            if get_exam_sqlite_collection_version(conn, collection) != version:
+                return False
+            sync_exam_sqlite_rows(conn, collection, data)
+            apply_class_stats_deltas(stats_deltas, conn)
+    elif not exam_db_enabled():
+        with json_file_lock(path):
+            if get_exam_collection_file_version(path) != version:
+                return False
+            write_json_file(path, data)
+            remove_temp_file(exam_collection_log_path(path))
+            apply_class_stats_deltas(stats_deltas)
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Khóa dòng version: các lần ghi khác (kể cả insert/update từng bản ghi) phải chờ tới khi commit.
+                cur.execute(
+                    "SELECT updated_at FROM exam_store_collections WHERE collection = %s FOR UPDATE",
+                    (collection,)
+                )
+                row = cur.fetchone()
+                if (row[0] if row else None) != version:
+                    return False
+                sync_exam_collection_rows(cur, collection, data)
+                apply_class_stats_deltas(stats_deltas, cur)
+    invalidate_process_cached_exam_collection(collection)
+    return True
+
+
+def update_exam_collection(collection, mutate):
+    """Đọc - sửa - ghi cả collection không mất cập nhật của request khác: nếu collection bị ghi xen giữa lúc
+    đọc và lúc ghi thì đọc lại và chạy lại mutate. mutate(data) sửa tại chỗ hoặc trả về dữ liệu mới; nó có thể
+    chạy nhiều lần nên chỉ được sửa data. Trả về dữ liệu đã ghi."""
+    spec = EXAM_COLLECTIONS[collection]
+    track_stats = collection in EXAM_CLASS_STATS_COLLECTIONS
+    if track_stats:
+        prepare_class_stats_lookups(collection, True)
+
+    for attempt in range(1, EXAM_UPDATE_MAX_ATTEMPTS + 1):
+        version, data = read_exam_collection_with_version(
+            collection, spec['path'], spec['fallback'], spec['type']
+        )
+        before = marshal.loads(marshal.dumps(data))
+        result = mutate(data)
+        if result is not None:
+            data = result
+        changes = diff_exam_collection(collection, before, data)
+        if changes is None:
+            return data
+
+        stats_deltas = {}
+        if track_stats:
+            for old_record, new_record in changes:
+                merge_class_stats_deltas(stats_deltas, class_stats_deltas(collection, old_record, new_record))
+        if commit_exam_collection(collection, version, data, stats_deltas):
+            break
+        print(f"Exam store conflict on {collection} (attempt {attempt}/{EXAM_UPDATE_MAX_ATTEMPTS}), retrying")
+    else:
+        raise ExamStoreConflict(
+            f"Không ghi được {collection} sau {EXAM_UPDATE_MAX_ATTEMPTS} lần thử do bị ghi đồng thời."
+        )
+
+    cache = get_exam_request_cache()
+    if cache is not None:
+        cache[collection] = copy_exam_collection(data)
+    drop_exam_collection_index(collection)
+    return data
+
+
+def read_exam_collection_by_name(collection):
+    spec = EXAM_COLLECTIONS[collection]
+    return read_exam_collection(collection, spec['path'], spec['fallback'], spec['type'])
+
+
+def load_exam_collection_by_name(collection):
+    spec = EXAM_COLLECTIONS[collection]
+    if collection == 'users':
+        return load_exam_users()
+    return load_exam_collection(collection, spec['path'], spec['fallback'], spec['type'])
+
+
+def save_exam_collection_by_name(collection, data):
+    save_exam_collection(collection, EXAM_COLLECTIONS[collection]['path'], data)
+
+
+def get_cached_exam_collection(collection):
+    cache = get_exam_request_cache()
+    return cache.get(collection) if cache is not None else None
+
+
+def get_exam_request_indexes():
+    if not exam_cache_active():
+        return None
+    if 'exam_collection_indexes' not in g:
+        g.exam_collection_indexes = {}
+    return g.exam_collection_indexes
+
+
+def drop_exam_collection_index(collection):
+    indexes = get_exam_request_indexes()
+    if indexes is not None:
+        indexes.pop(collection, None)
+
+
+def exam_index_keys(record, field):
+    value = record.get(field)
+    values = value if isinstance(value, list) else [value]
+    return tuple(dict.fromkeys(
+        v for v in values if isinstance(v, (str, int)) and not isinstance(v, bool)
+    ))
+
+
+def add_to_exam_index(index, role, record, at_start=False):
+    # "order" giữ thứ tự của bản ghi trong collection để gộp nhiều nhóm index mà không đổi thứ tự cũ.
+    if at_start:
+        index['first_order'] -= 1
+        order = index['first_order']
+    else:
+        index['last_order'] += 1
+        order = index['last_order']
+    keys = {}
+    for field, lookup in index['fields'].items():
+        keys[field] = exam_index_keys(record, field)
+        for value in keys[field]:
+            bucket = lookup.setdefault((role, value), [])
+            if at_start:
+                bucket.insert(0, record)
+            else:
+                bucket.append(record)
+    index['record_keys'][record.get('id')] = (role, keys, order)
+
+
+def remove_from_exam_index(index, record_id):
+    entry = index['record_keys'].pop(record_id, None)
+    if not entry:
         return
+    role, keys, _ = entry
+    for field, values in keys.items():
+        lookup = index['fields'][field]
+        for value in values:
+            bucket = [r for r in lookup.get((role, value), []) if r.get('id') != record_id]
+            if bucket:
+                lookup[(role, value)] = bucket
+            else:
+                lookup.pop((role, value), None)
 
-    ensure_exam_store_table()
-    with get_exam_db_connection() as conn:
-        with conn.cursor() as cur:
-            from psycopg2.extras import Json
-            cur.execute(
-                """
-                INSERT INTO exam_system_store (collection, payload, updated_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (collection)
-                DO UPDATE SET payload = EXCLUDED.payload, updated_at = NOW()
-                """,
-                (collection, Json(data))
-            )
+
+def replace_in_exam_index(index, role, record):
+    """Cập nhật tại chỗ nếu các khóa index không đổi; trả về False để báo cần dựng lại index."""
+    record_id = record.get('id')
+    entry = index['record_keys'].get(record_id)
+    if not entry or entry[0] != role:
+        return False
+    keys = {field: exam_index_keys(record, field) for field in index['fields']}
+    if keys != entry[1]:
+        return False
+    for field, values in keys.items():
+        lookup = index['fields'][field]
+        for value in values:
+            bucket = lookup.get((role, value), [])
+            for position, item in enumerate(bucket):
+                if item.get('id') == record_id:
+                    bucket[position] = record
+    return True
+
+
+def build_exam_collection_index(collection, data):
+    index = {
+        'fields': {field: {} for field in EXAM_COLLECTIONS[collection]['indexes']},
+        'record_keys': {},
+        'first_order': 0,
+        'last_order': -1,
+    }
+    for role, record in iter_exam_records(collection, data):
+        add_to_exam_index(index, role, record)
+    return index
+
+
+def get_exam_collection_index(collection):
+    """Index theo các trường trong EXAM_COLLECTIONS[...]['indexes'], dựng một lần mỗi request."""
+    indexes = get_exam_request_indexes()
+    if indexes is not None and collection in indexes:
+        return indexes[collection]
+
+    data = load_exam_collection_by_name(collection)
+    if indexes is not None:
+        data = get_cached_exam_collection(collection)
+    index = build_exam_collection_index(collection, data)
+    if indexes is not None:
+        indexes[collection] = index
+    return index
+
+
+def find_exam_records(collection, field, value, role=None):
+    if isinstance(value, (list, dict, set)):
+        return []
+    lookup = get_exam_collection_index(collection)['fields'][field]
+    return list(lookup.get((role, value), []))
+
+
+def find_exam_records_in(collection, field, values, role=None):
+    """Gộp kết quả của nhiều giá trị, giữ đúng thứ tự trong collection và không lặp bản ghi."""
+    record_keys = get_exam_collection_index(collection)['record_keys']
+    found = {}
+    for value in values:
+        for record in find_exam_records(collection, field, value, role):
+            found[record.get('id')] = record
+    return sorted(found.values(), key=lambda r: record_keys.get(r.get('id'), (None, None, 0))[2])
+
+
+def find_exam_record(collection, record_id, role=None):
+    records = find_exam_records(collection, 'id', record_id, role)
+    return records[0] if records else None
+
+
+def find_exam_record_role(users, record_id):
+    for role, records in users.items():
+        if any(r.get('id') == record_id for r in records or []):
+            return role
+    return None
+
+
+def insert_into_exam_collection(collection, data, record, role=None, at_start=True):
+    records = data.setdefault(role, []) if collection == 'users' else data
+    if at_start:
+        records.insert(0, record)
+    else:
+        records.append(record)
+
+
+def replace_in_exam_collection(collection, data, record, role=None):
+    record_id = record.get('id')
+    if collection == 'users':
+        role = role or find_exam_record_role(data, record_id)
+        records = data.get(role, []) if role else []
+    else:
+        records = data
+    for index, item in enumerate(records):
+        if item.get('id') == record_id:
+            records[index] = record
+            return True
+    return False
+
+
+def remove_from_exam_collection(collection, data, record_id):
+    if collection == 'users':
+        for role, records in data.items():
+            data[role] = [r for r in records if r.get('id') != record_id]
+    else:
+        data[:] = [r for r in data if r.get('id') != record_id]
+
+
+def find_exam_record_in(collection, data, record_id):
+    return next((r for _, r in iter_exam_records(collection, data) if r.get('id') == record_id), None)
+
+
+def insert_exam_record(collection, record, role=None, at_start=True):
+    """Thêm một bản ghi; ở chế độ DB chỉ ghi đúng một dòng (kèm dòng con)."""
+    record.setdefault('id', str(uuid.uuid4()))
+    if collection == 'users':
+        role = role or 'students'
+    spec = EXAM_COLLECTIONS[collection]
+    track_stats = collection in EXAM_CLASS_STATS_COLLECTIONS
+    if track_stats:
+        prepare_class_stats_lookups(collection, False)
+        stats_deltas = class_stats_deltas(collection, None, record)
+
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction(write=True) as conn:
+            aggregate = 'MIN(sort_key) - ?' if at_start else 'MAX(sort_key) + ?'
+            sort_key = conn.execute(
+                f"SELECT COALESCE({aggregate}, 0) FROM {spec['table']}",
+                (EXAM_SORT_KEY_STEP,)
+            ).fetchone()[0]
+            write_exam_sqlite_rows(conn, collection, [(role, record, sort_key)])
+            touch_exam_sqlite_collection(conn, collection)
+            if track_stats:
+                apply_class_stats_deltas(stats_deltas, conn)
+        invalidate_process_cached_exam_collection(collection)
+    elif not exam_db_enabled():
+        with json_file_lock(spec['path']):
+            data = read_exam_collection_by_name(collection)
+            insert_into_exam_collection(collection, data, record, role, at_start)
+            append_exam_collection_log(collection, spec['path'], data, {
+                'op': 'insert', 'record': record, 'role': role, 'at_start': at_start
+            })
+            if track_stats:
+                apply_class_stats_deltas(stats_deltas)
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                aggregate = 'MIN(sort_key) - %s' if at_start else 'MAX(sort_key) + %s'
+                cur.execute(
+                    f"SELECT COALESCE({aggregate}, 0) FROM {spec['table']}",
+                    (EXAM_SORT_KEY_STEP,)
+                )
+                sort_key = cur.fetchone()[0]
+                write_exam_rows(cur, collection, [(role, record, sort_key)])
+                touch_exam_collection(cur, collection)
+                if track_stats:
+                    apply_class_stats_deltas(stats_deltas, cur)
+        invalidate_process_cached_exam_collection(collection)
+
+    cached = get_cached_exam_collection(collection)
+    if cached is not None:
+        insert_into_exam_collection(collection, cached, record, role, at_start)
+    index = (get_exam_request_indexes() or {}).get(collection)
+    if index is not None:
+        add_to_exam_index(index, role, record, at_start)
+    return record
+
+
+def update_exam_record(collection, record, role=None):
+    """Ghi đè một bản ghi đã có theo id, giữ nguyên vị trí của nó trong collection."""
+    record_id = record.get('id')
+    spec = EXAM_COLLECTIONS[collection]
+    track_stats = collection in EXAM_CLASS_STATS_COLLECTIONS
+    if track_stats:
+        prepare_class_stats_lookups(collection, True)
+
+    if exam_sqlite_enabled():
+        role_column = 'role' if collection == 'users' else 'NULL'
+        with exam_sqlite_transaction(write=True) as conn:
+            row = conn.execute(
+                f"SELECT sort_key, {role_column} FROM {spec['table']} WHERE id = ?",
+                (str(record_id),)
+            ).fetchone()
+            if not row:
+                return False
+            role = role or row[1]
+            if track_stats:
+                old_record = find_exam_record_in(
+                    collection, fetch_exam_sqlite_rows(conn, collection, [record_id]), record_id
+                )
+            write_exam_sqlite_rows(conn, collection, [(role, record, row[0])])
+            touch_exam_sqlite_collection(conn, collection)
+            if track_stats:
+                apply_class_stats_deltas(class_stats_deltas(collection, old_record, record), conn)
+        invalidate_process_cached_exam_collection(collection)
+    elif not exam_db_enabled():
+        # Đọc bản trên đĩa chứ không dùng cache request: route thường đã sửa trực tiếp bản ghi trong cache.
+        with json_file_lock(spec['path']):
+            data = read_exam_collection_by_name(collection)
+            if collection == 'users':
+                role = role or find_exam_record_role(data, record_id)
+            old_record = find_exam_record_in(collection, data, record_id)
+            if not replace_in_exam_collection(collection, data, record, role):
+                return False
+            append_exam_collection_log(collection, spec['path'], data, {
+                'op': 'update', 'record': record, 'role': role
+            })
+            if track_stats:
+                apply_class_stats_deltas(class_stats_deltas(collection, old_record, record))
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                if collection == 'users':
+                    cur.execute(
+                        f"SELECT sort_key, role FROM {spec['table']} WHERE id = %s FOR UPDATE",
+                        (str(record_id),)
+                    )
+                else:
+                    cur.execute(
+                        f"SELECT sort_key, NULL FROM {spec['table']} WHERE id = %s FOR UPDATE",
+                        (str(record_id),)
+                    )
+                row = cur.fetchone()
+                if not row:
+                    return False
+                role = role or row[1]
+                if track_stats:
+                    old_record = find_exam_record_in(
+                        collection, fetch_exam_collection_rows(cur, collection, [record_id]), record_id
+                    )
+                write_exam_rows(cur, collection, [(role, record, row[0])])
+                touch_exam_collection(cur, collection)
+                if track_stats:
+                    apply_class_stats_deltas(class_stats_deltas(collection, old_record, record), cur)
+        invalidate_process_cached_exam_collection(collection)
+
+    cached = get_cached_exam_collection(collection)
+    if cached is not None:
+        replace_in_exam_collection(collection, cached, record, role)
+    index = (get_exam_request_indexes() or {}).get(collection)
+    if index is not None and not replace_in_exam_index(index, role, record):
+        drop_exam_collection_index(collection)
+    return True
+
+
+def delete_exam_record(collection, record_id):
+    track_stats = collection in EXAM_CLASS_STATS_COLLECTIONS
+    if track_stats:
+        prepare_class_stats_lookups(collection, True)
+
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction(write=True) as conn:
+            if track_stats:
+                old_record = find_exam_record_in(
+                    collection, fetch_exam_sqlite_rows(conn, collection, [record_id]), record_id
+                )
+            conn.execute(f"DELETE FROM {EXAM_COLLECTIONS[collection]['table']} WHERE id = ?", (str(record_id),))
+            touch_exam_sqlite_collection(conn, collection)
+            if track_stats:
+                apply_class_stats_deltas(class_stats_deltas(collection, old_record, None), conn)
+        invalidate_process_cached_exam_collection(collection)
+    elif not exam_db_enabled():
+        with json_file_lock(EXAM_COLLECTIONS[collection]['path']):
+            data = read_exam_collection_by_name(collection)
+            old_record = find_exam_record_in(collection, data, record_id)
+            remove_from_exam_collection(collection, data, record_id)
+            append_exam_collection_log(collection, EXAM_COLLECTIONS[collection]['path'], data, {
+                'op': 'delete', 'id': record_id
+            })
+            if track_stats:
+                apply_class_stats_deltas(class_stats_deltas(collection, old_record, None))
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                if track_stats:
+                    old_record = find_exam_record_in(
+                        collection, fetch_exam_collection_rows(cur, collection, [record_id]), record_id
+                    )
+                delete_exam_rows(cur, collection, [str(record_id)])
+                touch_exam_collection(cur, collection)
+                if track_stats:
+                    apply_class_stats_deltas(class_stats_deltas(collection, old_record, None), cur)
+        invalidate_process_cached_exam_collection(collection)
+
+    cached = get_cached_exam_collection(collection)
+    if cached is not None:
+        remove_from_exam_collection(collection, cached, record_id)
+    index = (get_exam_request_indexes() or {}).get(collection)
+    if index is not None:
+        remove_from_exam_index(index, record_id)
 
 
 def load_exam_users():
@@ -444,28 +2856,217 @@ def save_exam_exams(data):
     save_exam_collection('exams', EXAM_EXAMS_FILE, data)
 
 
-def load_exam_submissions():
-    return load_exam_collection('submissions', EXAM_SUBMISSIONS_FILE, [], list)
+def load_exam_submissions():
+    return load_exam_collection('submissions', EXAM_SUBMISSIONS_FILE, [], list)
+
+
+def save_exam_submissions(data):
+    save_exam_collection('submissions', EXAM_SUBMISSIONS_FILE, data)
+
+
+def load_exam_materials():
+    return load_exam_collection('materials', EXAM_MATERIALS_FILE, [], list)
+
+
+def save_exam_materials(data):
+    save_exam_collection('materials', EXAM_MATERIALS_FILE, data)
+
+
+def load_exam_classes():
+    return load_exam_collection('classes', EXAM_CLASSES_FILE, [], list)
+
+
+def save_exam_classes(data):
+    save_exam_collection('classes', EXAM_CLASSES_FILE, data)
+
+
+def get_exam_user(role, user_id):
+    return find_exam_record('users', user_id, role)
+
+
+def get_exam_user_by_username(role, username):
+    users = find_exam_records('users', 'username', username, role)
+    return users[0] if users else None
+
+
+def get_exam_class(class_id):
+    return find_exam_record('classes', class_id)
+
+
+def get_exam_class_by_code(class_code):
+    classes = find_exam_records('classes', 'class_code', class_code)
+    return classes[0] if classes else None
+
+
+def get_exam(exam_id):
+    return find_exam_record('exams', exam_id)
+
+
+def get_exam_lesson(lesson_id):
+    return find_exam_record('lessons', lesson_id)
+
+
+def get_exam_material(material_id):
+    return find_exam_record('materials', material_id)
+
+
+def get_exam_submission(submission_id):
+    return find_exam_record('submissions', submission_id)
+
+
+def classes_for_teacher(teacher_id):
+    return find_exam_records('classes', 'teacher_id', teacher_id)
+
+
+def classes_for_student(student_id):
+    return find_exam_records('classes', 'student_ids', student_id)
+
+
+def lessons_for_class(class_id):
+    return find_exam_records('lessons', 'class_id', class_id)
+
+
+def exams_for_class(class_id):
+    return find_exam_records('exams', 'class_id', class_id)
+
+
+def materials_for_class(class_id):
+    return find_exam_records('materials', 'class_id', class_id)
+
+
+def materials_for_teacher(teacher_id):
+    return find_exam_records('materials', 'teacher_id', teacher_id)
+
+
+def submissions_for_exam(exam_id):
+    return find_exam_records('submissions', 'exam_id', exam_id)
+
+
+def submissions_for_exams(exam_ids):
+    return find_exam_records_in('submissions', 'exam_id', exam_ids)
+
+
+def submissions_for_student(student_id):
+    return find_exam_records('submissions', 'student_id', student_id)
+
+
+def exam_submission_sort_key(submission, sort):
+    submitted_at = parse_exam_datetime(submission.get('submitted_at'))
+    if sort.startswith('score'):
+        return (float(submission.get('score', 0) or 0), submitted_at, str(submission.get('id')))
+    return (submitted_at, str(submission.get('id')))
+
+
+def filter_exam_submissions(exam_id, class_id, student_id, min_score, max_score):
+    """Bài nộp khớp bộ lọc, chưa sắp xếp."""
+    filters = [(field, value) for field, value in (
+        ('exam_id', exam_id), ('class_id', class_id), ('student_id', student_id)
+    ) if value]
+    if filters:
+        # Bắt đầu từ nhóm index nhỏ nhất, các điều kiện còn lại chỉ lọc trên nhóm đó.
+        buckets = [find_exam_records('submissions', field, value) for field, value in filters]
+        candidates = min(buckets, key=len)
+        candidates = [
+            s for s in candidates
+            if all(s.get(field) == value for field, value in filters)
+        ]
+    else:
+        candidates = [record for _, record in iter_exam_records('submissions', load_exam_submissions())]
+
+    if min_score is not None or max_score is not None:
+        candidates = [
+            s for s in candidates
+            if is_submission_graded(s)
+            and (min_score is None or float(s.get('score', 0) or 0) >= min_score)
+            and (max_score is None or float(s.get('score', 0) or 0) < max_score)
+        ]
+    return candidates
+
 
+def encode_exam_submission_cursor(key):
+    return '~'.join(part.isoformat() if isinstance(part, datetime) else str(part) for part in key)
 
-def save_exam_submissions(data):
-    save_exam_collection('submissions', EXAM_SUBMISSIONS_FILE, data)
 
+def decode_exam_submission_cursor(cursor, sort):
+    """Khóa sắp xếp từ cursor của encode_exam_submission_cursor, None nếu cursor không hợp lệ."""
+    try:
+        if sort.startswith('score'):
+            score, submitted_at, submission_id = cursor.split('~', 2)
+            return (float(score), datetime.fromisoformat(submitted_at), submission_id)
+        submitted_at, submission_id = cursor.split('~', 1)
+        return (datetime.fromisoformat(submitted_at), submission_id)
+    except (AttributeError, ValueError):
+        return None
 
-def load_exam_materials():
-    return load_exam_collection('materials', EXAM_MATERIALS_FILE, [], list)
 
+# Thứ tự đã sắp xếp (khóa tăng dần, id) theo bộ lọc, dùng lại giữa các request khi submissions chưa đổi version.
+_exam_submission_orders = OrderedDict()
+_exam_submission_orders_lock = Lock()
 
-def save_exam_materials(data):
-    save_exam_collection('materials', EXAM_MATERIALS_FILE, data)
 
+def get_exam_submission_order(filters, sort, load_candidates):
+    versions = g.get('exam_collection_versions', {}) if exam_cache_active() else {}
+    version = versions.get('submissions')
+    cache_key = (filters, sort.split('_')[0])
+    if version is not None:
+        with _exam_submission_orders_lock:
+            entry = _exam_submission_orders.get(cache_key)
+            if entry and entry[0] == version:
+                _exam_submission_orders.move_to_end(cache_key)
+                return entry[1], entry[2]
 
-def load_exam_classes():
-    return load_exam_collection('classes', EXAM_CLASSES_FILE, [], list)
+    keyed = sorted(
+        ((exam_submission_sort_key(s, sort), s.get('id')) for s in load_candidates()),
+        key=lambda item: item[0]
+    )
+    keys = [key for key, _ in keyed]
+    ids = [submission_id for _, submission_id in keyed]
+    if version is not None:
+        with _exam_submission_orders_lock:
+            _exam_submission_orders[cache_key] = (version, keys, ids)
+            _exam_submission_orders.move_to_end(cache_key)
+            while len(_exam_submission_orders) > EXAM_SUBMISSION_ORDER_CACHE_SIZE:
+                _exam_submission_orders.popitem(last=False)
+    return keys, ids
+
+
+def query_exam_submissions(exam_id=None, class_id=None, student_id=None, min_score=None, max_score=None,
+                           sort='time_desc', limit=None, after=None, before=None):
+    """Một trang bài nộp khớp bộ lọc, trả về (trang, cursor trang sau, cursor trang trước, vị trí đầu trang, tổng số).
+
+    Lọc theo đề/lớp/học sinh qua index của collection; khoảng điểm [min_score, max_score) chỉ tính bài đã chấm
+    xong. after/before là cursor (khóa sắp xếp) của bài cuối/đầu trang kề bên, nên vẫn đúng vị trí khi bài đó
+    đã bị xóa; trang được tìm bằng bisect trên thứ tự đã sắp."""
+    if sort not in EXAM_SUBMISSION_SORTS:
+        sort = 'time_desc'
+    limit = max(1, min(limit or EXAM_SUBMISSIONS_PAGE_SIZE, EXAM_SUBMISSIONS_MAX_PAGE_SIZE))
+    # Nạp collection trước để version của lần đọc này có trong g.
+    get_exam_collection_index('submissions')
+    keys, ids = get_exam_submission_order(
+        (exam_id, class_id, student_id, min_score, max_score), sort,
+        lambda: filter_exam_submissions(exam_id, class_id, student_id, min_score, max_score)
+    )
 
+    total = len(keys)
+    descending = sort.endswith('_desc')
+    after_key = decode_exam_submission_cursor(after, sort) if after else None
+    before_key = decode_exam_submission_cursor(before, sort) if before else None
+    # Vị trí hiển thị p ứng với keys[total - 1 - p] khi sắp giảm dần.
+    if after_key is not None:
+        start = total - bisect_left(keys, after_key) if descending else bisect_right(keys, after_key)
+    elif before_key is not None:
+        end = total - bisect_right(keys, before_key) if descending else bisect_left(keys, before_key)
+        start = max(0, end - limit)
+    else:
+        start = 0
+    end = min(start + limit, total)
 
-def save_exam_classes(data):
-    save_exam_collection('classes', EXAM_CLASSES_FILE, data)
+    positions = [total - 1 - p if descending else p for p in range(start, end)]
+    page = [find_exam_record('submissions', ids[position]) for position in positions]
+    page = [s for s in page if s]
+    next_after = encode_exam_submission_cursor(keys[positions[-1]]) if positions and end < total else None
+    prev_before = encode_exam_submission_cursor(keys[positions[0]]) if positions and start > 0 else None
+    return page, next_after, prev_before, start, total
 
 
 def generate_class_code(classes):
@@ -508,14 +3109,10 @@ def require_parent():
 
 
 def get_teacher_class(class_id):
-    teacher_id = session.get('exam_user_id')
-    return next(
-        (
-            c for c in load_exam_classes()
-            if c.get('id') == class_id and c.get('teacher_id') == teacher_id
-        ),
-        None
-    )
+    class_obj = get_exam_class(class_id)
+    if class_obj and class_obj.get('teacher_id') == session.get('exam_user_id'):
+        return class_obj
+    return None
 
 
 def student_in_class(class_obj, student_id):
@@ -523,28 +3120,20 @@ def student_in_class(class_obj, student_id):
 
 
 def get_student_classes(student_id):
-    return [
-        c for c in load_exam_classes()
-        if student_in_class(c, student_id)
-    ]
+    return classes_for_student(student_id)
 
 
 def get_student_by_id(student_id):
-    users = load_exam_users()
-    return next((s for s in users.get('students', []) if s.get('id') == student_id), None)
+    return get_exam_user('students', student_id)
 
 
 def get_parent_context(parent_id=None):
-    users = load_exam_users()
     parent_id = parent_id or session.get('exam_user_id')
-    parent = next((p for p in users.get('parents', []) if p.get('id') == parent_id), None)
+    parent = get_exam_user('parents', parent_id)
     if not parent or parent.get('active', True) is False:
         return None
 
-    class_obj = next(
-        (c for c in load_exam_classes() if c.get('id') == parent.get('class_id')),
-        None
-    )
+    class_obj = get_exam_class(parent.get('class_id'))
     student = get_student_by_id(parent.get('student_id'))
     if not class_obj or not student or not student_in_class(class_obj, student.get('id')):
         return None
@@ -556,28 +3145,347 @@ def get_parent_context(parent_id=None):
     }
 
 
-def build_class_stats(class_obj):
+def compute_class_stats_row(class_obj):
+    """Tính lại thống kê của một lớp từ các collection (dùng khi chưa có bản cộng dồn hoặc khi rebuild)."""
     class_id = class_obj.get('id')
-    lessons = [l for l in load_exam_lessons() if l.get('class_id') == class_id]
-    exams = [e for e in load_exam_exams() if e.get('class_id') == class_id]
-    materials = [m for m in load_exam_materials() if m.get('class_id') == class_id]
+    lessons = lessons_for_class(class_id)
+    exams = exams_for_class(class_id)
+    materials = materials_for_class(class_id)
     submissions = [
-        s for s in load_exam_submissions()
-        if any(e.get('id') == s.get('exam_id') for e in exams)
+        s for s in submissions_for_exams([e.get('id') for e in exams]) if is_submission_graded(s)
     ]
-    avg_score = None
-    if submissions:
-        avg_score = round(sum(float(s.get('score', 0)) for s in submissions) / len(submissions), 2)
+    activity_times = [class_obj.get('created_at'), class_obj.get('updated_at')]
+    for record in lessons + exams + materials:
+        activity_times.extend([record.get('created_at'), record.get('updated_at')])
+    activity_times.extend(s.get('submitted_at') for s in submissions)
+    activity_times = [value for value in activity_times if value]
     return {
+        'class_id': class_id,
         'student_count': len(class_obj.get('student_ids', [])),
         'lesson_count': len(lessons),
         'exam_count': len(exams),
         'material_count': len(materials),
         'submission_count': len(submissions),
-        'avg_score': avg_score
+        'score_sum': sum(float(s.get('score', 0) or 0) for s in submissions),
+        'last_activity': max(activity_times, key=parse_exam_datetime) if activity_times else None,
+    }
+
+
+def load_class_stats_rows():
+    cached = g.get('exam_class_stats') if exam_cache_active() else None
+    if cached is not None:
+        return cached
+
+    columns = ('class_id',) + EXAM_CLASS_STATS_FIELDS + ('last_activity',)
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction() as conn:
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM exam_class_stats")
+            rows = {row[0]: dict(zip(columns, row)) for row in cursor}
+    elif not exam_db_enabled():
+        rows = read_json_file(EXAM_CLASS_STATS_FILE, {})
+        rows = rows if isinstance(rows, dict) else {}
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {', '.join(columns)} FROM exam_class_stats")
+                rows = {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+    if exam_cache_active():
+        g.exam_class_stats = rows
+    return rows
+
+
+def forget_class_stats_rows():
+    if exam_cache_active():
+        g.pop('exam_class_stats', None)
+
+
+def store_class_stats_rows(rows, replace_all=False):
+    """Ghi các dòng thống kê đã tính đủ; replace_all=True xóa hết bản cũ (dùng cho rebuild)."""
+    if exam_sqlite_enabled():
+        forget_class_stats_rows()
+        with exam_sqlite_transaction(write=True) as conn:
+            if replace_all:
+                conn.execute("DELETE FROM exam_class_stats")
+            insert_exam_sqlite_class_stats_rows(conn, rows)
+        return
+
+    if not exam_db_enabled():
+        forget_class_stats_rows()
+        with json_file_lock(EXAM_CLASS_STATS_FILE):
+            existing = {} if replace_all else load_class_stats_rows()
+            for row in rows:
+                existing.setdefault(row['class_id'], row)
+            write_json_file(EXAM_CLASS_STATS_FILE, existing)
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            if replace_all:
+                cur.execute("DELETE FROM exam_class_stats")
+            insert_class_stats_rows(cur, rows)
+
+
+def insert_class_stats_rows(cur, rows):
+    from psycopg2.extras import execute_values
+    columns = ('class_id',) + EXAM_CLASS_STATS_FIELDS + ('last_activity',)
+    # Dòng đã có nghĩa là đã được cộng dồn từ các lần ghi sau đó, không ghi đè.
+    execute_values(
+        cur,
+        f"INSERT INTO exam_class_stats ({', '.join(columns)}) VALUES %s "
+        "ON CONFLICT (class_id) DO NOTHING",
+        [tuple(row.get(column) for column in columns) for row in rows]
+    )
+
+
+def insert_exam_sqlite_class_stats_rows(conn, rows):
+    columns = ('class_id',) + EXAM_CLASS_STATS_FIELDS + ('last_activity',)
+    conn.executemany(
+        f"INSERT INTO exam_class_stats ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) "
+        "ON CONFLICT (class_id) DO NOTHING",
+        [tuple(row.get(column) for column in columns) for row in rows]
+    )
+
+
+def materialize_class_stats_row(row):
+    """Lưu dòng vừa tính từ các collection của request, chỉ khi chưa collection nào bị ghi kể từ lúc request đọc.
+
+    Kiểm tra trong cùng khóa/transaction mà các lần ghi dùng để cộng dồn: lần ghi chen giữa lúc tính và lúc lưu
+    sẽ bị bỏ qua vì dòng chưa có, nên khi version đã đổi thì không lưu và để lần đọc sau tính lại."""
+    versions = g.get('exam_collection_versions', {}) if exam_cache_active() else {}
+    if any(collection not in versions for collection in EXAM_CLASS_STATS_COLLECTIONS):
+        return False
+
+    if exam_sqlite_enabled():
+        with exam_sqlite_transaction(write=True) as conn:
+            for collection in EXAM_CLASS_STATS_COLLECTIONS:
+                if get_exam_sqlite_collection_version(conn, collection) != versions[collection]:
+                    return False
+            insert_exam_sqlite_class_stats_rows(conn, [row])
+        forget_class_stats_rows()
+        return True
+
+    if not exam_db_enabled():
+        with ExitStack() as stack:
+            # Cùng thứ tự khóa với lần ghi: file collection trước, file thống kê sau.
+            for collection in EXAM_CLASS_STATS_COLLECTIONS:
+                stack.enter_context(json_file_lock(EXAM_COLLECTIONS[collection]['path']))
+            for collection in EXAM_CLASS_STATS_COLLECTIONS:
+                path = EXAM_COLLECTIONS[collection]['path']
+                if get_exam_collection_file_version(path) != versions[collection]:
+                    return False
+            store_class_stats_rows([row])
+        return True
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            # FOR SHARE chặn touch_exam_collection của các lần ghi tới khi dòng thống kê được lưu.
+            cur.execute(
+                "SELECT collection, updated_at FROM exam_store_collections "
+                "WHERE collection = ANY(%s) FOR SHARE",
+                (list(EXAM_CLASS_STATS_COLLECTIONS),)
+            )
+            current = dict(cur.fetchall())
+            if any(current.get(collection) != versions[collection] for collection in EXAM_CLASS_STATS_COLLECTIONS):
+                return False
+            insert_class_stats_rows(cur, [row])
+    forget_class_stats_rows()
+    return True
+
+
+def clear_class_stats(cur=None):
+    """Bỏ toàn bộ thống kê cộng dồn; lần đọc sau sẽ tính lại từng lớp."""
+    forget_class_stats_rows()
+    if cur is not None:
+        cur.execute("DELETE FROM exam_class_stats")
+    else:
+        write_json_file(EXAM_CLASS_STATS_FILE, {})
+
+
+def class_stats_deltas(collection, old_record, new_record):
+    """Chênh lệch thống kê theo lớp khi một bản ghi đổi từ old_record sang new_record."""
+    deltas = {}
+
+    def add(class_id, field, amount):
+        if class_id and amount:
+            changes = deltas.setdefault(class_id, {})
+            changes[field] = changes.get(field, 0) + amount
+
+    def touch(class_id, *times):
+        # Cùng nguồn thời gian với compute_class_stats_row; xóa bản ghi không tính là hoạt động mới.
+        times = [value for value in times if value]
+        if class_id and times:
+            merge_class_stats_deltas(deltas, {class_id: {'last_activity': max(times, key=parse_exam_datetime)}})
+
+    for record, sign in ((old_record, -1), (new_record, 1)):
+        if not record:
+            continue
+        if collection == 'classes':
+            add(record.get('id'), 'student_count', sign * len(record.get('student_ids', [])))
+            if sign > 0:
+                touch(record.get('id'), record.get('created_at'), record.get('updated_at'))
+        elif collection in EXAM_CLASS_STATS_COUNTERS:
+            add(record.get('class_id'), EXAM_CLASS_STATS_COUNTERS[collection], sign)
+            if sign > 0:
+                touch(record.get('class_id'), record.get('created_at'), record.get('updated_at'))
+        elif collection == 'submissions':
+            # Bài đang chờ AI chấm chưa được tính, sẽ cộng vào khi chấm xong.
+            exam = get_exam(record.get('exam_id'))
+            if exam and is_submission_graded(record):
+                add(exam.get('class_id'), 'submission_count', sign)
+                add(exam.get('class_id'), 'score_sum', sign * float(record.get('score', 0) or 0))
+                if sign > 0:
+                    touch(exam.get('class_id'), record.get('submitted_at'))
+
+    # Bài nộp được tính theo lớp của đề: đổi lớp hoặc xóa đề thì chuyển/bỏ luôn phần bài nộp.
+    if collection == 'exams' and old_record:
+        old_class_id = old_record.get('class_id')
+        new_class_id = (new_record or {}).get('class_id')
+        if old_class_id != new_class_id:
+            submissions = [
+                s for s in submissions_for_exam(old_record.get('id')) if is_submission_graded(s)
+            ]
+            score_sum = sum(float(s.get('score', 0) or 0) for s in submissions)
+            add(old_class_id, 'submission_count', -len(submissions))
+            add(old_class_id, 'score_sum', -score_sum)
+            add(new_class_id, 'submission_count', len(submissions))
+            add(new_class_id, 'score_sum', score_sum)
+    return deltas
+
+
+def prepare_class_stats_lookups(collection, has_old_record):
+    # Dựng trước index cần cho class_stats_deltas để không phải mở thêm kết nối DB giữa transaction.
+    if collection == 'submissions':
+        get_exam_collection_index('exams')
+    elif collection == 'exams' and has_old_record:
+        get_exam_collection_index('submissions')
+
+
+def merge_class_stats_deltas(target, deltas):
+    for class_id, changes in deltas.items():
+        merged = target.setdefault(class_id, {})
+        for field, value in changes.items():
+            if field == 'last_activity':
+                if parse_exam_datetime(value) > parse_exam_datetime(merged.get(field)):
+                    merged[field] = value
+            else:
+                merged[field] = merged.get(field, 0) + value
+    return target
+
+
+def newer_class_activity(current, candidate):
+    """candidate nếu nó mới hơn last_activity đang lưu, ngược lại None."""
+    if candidate and parse_exam_datetime(candidate) > parse_exam_datetime(current):
+        return candidate
+    return None
+
+
+def apply_class_stats_deltas(deltas, cur=None):
+    """Cộng dồn vào các dòng thống kê đã có; lớp chưa có dòng sẽ được tính đủ khi đọc lần đầu.
+
+    cur là cursor PostgreSQL hoặc kết nối SQLite của transaction đang ghi bản ghi, để thống kê cùng commit/rollback
+    với nó; None là chế độ JSON (file thống kê, trong khóa của file collection)."""
+    if not deltas:
+        return
+    forget_class_stats_rows()
+    if exam_sqlite_enabled():
+        apply_exam_sqlite_class_stats_deltas(cur, deltas)
+        return
+    if cur is None:
+        with json_file_lock(EXAM_CLASS_STATS_FILE):
+            rows = load_class_stats_rows()
+            changed = False
+            for class_id, changes in deltas.items():
+                if class_id not in rows:
+                    continue
+                row = dict(rows[class_id])
+                for field, amount in changes.items():
+                    if field != 'last_activity':
+                        row[field] = row.get(field, 0) + amount
+                activity = newer_class_activity(row.get('last_activity'), changes.get('last_activity'))
+                if activity:
+                    row['last_activity'] = activity
+                rows[class_id] = row
+                changed = True
+            if changed:
+                write_json_file(EXAM_CLASS_STATS_FILE, rows)
+        return
+
+    for class_id, changes in deltas.items():
+        counters = {field: amount for field, amount in changes.items() if field != 'last_activity'}
+        activity = changes.get('last_activity')
+        if activity:
+            cur.execute(
+                "SELECT last_activity FROM exam_class_stats WHERE class_id = %s FOR UPDATE",
+                (str(class_id),)
+            )
+            row = cur.fetchone()
+            if row is None:
+                continue
+            activity = newer_class_activity(row[0], activity)
+        assignments = [f"{field} = {field} + %s" for field in counters]
+        values = list(counters.values())
+        if activity:
+            assignments.append("last_activity = %s")
+            values.append(activity)
+        if not assignments:
+            continue
+        cur.execute(
+            f"UPDATE exam_class_stats SET {', '.join(assignments)}, updated_at = NOW() WHERE class_id = %s",
+            (*values, str(class_id))
+        )
+
+
+def apply_exam_sqlite_class_stats_deltas(conn, deltas):
+    # Transaction ghi của SQLite đã giữ khóa ghi (BEGIN IMMEDIATE) nên đọc rồi cập nhật không bị chen ngang.
+    for class_id, changes in deltas.items():
+        counters = {field: amount for field, amount in changes.items() if field != 'last_activity'}
+        row = conn.execute(
+            "SELECT last_activity FROM exam_class_stats WHERE class_id = ?", (str(class_id),)
+        ).fetchone()
+        if row is None:
+            continue
+        assignments = [f"{field} = {field} + ?" for field in counters]
+        values = list(counters.values())
+        activity = newer_class_activity(row[0], changes.get('last_activity'))
+        if activity:
+            assignments.append("last_activity = ?")
+            values.append(activity)
+        if not assignments:
+            continue
+        conn.execute(
+            f"UPDATE exam_class_stats SET {', '.join(assignments)}, updated_at = CURRENT_TIMESTAMP "
+            "WHERE class_id = ?",
+            (*values, str(class_id))
+        )
+
+
+def class_stats_from_row(row):
+    submission_count = row.get('submission_count', 0)
+    avg_score = None
+    if submission_count:
+        avg_score = round(row.get('score_sum', 0) / submission_count, 2)
+    return {
+        'student_count': row.get('student_count', 0),
+        'lesson_count': row.get('lesson_count', 0),
+        'exam_count': row.get('exam_count', 0),
+        'material_count': row.get('material_count', 0),
+        'submission_count': submission_count,
+        'avg_score': avg_score,
+        'last_activity': row.get('last_activity'),
     }
 
 
+def build_class_stats(class_obj):
+    row = load_class_stats_rows().get(class_obj.get('id'))
+    if row is None:
+        row = compute_class_stats_row(class_obj)
+        materialize_class_stats_row(row)
+    return class_stats_from_row(row)
+
+
 def parse_exam_datetime(value):
     try:
         return datetime.strptime(value or '', "%d/%m/%Y %H:%M")
@@ -608,20 +3516,14 @@ def classify_error_topic(text):
 
 def build_teacher_class_analysis(class_obj, students=None, exams=None, submissions=None):
     class_id = class_obj.get('id')
-    users = load_exam_users()
-    students = students if students is not None else [
-        s for s in users.get('students', [])
-        if s.get('id') in class_obj.get('student_ids', [])
-    ]
-    exams = exams if exams is not None else [
-        e for e in load_exam_exams()
-        if e.get('class_id') == class_id
-    ]
-    exam_lookup = {exam.get('id'): exam for exam in exams}
-    submissions = submissions if submissions is not None else [
-        sub for sub in load_exam_submissions()
-        if sub.get('exam_id') in exam_lookup
-    ]
+    students = students if students is not None else find_exam_records_in(
+        'users', 'id', class_obj.get('student_ids', []), 'students'
+    )
+    exams = exams if exams is not None else exams_for_class(class_id)
+    submissions = submissions if submissions is not None else submissions_for_exams(
+        [exam.get('id') for exam in exams]
+    )
+    submissions = [sub for sub in submissions if is_submission_graded(sub)]
 
     submissions_by_student = {}
     for sub in submissions:
@@ -850,20 +3752,19 @@ def classify_learning_axis(text):
 
 
 def build_student_learning_profile(student_id, class_id=None):
-    users = load_exam_users()
-    student = next((s for s in users.get('students', []) if s.get('id') == student_id), None)
+    student = get_student_by_id(student_id)
     classes = get_student_classes(student_id)
     if class_id:
         classes = [c for c in classes if c.get('id') == class_id]
 
-    class_ids = {c.get('id') for c in classes}
-    lessons = [l for l in load_exam_lessons() if l.get('class_id') in class_ids]
-    materials = [m for m in load_exam_materials() if m.get('class_id') in class_ids]
-    exams = [e for e in load_exam_exams() if e.get('class_id') in class_ids]
+    class_ids = [c.get('id') for c in classes]
+    lessons = find_exam_records_in('lessons', 'class_id', class_ids)
+    materials = find_exam_records_in('materials', 'class_id', class_ids)
+    exams = find_exam_records_in('exams', 'class_id', class_ids)
     exam_lookup = {e.get('id'): e for e in exams}
     submissions = [
-        s for s in load_exam_submissions()
-        if s.get('student_id') == student_id and s.get('exam_id') in exam_lookup
+        s for s in submissions_for_student(student_id)
+        if s.get('exam_id') in exam_lookup and is_submission_graded(s)
     ]
     submissions.sort(key=lambda sub: parse_exam_datetime(sub.get('submitted_at')))
 
@@ -1025,82 +3926,438 @@ def build_admin_report_data():
             'student': student_lookup.get(parent.get('student_id'), {})
         })
 
-    student_options = []
-    for class_obj in classes:
-        for student_id in class_obj.get('student_ids', []):
-            student = student_lookup.get(student_id)
-            if student:
-                student_options.append({
-                    'class_id': class_obj.get('id'),
-                    'class_name': class_obj.get('name'),
-                    'student_id': student.get('id'),
-                    'student_name': student.get('full_name'),
-                    'student_username': student.get('username')
-                })
+    student_options = []
+    for class_obj in classes:
+        for student_id in class_obj.get('student_ids', []):
+            student = student_lookup.get(student_id)
+            if student:
+                student_options.append({
+                    'class_id': class_obj.get('id'),
+                    'class_name': class_obj.get('name'),
+                    'student_id': student.get('id'),
+                    'student_name': student.get('full_name'),
+                    'student_username': student.get('username')
+                })
+
+    subject_counts = {}
+    for row in class_rows:
+        subject = row['class'].get('subject') or 'Chưa phân môn'
+        subject_counts[subject] = subject_counts.get(subject, 0) + 1
+
+    summary = {
+        'teacher_count': len(teachers),
+        'active_teacher_count': len([t for t in teachers if t.get('active', True) is not False]),
+        'student_count': len(students),
+        'parent_count': len(parents),
+        'active_parent_count': len([p for p in parents if p.get('active', True) is not False]),
+        'class_count': len(classes),
+        'lesson_count': sum(row['stats']['lesson_count'] for row in class_rows),
+        'exam_count': sum(row['stats']['exam_count'] for row in class_rows),
+        'submission_count': sum(row['stats']['submission_count'] for row in class_rows),
+        'storage_backend': exam_storage_backend_label()
+    }
+
+    return {
+        'summary': summary,
+        'teacher_rows': teacher_rows,
+        'parent_rows': parent_rows,
+        'student_options': student_options,
+        'class_rows': class_rows,
+        'class_chart_labels': [row['class'].get('name', 'Lớp học') for row in class_rows],
+        'class_student_counts': [row['stats']['student_count'] for row in class_rows],
+        'subject_chart_labels': list(subject_counts.keys()),
+        'subject_chart_counts': list(subject_counts.values())
+    }
+
+
+def is_google_drive_url(url):
+    url = (url or '').strip()
+    return (
+        url.startswith(('https://drive.google.com/', 'http://drive.google.com/'))
+        or url.startswith(('https://docs.google.com/', 'http://docs.google.com/'))
+    )
+
+
+def get_google_embed_url(url):
+    url = (url or '').strip()
+
+    folder_match = re.search(r'drive\.google\.com/drive/folders/([^/?#]+)', url)
+    if folder_match:
+        return f"https://drive.google.com/embeddedfolderview?id={folder_match.group(1)}#list"
+
+    file_match = re.search(r'drive\.google\.com/file/d/([^/?#]+)', url)
+    if file_match:
+        return f"https://drive.google.com/file/d/{file_match.group(1)}/preview"
+
+    id_match = re.search(r'[?&]id=([^&#]+)', url)
+    if 'drive.google.com' in url and id_match:
+        return f"https://drive.google.com/file/d/{id_match.group(1)}/preview"
+
+    docs_match = re.search(
+        r'docs\.google\.com/(document|spreadsheets|presentation|forms)/d/([^/?#]+)',
+        url
+    )
+    if docs_match:
+        doc_type, doc_id = docs_match.groups()
+        return f"https://docs.google.com/{doc_type}/d/{doc_id}/preview"
+
+    return url
+
+
+# ---------------- ESSAY GRADING QUEUE ----------------
+# Bài tự luận được lưu ngay với trạng thái "đang chấm"; worker nền lấy việc từ hàng đợi bền
+# (bảng exam_grading_jobs hoặc file JSON) và chấm từng câu, lỗi AI thì thử lại với backoff.
+_essay_grading_workers_lock = Lock()
+_essay_grading_workers_pid = None
+_essay_grading_wakeup = Event()
+
+
+def reset_essay_grading_after_fork():
+    global _essay_grading_workers_lock, _essay_grading_wakeup
+    _essay_grading_workers_lock = Lock()
+    _essay_grading_wakeup = Event()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_essay_grading_after_fork)
+
+
+def is_submission_graded(submission):
+    # Bài cũ không có trường grading được coi là đã chấm xong.
+    return (submission.get('grading') or {}).get('status', 'done') == 'done'
+
+
+def read_essay_grading_jobs():
+    jobs = read_json_file(EXAM_GRADING_JOBS_FILE, {})
+    return jobs if isinstance(jobs, dict) else {}
+
+
+def enqueue_essay_grading_jobs(submission_ids):
+    submission_ids = [str(submission_id) for submission_id in submission_ids]
+    if not submission_ids:
+        return
+
+    if not exam_db_enabled():
+        with json_file_lock(EXAM_GRADING_JOBS_FILE):
+            jobs = read_essay_grading_jobs()
+            for submission_id in submission_ids:
+                jobs.setdefault(submission_id, {
+                    'status': 'pending',
+                    'attempts': 0,
+                    'next_attempt_at': time.time(),
+                    'locked_until': None,
+                    'last_error': None,
+                    'graded': 0
+                })
+            write_json_file(EXAM_GRADING_JOBS_FILE, jobs)
+    else:
+        from psycopg2.extras import execute_values
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO exam_grading_jobs (submission_id) VALUES %s "
+                    "ON CONFLICT (submission_id) DO NOTHING",
+                    [(submission_id,) for submission_id in submission_ids]
+                )
+    _essay_grading_wakeup.set()
+
+
+def claim_essay_grading_job():
+    """Nhận một việc đến hạn, kể cả việc 'running' đã hết hạn giữ chỗ (worker trước bị dừng giữa chừng)."""
+    if not exam_db_enabled():
+        now = time.time()
+        with json_file_lock(EXAM_GRADING_JOBS_FILE):
+            jobs = read_essay_grading_jobs()
+            due = [
+                (job.get('next_attempt_at') or 0, submission_id)
+                for submission_id, job in jobs.items()
+                if (job.get('status') == 'pending' and (job.get('next_attempt_at') or 0) <= now)
+                or (job.get('status') == 'running' and (job.get('locked_until') or 0) <= now)
+            ]
+            if not due:
+                return None
+            submission_id = min(due)[1]
+            job = jobs[submission_id]
+            job['status'] = 'running'
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['locked_until'] = now + ESSAY_GRADING_LEASE_SECONDS
+            write_json_file(EXAM_GRADING_JOBS_FILE, jobs)
+            return submission_id, job['attempts']
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE exam_grading_jobs
+                SET status = 'running', attempts = attempts + 1,
+                    locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+                WHERE submission_id = (
+                    SELECT submission_id FROM exam_grading_jobs
+                    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                       OR (status = 'running' AND locked_until <= NOW())
+                    ORDER BY next_attempt_at
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING submission_id, attempts
+                """,
+                (ESSAY_GRADING_LEASE_SECONDS,)
+            )
+            row = cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def renew_essay_grading_job(submission_id, attempts, graded):
+    """Gia hạn giữ chỗ và ghi tiến độ; trả về False nếu việc đã bị worker khác nhận lại (attempts đã đổi)."""
+    if not exam_db_enabled():
+        with json_file_lock(EXAM_GRADING_JOBS_FILE):
+            jobs = read_essay_grading_jobs()
+            job = jobs.get(str(submission_id))
+            if not job or job.get('status') != 'running' or job.get('attempts') != attempts:
+                return False
+            job['locked_until'] = time.time() + ESSAY_GRADING_LEASE_SECONDS
+            job['graded'] = graded
+            write_json_file(EXAM_GRADING_JOBS_FILE, jobs)
+        return True
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE exam_grading_jobs
+                SET locked_until = NOW() + make_interval(secs => %s), graded = %s, updated_at = NOW()
+                WHERE submission_id = %s AND status = 'running' AND attempts = %s
+                RETURNING 1
+                """,
+                (ESSAY_GRADING_LEASE_SECONDS, graded, str(submission_id), attempts)
+            )
+            return cur.fetchone() is not None
+
+
+def get_essay_grading_progress(submission_id):
+    """Số câu đã chấm của việc đang chạy (chưa ghi vào bài nộp), None nếu không có việc."""
+    if not exam_db_enabled():
+        job = read_essay_grading_jobs().get(str(submission_id))
+        return job.get('graded', 0) if job else None
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT graded FROM exam_grading_jobs WHERE submission_id = %s", (str(submission_id),))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+
+def finish_essay_grading_job(submission_id):
+    if not exam_db_enabled():
+        with json_file_lock(EXAM_GRADING_JOBS_FILE):
+            jobs = read_essay_grading_jobs()
+            if jobs.pop(str(submission_id), None) is not None:
+                write_json_file(EXAM_GRADING_JOBS_FILE, jobs)
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM exam_grading_jobs WHERE submission_id = %s", (str(submission_id),))
+
+
+def retry_essay_grading_job(submission_id, attempts, error):
+    # Backoff lũy thừa: 10s, 20s, 40s... với cấu hình mặc định.
+    delay = min(ESSAY_GRADING_RETRY_SECONDS * (2 ** max(attempts - 1, 0)), 3600)
+    if not exam_db_enabled():
+        with json_file_lock(EXAM_GRADING_JOBS_FILE):
+            jobs = read_essay_grading_jobs()
+            job = jobs.get(str(submission_id))
+            if job is None:
+                return
+            job['status'] = 'pending'
+            job['next_attempt_at'] = time.time() + delay
+            job['locked_until'] = None
+            job['last_error'] = str(error)
+            write_json_file(EXAM_GRADING_JOBS_FILE, jobs)
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE exam_grading_jobs
+                SET status = 'pending', next_attempt_at = NOW() + make_interval(secs => %s),
+                    locked_until = NULL, last_error = %s, updated_at = NOW()
+                WHERE submission_id = %s
+                """,
+                (delay, str(error), str(submission_id))
+            )
+
+
+def requeue_pending_essay_submissions():
+    # Bài đang chờ chấm mà mất việc trong hàng đợi (process dừng ngay sau khi lưu bài) được xếp lại.
+    if not exam_db_enabled():
+        pending = [
+            s.get('id') for s in read_exam_collection_by_name('submissions')
+            if not is_submission_graded(s)
+        ]
+    else:
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id FROM exam_submissions "
+                    "WHERE COALESCE(data->'grading'->>'status', 'done') <> 'done'"
+                )
+                pending = [row[0] for row in cur.fetchall()]
+    enqueue_essay_grading_jobs(pending)
+
 
-    subject_counts = {}
-    for row in class_rows:
-        subject = row['class'].get('subject') or 'Chưa phân môn'
-        subject_counts[subject] = subject_counts.get(subject, 0) + 1
+def grade_essay_answer(question, student_answer):
+    prompt = f"""Đây là câu hỏi tự luận:
 
-    summary = {
-        'teacher_count': len(teachers),
-        'active_teacher_count': len([t for t in teachers if t.get('active', True) is not False]),
-        'student_count': len(students),
-        'parent_count': len(parents),
-        'active_parent_count': len([p for p in parents if p.get('active', True) is not False]),
-        'class_count': len(classes),
-        'lesson_count': sum(row['stats']['lesson_count'] for row in class_rows),
-        'exam_count': sum(row['stats']['exam_count'] for row in class_rows),
-        'submission_count': sum(row['stats']['submission_count'] for row in class_rows),
-        'storage_backend': 'PostgreSQL/Supabase' if exam_db_enabled() else 'JSON local'
-    }
+Câu hỏi: {question['question']}
+Điểm tối đa: {question['points']}
+Đáp án gợi ý: {question.get('suggested_answer', 'Không có')}
 
-    return {
-        'summary': summary,
-        'teacher_rows': teacher_rows,
-        'parent_rows': parent_rows,
-        'student_options': student_options,
-        'class_rows': class_rows,
-        'class_chart_labels': [row['class'].get('name', 'Lớp học') for row in class_rows],
-        'class_student_counts': [row['stats']['student_count'] for row in class_rows],
-        'subject_chart_labels': list(subject_counts.keys()),
-        'subject_chart_counts': list(subject_counts.values())
-    }
+Câu trả lời của học sinh:
+{student_answer}
+
+Hãy chấm điểm (0-{question['points']}) và nhận xét ngắn gọn.
+Format: ĐIỂM: X/{question['points']}
+NHẬN XÉT: ..."""
 
+    response = model.generate_content([prompt], priority='grading')
+    feedback = clean_ai_output(response.text)
 
-def is_google_drive_url(url):
-    url = (url or '').strip()
-    return (
-        url.startswith(('https://drive.google.com/', 'http://drive.google.com/'))
-        or url.startswith(('https://docs.google.com/', 'http://docs.google.com/'))
+    # Trích xuất điểm
+    match = re.search(r'ĐIỂM:\s*(\d+\.?\d*)', feedback)
+    return (float(match.group(1)) if match else 0), feedback
+
+
+def run_essay_grading_job(submission_id, attempts):
+    """Chấm tiếp các câu chưa có kết quả; gia hạn giữ chỗ sau mỗi câu, bài nộp chỉ được ghi một lần khi dừng."""
+    last_attempt = attempts >= ESSAY_GRADING_MAX_ATTEMPTS
+    submission = get_exam_submission(submission_id)
+    exam = get_exam(submission.get('exam_id')) if submission else None
+    if not submission or not exam:
+        if last_attempt:
+            finish_essay_grading_job(submission_id)
+        else:
+            retry_essay_grading_job(submission_id, attempts, 'Không tìm thấy bài nộp hoặc đề.')
+        return
+    if is_submission_graded(submission):
+        finish_essay_grading_job(submission_id)
+        return
+
+    questions = exam.get('essay_questions', [])
+    essay_answers = submission.get('essay_answers', {})
+    results = {str(r.get('question_id')): r for r in submission.get('detailed_results', [])}
+    grading = dict(submission.get('grading') or {}, status='running', attempts=attempts)
+    submission['grading'] = grading
+
+    pending_questions = [q for q in questions if str(q['id']) not in results]
+    graded_before = len(results)
+    failed_error = None
+    outcomes = iter_ai_calls(
+        lambda q: grade_essay_answer(q, essay_answers.get(str(q['id']), '')),
+        pending_questions
     )
+    for position, graded, error in outcomes:
+        q = pending_questions[position]
+        if error is not None and not last_attempt:
+            # Câu lỗi được chấm lại ở lần thử sau, các câu khác vẫn được lưu.
+            failed_error = failed_error or error
+        else:
+            # Hết số lần thử: giữ cách xử lý cũ, câu lỗi được 0 điểm.
+            q_score, feedback = graded if error is None else (0, "Không chấm được.")
+            results[str(q['id'])] = {
+                'question_id': q['id'],
+                'question': q['question'],
+                'student_answer': essay_answers.get(str(q['id']), ''),
+                'points': q['points'],
+                'score': q_score,
+                'feedback': feedback
+            }
+        if not renew_essay_grading_job(submission_id, attempts, len(results)):
+            # Việc đã hết hạn giữ chỗ và được worker khác nhận lại: bỏ kết quả, không ghi đè bài nộp.
+            return
+
+    if failed_error is not None:
+        if len(results) > graded_before:
+            submission['detailed_results'] = [
+                results[str(q['id'])] for q in questions if str(q['id']) in results
+            ]
+            grading['graded'] = len(submission['detailed_results'])
+            update_exam_record('submissions', submission)
+        retry_essay_grading_job(submission_id, attempts, failed_error)
+        return
 
+    detailed_results = [results[str(q['id'])] for q in questions if str(q['id']) in results]
+    total_points = sum(r['score'] for r in detailed_results)
+    max_points = sum(q['points'] for q in questions)
+    submission['detailed_results'] = detailed_results
+    submission['score'] = round((total_points / max_points) * 10, 2) if max_points else 0
+    submission['ai_feedback'] = f"Tổng điểm: {total_points}/{max_points}"
+    submission['grading'] = {
+        'status': 'done',
+        'graded': len(detailed_results),
+        'total': len(questions),
+        'attempts': attempts
+    }
+    update_exam_record('submissions', submission)
+    finish_essay_grading_job(submission_id)
 
-def get_google_embed_url(url):
-    url = (url or '').strip()
 
-    folder_match = re.search(r'drive\.google\.com/drive/folders/([^/?#]+)', url)
-    if folder_match:
-        return f"https://drive.google.com/embeddedfolderview?id={folder_match.group(1)}#list"
+def essay_grading_worker():
+    while True:
+        try:
+            job = claim_essay_grading_job()
+        except Exception as error:
+            print(f"Essay grading queue error: {error}")
+            time.sleep(ESSAY_GRADING_POLL_SECONDS)
+            continue
+        if not job:
+            _essay_grading_wakeup.wait(ESSAY_GRADING_POLL_SECONDS)
+            _essay_grading_wakeup.clear()
+            continue
 
-    file_match = re.search(r'drive\.google\.com/file/d/([^/?#]+)', url)
-    if file_match:
-        return f"https://drive.google.com/file/d/{file_match.group(1)}/preview"
+        submission_id, attempts = job
+        try:
+            # Cache riêng cho mỗi việc để collection và index chỉ đọc một lần.
+            with exam_cache_scope():
+                run_essay_grading_job(submission_id, attempts)
+        except Exception as error:
+            print(f"Essay grading error for {submission_id}: {error}")
+            try:
+                retry_essay_grading_job(submission_id, attempts, error)
+            except Exception:
+                # Việc vẫn ở trạng thái running và sẽ được nhận lại khi hết hạn giữ chỗ.
+                pass
 
-    id_match = re.search(r'[?&]id=([^&#]+)', url)
-    if 'drive.google.com' in url and id_match:
-        return f"https://drive.google.com/file/d/{id_match.group(1)}/preview"
 
-    docs_match = re.search(
-        r'docs\.google\.com/(document|spreadsheets|presentation|forms)/d/([^/?#]+)',
-        url
-    )
-    if docs_match:
-        doc_type, doc_id = docs_match.groups()
-        return f"https://docs.google.com/{doc_type}/d/{doc_id}/preview"
+def start_essay_grading_workers():
+    global _essay_grading_workers_pid
+    if ESSAY_GRADING_WORKERS <= 0 or _essay_grading_workers_pid == os.getpid():
+        return
+    with _essay_grading_workers_lock:
+        if _essay_grading_workers_pid == os.getpid():
+            return
+        _essay_grading_workers_pid = os.getpid()
+        try:
+            requeue_pending_essay_submissions()
+        except Exception as error:
+            print(f"Essay grading queue error: {error}")
+        for index in range(ESSAY_GRADING_WORKERS):
+            Thread(target=essay_grading_worker, name=f"essay-grading-{index}", daemon=True).start()
 
-    return url
+
+@app.before_request
+def ensure_essay_grading_workers():
+    # Worker chạy theo từng process (gunicorn fork sau khi import) nên khởi động ở request đầu tiên.
+    start_essay_grading_workers()
 
 
 # ---------------- AUTHENTICATION ----------------
@@ -1117,8 +4374,7 @@ def exam_student_register():
             flash('Vui lòng nhập đầy đủ thông tin!', 'error')
             return redirect(url_for('exam_student_register'))
 
-        users = load_exam_users()
-        if any(s['username'] == username for s in users['students']):
+        if get_exam_user_by_username('students', username):
             flash('Tên đăng nhập đã tồn tại!', 'error')
             return redirect(url_for('exam_student_register'))
 
@@ -1131,8 +4387,7 @@ def exam_student_register():
             'email': email,
             'created_at': datetime.now().strftime("%d/%m/%Y %H:%M")
         }
-        users['students'].append(new_student)
-        save_exam_users(users)
+        insert_exam_record('users', new_student, role='students', at_start=False)
 
         flash('Đăng ký thành công! Hãy đăng nhập.', 'success')
         return redirect(url_for('exam_student_login'))
@@ -1146,9 +4401,7 @@ def exam_student_login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
 
-        users = load_exam_users()
-        student = next(
-            (s for s in users['students'] if s['username'] == username), None)
+        student = get_exam_user_by_username('students', username)
 
         if student and check_password_hash(student['password'], password):
             session['exam_user_type'] = 'student'
@@ -1168,9 +4421,7 @@ def exam_teacher_login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
 
-        users = load_exam_users()
-        teacher = next(
-            (t for t in users['teachers'] if t['username'] == username), None)
+        teacher = get_exam_user_by_username('teachers', username)
 
         if teacher:
             if teacher.get('active', True) is False:
@@ -1211,11 +4462,7 @@ def exam_parent_login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
 
-        users = load_exam_users()
-        parent = next(
-            (p for p in users.get('parents', []) if p.get('username') == username),
-            None
-        )
+        parent = get_exam_user_by_username('parents', username)
 
         if parent:
             if parent.get('active', True) is False:
@@ -1284,8 +4531,6 @@ def admin_dashboard():
     if blocked:
         return blocked
 
-    users = load_exam_users()
-    users.setdefault('teachers', [])
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '').strip()
@@ -1297,11 +4542,11 @@ def admin_dashboard():
             flash('Vui lòng nhập đủ tên đăng nhập, mật khẩu, họ tên và môn dạy.', 'error')
             return redirect(url_for('admin_dashboard'))
 
-        if any(t.get('username') == username for t in users['teachers']):
+        if get_exam_user_by_username('teachers', username):
             flash('Tên đăng nhập giáo viên đã tồn tại.', 'error')
             return redirect(url_for('admin_dashboard'))
 
-        users['teachers'].append({
+        insert_exam_record('users', {
             'id': str(uuid.uuid4()),
             'username': username,
             'password': generate_password_hash(password),
@@ -1310,8 +4555,7 @@ def admin_dashboard():
             'email': email,
             'active': True,
             'created_at': datetime.now().strftime("%d/%m/%Y %H:%M")
-        })
-        save_exam_users(users)
+        }, role='teachers', at_start=False)
         flash('Đã tạo tài khoản giáo viên.', 'success')
         return redirect(url_for('admin_dashboard'))
 
@@ -1320,78 +4564,173 @@ def admin_dashboard():
     return render_template('admin/dashboard.html', **report_data)
 
 
-@app.route('/admin/export_report')
-def admin_export_report():
-    blocked = require_admin()
-    if blocked:
-        return blocked
+ADMIN_EXPORT_FORMATS = {
+    'xls': ('application/vnd.ms-excel; charset=utf-8', 'xls'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
-    report_data = build_admin_report_data()
-    generated_at = datetime.now().strftime("%d/%m/%Y %H:%M")
-    summary = report_data['summary']
-    teacher_rows = report_data['teacher_rows']
-    parent_rows = report_data['parent_rows']
-    class_rows = report_data['class_rows']
 
-    def cell(value):
-        return html_lib.escape(str(value if value is not None else ''))
+def parse_admin_report_filters(args):
+    def parse_date(value):
+        try:
+            return datetime.strptime((value or '').strip(), '%Y-%m-%d').date()
+        except ValueError:
+            return None
 
-    teacher_html = ''.join(
-        f"""
-        <tr>
-            <td>{cell(row['teacher'].get('full_name'))}</td>
-            <td>{cell(row['teacher'].get('username'))}</td>
-            <td>{cell(row['teacher'].get('subject'))}</td>
-            <td>{cell(row['teacher'].get('email'))}</td>
-            <td>{cell(row['class_count'])}</td>
-            <td>{cell(row['student_count'])}</td>
-            <td>{cell(row['lesson_count'])}</td>
-            <td>{cell(row['exam_count'])}</td>
-            <td>{cell(row['submission_count'])}</td>
-            <td>{'Đã khóa' if row['teacher'].get('active', True) is False else 'Đang hoạt động'}</td>
-        </tr>
-        """
-        for row in teacher_rows
+    return {
+        'teacher_id': (args.get('teacher_id') or '').strip() or None,
+        'class_id': (args.get('class_id') or '').strip() or None,
+        'date_from': parse_date(args.get('date_from')),
+        'date_to': parse_date(args.get('date_to')),
+    }
+
+
+def admin_report_class_matches(class_obj, filters):
+    if filters['teacher_id'] and class_obj.get('teacher_id') != filters['teacher_id']:
+        return False
+    if filters['date_from'] or filters['date_to']:
+        created_at = parse_exam_datetime(class_obj.get('created_at'))
+        if created_at == datetime.min:
+            return False
+        if filters['date_from'] and created_at.date() < filters['date_from']:
+            return False
+        if filters['date_to'] and created_at.date() > filters['date_to']:
+            return False
+    return True
+
+
+def iter_admin_report_sections(filters):
+    """Sinh lần lượt (tiêu đề, cột, các dòng) của báo cáo admin; các dòng được tạo khi ghi ra."""
+    filtered = any(filters.values())
+    if filters['class_id']:
+        classes = [c for c in [get_exam_class(filters['class_id'])] if c]
+    elif filters['teacher_id']:
+        classes = classes_for_teacher(filters['teacher_id'])
+    else:
+        classes = load_exam_classes()
+    classes = [c for c in classes if admin_report_class_matches(c, filters)]
+    class_ids = {c.get('id') for c in classes}
+
+    # Bộ lọc áp lên danh sách lớp; giáo viên và phụ huynh đi theo các lớp được chọn.
+    if filtered:
+        teacher_ids = {c.get('teacher_id') for c in classes}
+        if filters['teacher_id']:
+            teacher_ids.add(filters['teacher_id'])
+        teachers = find_exam_records_in('users', 'id', teacher_ids, 'teachers')
+        parents = find_exam_records_in('users', 'class_id', class_ids, 'parents')
+        student_count = len({sid for c in classes for sid in c.get('student_ids', [])})
+    else:
+        users = load_exam_users()
+        teachers = users.get('teachers', [])
+        parents = users.get('parents', [])
+        student_count = len(users.get('students', []))
+
+    totals = {'lesson_count': 0, 'exam_count': 0, 'submission_count': 0}
+    for class_obj in classes:
+        stats = build_class_stats(class_obj)
+        for field in totals:
+            totals[field] += stats[field]
+
+    yield (
+        'Tổng quan',
+        ['Giáo viên', 'Giáo viên hoạt động', 'Học sinh', 'Phụ huynh', 'Lớp',
+         'Bài giảng', 'Đề kiểm tra', 'Bài nộp'],
+        iter([[
+            len(teachers),
+            len([t for t in teachers if t.get('active', True) is not False]),
+            student_count,
+            len(parents),
+            len(classes),
+            totals['lesson_count'],
+            totals['exam_count'],
+            totals['submission_count'],
+        ]])
     )
 
-    class_html = ''.join(
-        f"""
-        <tr>
-            <td>{cell(row['class'].get('name'))}</td>
-            <td>{cell(row['class'].get('class_code'))}</td>
-            <td>{cell(row['class'].get('join_password_plain') or 'Cần đặt lại')}</td>
-            <td>{cell(row['class'].get('grade'))}</td>
-            <td>{cell(row['class'].get('subject'))}</td>
-            <td>{cell(row['teacher'].get('full_name', ''))}</td>
-            <td>{cell(row['stats']['student_count'])}</td>
-            <td>{cell(row['stats']['lesson_count'])}</td>
-            <td>{cell(row['stats']['exam_count'])}</td>
-            <td>{cell(row['stats']['material_count'])}</td>
-            <td>{cell(row['stats']['submission_count'])}</td>
-            <td>{cell(row['stats']['avg_score'] if row['stats']['avg_score'] is not None else 'Chưa có')}</td>
-        </tr>
-        """
-        for row in class_rows
+    def teacher_rows():
+        for teacher in teachers:
+            teacher_stats = [
+                build_class_stats(c) for c in classes_for_teacher(teacher.get('id'))
+                if c.get('id') in class_ids
+            ]
+            yield [
+                teacher.get('full_name'),
+                teacher.get('username'),
+                teacher.get('subject'),
+                teacher.get('email'),
+                len(teacher_stats),
+                sum(stats['student_count'] for stats in teacher_stats),
+                sum(stats['lesson_count'] for stats in teacher_stats),
+                sum(stats['exam_count'] for stats in teacher_stats),
+                sum(stats['submission_count'] for stats in teacher_stats),
+                'Đã khóa' if teacher.get('active', True) is False else 'Đang hoạt động',
+            ]
+
+    yield (
+        'Danh sách giáo viên',
+        ['Giáo viên', 'Tài khoản', 'Môn', 'Email', 'Số lớp', 'Học sinh', 'Bài giảng',
+         'Đề kiểm tra', 'Bài nộp', 'Trạng thái'],
+        teacher_rows()
     )
 
-    parent_html = ''.join(
-        f"""
-        <tr>
-            <td>{cell(row['parent'].get('full_name'))}</td>
-            <td>{cell(row['parent'].get('username'))}</td>
-            <td>{cell(row['parent'].get('phone'))}</td>
-            <td>{cell(row['parent'].get('email'))}</td>
-            <td>{cell(row['student'].get('full_name', ''))}</td>
-            <td>{cell(row['student'].get('username', ''))}</td>
-            <td>{cell(row['class'].get('name', ''))}</td>
-            <td>{cell(row['class'].get('class_code', ''))}</td>
-            <td>{'Đã khóa' if row['parent'].get('active', True) is False else 'Đang hoạt động'}</td>
-        </tr>
-        """
-        for row in parent_rows
+    def parent_rows():
+        for parent in parents:
+            student = get_student_by_id(parent.get('student_id')) or {}
+            class_obj = get_exam_class(parent.get('class_id')) or {}
+            yield [
+                parent.get('full_name'),
+                parent.get('username'),
+                parent.get('phone'),
+                parent.get('email'),
+                student.get('full_name', ''),
+                student.get('username', ''),
+                class_obj.get('name', ''),
+                class_obj.get('class_code', ''),
+                'Đã khóa' if parent.get('active', True) is False else 'Đang hoạt động',
+            ]
+
+    yield (
+        'Danh sách phụ huynh',
+        ['Phụ huynh', 'Tài khoản', 'Điện thoại', 'Email', 'Học sinh', 'Tài khoản học sinh',
+         'Lớp', 'Mã lớp', 'Trạng thái'],
+        parent_rows()
+    )
+
+    def class_rows():
+        for class_obj in classes:
+            stats = build_class_stats(class_obj)
+            teacher = get_exam_user('teachers', class_obj.get('teacher_id')) or {}
+            yield [
+                class_obj.get('name'),
+                class_obj.get('class_code'),
+                class_obj.get('join_password_plain') or 'Cần đặt lại',
+                class_obj.get('grade'),
+                class_obj.get('subject'),
+                teacher.get('full_name', ''),
+                stats['student_count'],
+                stats['lesson_count'],
+                stats['exam_count'],
+                stats['material_count'],
+                stats['submission_count'],
+                stats['avg_score'] if stats['avg_score'] is not None else 'Chưa có',
+            ]
+
+    yield (
+        'Danh sách lớp học',
+        ['Lớp', 'Mã lớp', 'Mật khẩu lớp', 'Khối/Lớp', 'Môn', 'Giáo viên', 'Học sinh',
+         'Bài giảng', 'Đề kiểm tra', 'Học liệu', 'Bài nộp', 'Điểm trung bình'],
+        class_rows()
     )
 
-    html = f"""<!DOCTYPE html>
+
+def stream_admin_report_xls(sections, generated_at):
+    # HTML mà Excel mở được như bảng tính, giữ định dạng file .xls cũ.
+    def cell(value):
+        return html_lib.escape(str(value if value is not None else ''))
+
+    yield f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -1405,60 +4744,222 @@ def admin_export_report():
 <body>
     <h1>Báo cáo admin hệ thống học tập</h1>
     <p>Thời điểm xuất: {cell(generated_at)}</p>
-    <h2>Tổng quan</h2>
-    <table>
-        <tr><th>Giáo viên</th><th>Giáo viên hoạt động</th><th>Học sinh</th><th>Phụ huynh</th><th>Lớp</th><th>Bài giảng</th><th>Đề kiểm tra</th><th>Bài nộp</th></tr>
-        <tr>
-            <td>{summary['teacher_count']}</td>
-            <td>{summary['active_teacher_count']}</td>
-            <td>{summary['student_count']}</td>
-            <td>{summary['parent_count']}</td>
-            <td>{summary['class_count']}</td>
-            <td>{summary['lesson_count']}</td>
-            <td>{summary['exam_count']}</td>
-            <td>{summary['submission_count']}</td>
-        </tr>
-    </table>
-    <h2>Danh sách giáo viên</h2>
-    <table>
-        <tr><th>Giáo viên</th><th>Tài khoản</th><th>Môn</th><th>Email</th><th>Số lớp</th><th>Học sinh</th><th>Bài giảng</th><th>Đề kiểm tra</th><th>Bài nộp</th><th>Trạng thái</th></tr>
-        {teacher_html}
-    </table>
-    <h2>Danh sách phụ huynh</h2>
-    <table>
-        <tr><th>Phụ huynh</th><th>Tài khoản</th><th>Điện thoại</th><th>Email</th><th>Học sinh</th><th>Tài khoản học sinh</th><th>Lớp</th><th>Mã lớp</th><th>Trạng thái</th></tr>
-        {parent_html}
-    </table>
-    <h2>Danh sách lớp học</h2>
-    <table>
-        <tr><th>Lớp</th><th>Mã lớp</th><th>Mật khẩu lớp</th><th>Khối/Lớp</th><th>Môn</th><th>Giáo viên</th><th>Học sinh</th><th>Bài giảng</th><th>Đề kiểm tra</th><th>Học liệu</th><th>Bài nộp</th><th>Điểm trung bình</th></tr>
-        {class_html}
-    </table>
-</body>
-</html>"""
+"""
+    for title, headers, rows in sections:
+        header_html = ''.join(f"<th>{cell(header)}</th>" for header in headers)
+        yield f"    <h2>{cell(title)}</h2>\n    <table>\n        <tr>{header_html}</tr>\n"
+        for row in rows:
+            yield "        <tr>" + ''.join(f"<td>{cell(value)}</td>" for value in row) + "</tr>\n"
+        yield "    </table>\n"
+    yield "</body>\n</html>"
+
+
+def stream_admin_report_csv(sections, generated_at):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    # BOM để Excel nhận đúng UTF-8 tiếng Việt.
+    writer.writerow(['Báo cáo admin hệ thống học tập', generated_at])
+    yield '\ufeff' + flush()
+    for title, headers, rows in sections:
+        writer.writerow([])
+        writer.writerow([title])
+        writer.writerow(headers)
+        yield flush()
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+            yield flush()
+
+
+class StreamSink:
+    """File-like chỉ ghi, không seek được: zipfile sẽ ghi dạng stream và ta lấy bytes ra dần."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def xlsx_column_name(index):
+    name = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+def xlsx_row_xml(row_number, values, bold=False):
+    cells = []
+    for column, value in enumerate(values):
+        ref = f"{xlsx_column_name(column)}{row_number}"
+        style = ' s="1"' if bold else ''
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"{style}><v>{value}</v></c>')
+        else:
+            text = XML_ILLEGAL_CHARS.sub('', str(value if value is not None else ''))
+            cells.append(
+                f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">'
+                f'{html_lib.escape(text, quote=False)}</t></is></c>'
+            )
+    return f'<row r="{row_number}">{"".join(cells)}</row>'
+
+
+def stream_admin_report_xlsx(sections, generated_at):
+    """Ghi workbook .xlsx tối giản (mỗi phần một sheet) thẳng ra response, không giữ cả file trong bộ nhớ."""
+    sink = StreamSink()
+    sheet_names = []
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for title, headers, rows in sections:
+            sheet_names.append(title[:31])
+            path = f"xl/worksheets/sheet{len(sheet_names)}.xml"
+            with archive.open(path, 'w') as sheet:
+                sheet.write(
+                    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                    b'<sheetData>'
+                )
+                sheet.write(xlsx_row_xml(1, headers, bold=True).encode('utf-8'))
+                for row_number, row in enumerate(rows, start=2):
+                    sheet.write(xlsx_row_xml(row_number, row).encode('utf-8'))
+                    chunk = sink.drain()
+                    if chunk:
+                        yield chunk
+                sheet.write(b'</sheetData></worksheet>')
+            yield sink.drain()
+
+        sheet_entries = ''.join(
+            f'<sheet name="{html_lib.escape(name)}" sheetId="{index}" r:id="rId{index}"/>'
+            for index, name in enumerate(sheet_names, start=1)
+        )
+        sheet_rels = ''.join(
+            f'<Relationship Id="rId{index}" '
+            f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            f'Target="worksheets/sheet{index}.xml"/>'
+            for index in range(1, len(sheet_names) + 1)
+        )
+        styles_id = len(sheet_names) + 1
+        sheet_types = ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{index}.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for index in range(1, len(sheet_names) + 1)
+        )
+        archive.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{sheet_types}</Types>'
+        ))
+        archive.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'
+        ))
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheet_entries}</sheets></workbook>'
+        ))
+        archive.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{sheet_rels}<Relationship Id="rId{styles_id}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+            'Target="styles.xml"/></Relationships>'
+        ))
+        archive.writestr('xl/styles.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+            '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+            '<fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+            '</styleSheet>'
+        ))
+    yield sink.drain()
+
+
+@app.route('/admin/export_report')
+def admin_export_report():
+    blocked = require_admin()
+    if blocked:
+        return blocked
 
-    filename = f"bao-cao-admin-{datetime.now().strftime('%Y%m%d-%H%M')}.xls"
+    export_format = request.args.get('format', 'xls').lower()
+    if export_format not in ADMIN_EXPORT_FORMATS:
+        export_format = 'xls'
+    mimetype, extension = ADMIN_EXPORT_FORMATS[export_format]
+    writer = {
+        'xls': stream_admin_report_xls,
+        'csv': stream_admin_report_csv,
+        'xlsx': stream_admin_report_xlsx,
+    }[export_format]
+
+    filters = parse_admin_report_filters(request.args)
+    generated_at = datetime.now().strftime("%d/%m/%Y %H:%M")
+    filename = f"bao-cao-admin-{datetime.now().strftime('%Y%m%d-%H%M')}.{extension}"
+    # stream_with_context giữ request context (session, cache trên g) trong lúc sinh từng dòng.
     return Response(
-        html,
-        mimetype='application/vnd.ms-excel; charset=utf-8',
+        stream_with_context(writer(iter_admin_report_sections(filters), generated_at)),
+        mimetype=mimetype,
         headers={'Content-Disposition': f'attachment; filename="{filename}"'}
     )
 
 
+@app.route('/admin/ai_stats')
+def admin_ai_stats():
+    blocked = require_admin()
+    if blocked:
+        return blocked
+
+    return jsonify({
+        'response_cache': get_ai_response_cache_stats(),
+        'key_budgets': model.get_budgets(),
+        'lane_waiting': model.get_lane_waiting()
+    })
+
+
 @app.route('/admin/teachers/<teacher_id>/toggle', methods=['POST'])
 def admin_toggle_teacher(teacher_id):
     blocked = require_admin()
     if blocked:
         return blocked
 
-    users = load_exam_users()
-    teacher = next((t for t in users.get('teachers', []) if t.get('id') == teacher_id), None)
+    teacher = get_exam_user('teachers', teacher_id)
     if not teacher:
         flash('Không tìm thấy giáo viên.', 'error')
         return redirect(url_for('admin_dashboard'))
 
     teacher['active'] = not teacher.get('active', True)
-    save_exam_users(users)
+    update_exam_record('users', teacher, role='teachers')
     flash('Đã cập nhật trạng thái giáo viên.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1474,15 +4975,14 @@ def admin_reset_teacher_password(teacher_id):
         flash('Vui lòng nhập mật khẩu mới.', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    users = load_exam_users()
-    teacher = next((t for t in users.get('teachers', []) if t.get('id') == teacher_id), None)
+    teacher = get_exam_user('teachers', teacher_id)
     if not teacher:
         flash('Không tìm thấy giáo viên.', 'error')
         return redirect(url_for('admin_dashboard'))
 
     teacher['password'] = generate_password_hash(new_password)
     teacher['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_users(users)
+    update_exam_record('users', teacher, role='teachers')
     flash('Đã reset mật khẩu giáo viên.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1493,8 +4993,7 @@ def admin_edit_teacher(teacher_id):
     if blocked:
         return blocked
 
-    users = load_exam_users()
-    teacher = next((t for t in users.get('teachers', []) if t.get('id') == teacher_id), None)
+    teacher = get_exam_user('teachers', teacher_id)
     if not teacher:
         flash('Không tìm thấy giáo viên.', 'error')
         return redirect(url_for('admin_dashboard'))
@@ -1503,7 +5002,7 @@ def admin_edit_teacher(teacher_id):
     teacher['subject'] = request.form.get('subject', '').strip() or teacher.get('subject', '')
     teacher['email'] = request.form.get('email', '').strip()
     teacher['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_users(users)
+    update_exam_record('users', teacher, role='teachers')
     flash('Đã cập nhật thông tin giáo viên.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1526,22 +5025,19 @@ def admin_create_parent():
         flash('Vui lòng nhập đủ tài khoản, mật khẩu, họ tên, lớp và học sinh cho phụ huynh.', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    users = load_exam_users()
-    username_exists = (
-        any(u.get('username') == username for u in users.get('teachers', [])) or
-        any(u.get('username') == username for u in users.get('students', [])) or
-        any(u.get('username') == username for u in users.get('parents', []))
+    username_exists = any(
+        get_exam_user_by_username(role, username) for role in EXAM_USER_ROLES
     )
     if username_exists:
         flash('Tên đăng nhập đã tồn tại trong hệ thống.', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    class_obj = next((c for c in load_exam_classes() if c.get('id') == class_id), None)
+    class_obj = get_exam_class(class_id)
     if not class_obj or not student_in_class(class_obj, student_id):
         flash('Học sinh không thuộc lớp đã chọn.', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    users.setdefault('parents', []).append({
+    insert_exam_record('users', {
         'id': str(uuid.uuid4()),
         'username': username,
         'password': generate_password_hash(password),
@@ -1552,8 +5048,7 @@ def admin_create_parent():
         'student_id': student_id,
         'active': True,
         'created_at': datetime.now().strftime("%d/%m/%Y %H:%M")
-    })
-    save_exam_users(users)
+    }, role='parents', at_start=False)
     flash('Đã tạo tài khoản phụ huynh.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1564,15 +5059,14 @@ def admin_toggle_parent(parent_id):
     if blocked:
         return blocked
 
-    users = load_exam_users()
-    parent = next((p for p in users.get('parents', []) if p.get('id') == parent_id), None)
+    parent = get_exam_user('parents', parent_id)
     if not parent:
         flash('Không tìm thấy tài khoản phụ huynh.', 'error')
         return redirect(url_for('admin_dashboard'))
 
     parent['active'] = not parent.get('active', True)
     parent['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_users(users)
+    update_exam_record('users', parent, role='parents')
     flash('Đã cập nhật trạng thái phụ huynh.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1588,15 +5082,14 @@ def admin_reset_parent_password(parent_id):
         flash('Vui lòng nhập mật khẩu mới cho phụ huynh.', 'error')
         return redirect(url_for('admin_dashboard'))
 
-    users = load_exam_users()
-    parent = next((p for p in users.get('parents', []) if p.get('id') == parent_id), None)
+    parent = get_exam_user('parents', parent_id)
     if not parent:
         flash('Không tìm thấy tài khoản phụ huynh.', 'error')
         return redirect(url_for('admin_dashboard'))
 
     parent['password'] = generate_password_hash(new_password)
     parent['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_users(users)
+    update_exam_record('users', parent, role='parents')
     flash('Đã reset mật khẩu phụ huynh.', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -1609,10 +5102,7 @@ def teacher_dashboard():
         return blocked
 
     teacher_id = session.get('exam_user_id')
-    classes = [
-        c for c in load_exam_classes()
-        if c.get('teacher_id') == teacher_id
-    ]
+    classes = classes_for_teacher(teacher_id)
     class_rows = [
         {'class': class_obj, 'stats': build_class_stats(class_obj)}
         for class_obj in classes
@@ -1656,8 +5146,7 @@ def teacher_create_class():
         'updated_at': None,
         'active': True
     }
-    classes.insert(0, class_obj)
-    save_exam_classes(classes)
+    insert_exam_record('classes', class_obj)
     flash(f'Đã tạo lớp. Mã lớp: {class_obj["class_code"]} · Mật khẩu lớp: {join_password}', 'success')
     return redirect(url_for('teacher_class_detail', class_id=class_obj['id']))
 
@@ -1668,23 +5157,22 @@ def teacher_reset_class_password(class_id):
     if blocked:
         return blocked
 
-    classes = load_exam_classes()
-    class_obj = next(
-        (
-            c for c in classes
-            if c.get('id') == class_id and c.get('teacher_id') == session.get('exam_user_id')
-        ),
-        None
-    )
+    class_obj = get_teacher_class(class_id)
     if not class_obj:
         flash('Không tìm thấy lớp học hoặc bạn không có quyền truy cập.', 'error')
         return redirect(url_for('teacher_dashboard'))
 
     new_password = request.form.get('join_password', '').strip() or generate_join_password()
-    class_obj['join_password'] = generate_password_hash(new_password)
-    class_obj['join_password_plain'] = new_password
-    class_obj['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_classes(classes)
+    password_hash = generate_password_hash(new_password)
+
+    def reset_password(classes):
+        current = find_exam_record_in('classes', classes, class_id)
+        if current:
+            current['join_password'] = password_hash
+            current['join_password_plain'] = new_password
+            current['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
+
+    update_exam_collection('classes', reset_password)
     flash(f'Đã cập nhật mật khẩu lớp: {new_password}', 'success')
     return redirect(url_for('teacher_class_detail', class_id=class_id))
 
@@ -1700,18 +5188,11 @@ def teacher_class_detail(class_id):
         flash('Không tìm thấy lớp học hoặc bạn không có quyền truy cập.', 'error')
         return redirect(url_for('teacher_dashboard'))
 
-    lessons = [l for l in load_exam_lessons() if l.get('class_id') == class_id]
-    exams = [e for e in load_exam_exams() if e.get('class_id') == class_id]
-    materials = [m for m in load_exam_materials() if m.get('class_id') == class_id]
-    users = load_exam_users()
-    students = [
-        s for s in users.get('students', [])
-        if s.get('id') in class_obj.get('student_ids', [])
-    ]
-    submissions = [
-        sub for sub in load_exam_submissions()
-        if any(exam.get('id') == sub.get('exam_id') for exam in exams)
-    ]
+    lessons = lessons_for_class(class_id)
+    exams = exams_for_class(class_id)
+    materials = materials_for_class(class_id)
+    students = find_exam_records_in('users', 'id', class_obj.get('student_ids', []), 'students')
+    submissions = submissions_for_exams([exam.get('id') for exam in exams])
     class_analysis = build_teacher_class_analysis(
         class_obj,
         students=students,
@@ -1736,14 +5217,7 @@ def teacher_save_class_reviews(class_id):
     if blocked:
         return blocked
 
-    classes = load_exam_classes()
-    class_obj = next(
-        (
-            c for c in classes
-            if c.get('id') == class_id and c.get('teacher_id') == session.get('exam_user_id')
-        ),
-        None
-    )
+    class_obj = get_teacher_class(class_id)
     if not class_obj:
         flash('Không tìm thấy lớp học hoặc bạn không có quyền truy cập.', 'error')
         return redirect(url_for('teacher_dashboard'))
@@ -1751,7 +5225,8 @@ def teacher_save_class_reviews(class_id):
     student_ids = request.form.getlist('student_id[]')
     comments = request.form.getlist('comment[]')
     published_ids = set(request.form.getlist('published_student_id[]'))
-    reviews = class_obj.setdefault('student_reviews', {})
+    now = datetime.now().strftime("%d/%m/%Y %H:%M")
+    reviews = {}
 
     for index, student_id in enumerate(student_ids):
         comment = comments[index].strip() if index < len(comments) else ''
@@ -1760,11 +5235,17 @@ def teacher_save_class_reviews(class_id):
         reviews[student_id] = {
             'comment': comment,
             'published': student_id in published_ids,
-            'updated_at': datetime.now().strftime("%d/%m/%Y %H:%M")
+            'updated_at': now
         }
 
-    class_obj['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-    save_exam_classes(classes)
+    def save_reviews(classes):
+        # Gộp vào bản mới nhất của lớp để không ghi đè học sinh vừa tham gia hay nhận xét của tab khác.
+        current = find_exam_record_in('classes', classes, class_id)
+        if current:
+            current.setdefault('student_reviews', {}).update(reviews)
+            current['updated_at'] = now
+
+    update_exam_collection('classes', save_reviews)
     flash('Đã lưu nhận xét cá nhân cho học sinh trong lớp.', 'success')
     return redirect(url_for('teacher_class_detail', class_id=class_id))
 
@@ -1806,8 +5287,7 @@ def teacher_material_library(class_id=None):
             flash('Link học liệu phải là link Google Drive hoặc Google Docs.', 'error')
             return redirect(redirect_target)
 
-        materials = load_exam_materials()
-        materials.insert(0, {
+        insert_exam_record('materials', {
             'id': str(uuid.uuid4()),
             'title': title,
             'grade': grade,
@@ -1819,14 +5299,13 @@ def teacher_material_library(class_id=None):
             'created_at': datetime.now().strftime("%d/%m/%Y %H:%M"),
             'updated_at': None
         })
-        save_exam_materials(materials)
         flash('Đã thêm sách vào kho học liệu.', 'success')
         return redirect(redirect_target)
 
     teacher_id = session.get('exam_user_id')
     materials = [
-        m for m in load_exam_materials()
-        if m.get('teacher_id') == teacher_id and (not class_id or m.get('class_id') == class_id)
+        m for m in materials_for_teacher(teacher_id)
+        if not class_id or m.get('class_id') == class_id
     ]
     materials = sorted(
         materials,
@@ -1845,8 +5324,7 @@ def teacher_edit_material(material_id):
     if blocked:
         return blocked
 
-    materials = load_exam_materials()
-    material = next((m for m in materials if m.get('id') == material_id), None)
+    material = get_exam_material(material_id)
     if not material or material.get('teacher_id') != session.get('exam_user_id'):
         flash('Không tìm thấy sách hoặc bạn không có quyền chỉnh sửa.', 'error')
         return redirect(url_for('teacher_material_library'))
@@ -1882,7 +5360,7 @@ def teacher_edit_material(material_id):
             'description': description,
             'updated_at': datetime.now().strftime("%d/%m/%Y %H:%M")
         })
-        save_exam_materials(materials)
+        update_exam_record('materials', material)
         flash('Đã cập nhật sách.', 'success')
         if material.get('class_id'):
             return redirect(url_for('teacher_material_library', class_id=material.get('class_id')))
@@ -1890,9 +5368,8 @@ def teacher_edit_material(material_id):
 
     teacher_id = session.get('exam_user_id')
     visible_materials = [
-        m for m in materials
-        if m.get('teacher_id') == teacher_id
-        and (not material.get('class_id') or m.get('class_id') == material.get('class_id'))
+        m for m in materials_for_teacher(teacher_id)
+        if not material.get('class_id') or m.get('class_id') == material.get('class_id')
     ]
     visible_materials = sorted(
         visible_materials,
@@ -1912,14 +5389,12 @@ def teacher_delete_material(material_id):
     if blocked:
         return blocked
 
-    materials = load_exam_materials()
-    material = next((m for m in materials if m.get('id') == material_id), None)
+    material = get_exam_material(material_id)
     if not material or material.get('teacher_id') != session.get('exam_user_id'):
         flash('Không tìm thấy sách hoặc bạn không có quyền xóa.', 'error')
         return redirect(url_for('teacher_material_library'))
 
-    materials = [m for m in materials if m.get('id') != material_id]
-    save_exam_materials(materials)
+    delete_exam_record('materials', material_id)
     flash('Đã xóa sách khỏi kho học liệu.', 'success')
     if material.get('class_id'):
         return redirect(url_for('teacher_material_library', class_id=material.get('class_id')))
@@ -1932,10 +5407,7 @@ def exam_material_view(material_id):
     if user_type not in {'teacher', 'student'}:
         return redirect(url_for('exam_student_login'))
 
-    material = next(
-        (m for m in load_exam_materials() if m.get('id') == material_id),
-        None
-    )
+    material = get_exam_material(material_id)
     if not material:
         flash('Không tìm thấy học liệu.', 'error')
         if user_type == 'teacher':
@@ -1946,17 +5418,14 @@ def exam_material_view(material_id):
         flash('Bạn không có quyền xem học liệu này trong trang quản lý giáo viên.', 'error')
         return redirect(url_for('teacher_material_library'))
     if user_type == 'student' and material.get('class_id'):
-        class_obj = next(
-            (c for c in load_exam_classes() if c.get('id') == material.get('class_id')),
-            None
-        )
+        class_obj = get_exam_class(material.get('class_id'))
         if not class_obj or not student_in_class(class_obj, session.get('exam_user_id')):
             flash('Bạn cần tham gia lớp để xem học liệu này.', 'error')
             return redirect(url_for('student_dashboard'))
 
     return render_template('exam_system/material_viewer.html',
                            material=material,
-                           class_obj=next((c for c in load_exam_classes() if c.get('id') == material.get('class_id')), None),
+                           class_obj=get_exam_class(material.get('class_id')),
                            embed_url=get_google_embed_url(material.get('drive_url')))
 
 
@@ -2002,9 +5471,7 @@ def teacher_create_lesson(class_id=None):
             'grade': grade
         }
 
-        lessons = load_exam_lessons()
-        lessons.insert(0, new_lesson)
-        save_exam_lessons(lessons)
+        insert_exam_record('lessons', new_lesson)
 
         flash('Đã tạo bài giảng!', 'success')
         return redirect(url_for('teacher_class_detail', class_id=class_id))
@@ -2137,9 +5604,7 @@ def teacher_create_multiple_choice(class_id=None):
                 'questions': questions
             }
 
-            exams = load_exam_exams()
-            exams.insert(0, new_exam)
-            save_exam_exams(exams)
+            insert_exam_record('exams', new_exam)
 
             flash(f'Đã tạo đề trắc nghiệm thủ công với {len(questions)} câu.', 'success')
             return redirect(url_for('teacher_class_detail', class_id=class_id))
@@ -2170,12 +5635,14 @@ Hãy chuyển đổi thành JSON với format:
 
 CHỈ TRẢ VỀ JSON, KHÔNG THÊM TEXT KHÁC."""
 
+                def parse_questions_json(text):
+                    return json.loads(text.replace('```json', '').replace('```', '').strip())
+
                 try:
-                    response = model.generate_content([prompt])
-                    ai_json = response.text.replace('```json',
-                                                    '').replace('```',
-                                                                '').strip()
-                    questions_data = json.loads(ai_json)
+                    # Cùng một file Word thì dùng lại kết quả tách câu hỏi đã có.
+                    questions_data = parse_questions_json(
+                        generate_cached_ai_text([prompt], validate=parse_questions_json)
+                    )
 
                     # Lưu vào session để preview
                     session['preview_questions'] = questions_data
@@ -2213,9 +5680,7 @@ CHỈ TRẢ VỀ JSON, KHÔNG THÊM TEXT KHÁC."""
                 'questions': questions
             }
 
-            exams = load_exam_exams()
-            exams.insert(0, new_exam)
-            save_exam_exams(exams)
+            insert_exam_record('exams', new_exam)
 
             flash('Đã tạo đề trắc nghiệm!', 'success')
             return redirect(url_for('teacher_class_detail', class_id=class_id))
@@ -2278,9 +5743,7 @@ def teacher_create_essay(class_id=None):
             'essay_questions': questions
         }
 
-        exams = load_exam_exams()
-        exams.insert(0, new_exam)
-        save_exam_exams(exams)
+        insert_exam_record('exams', new_exam)
 
         flash('Đã tạo đề tự luận!', 'success')
         return redirect(url_for('teacher_class_detail', class_id=class_id))
@@ -2295,7 +5758,7 @@ def teacher_view_submissions(exam_id):
     if blocked:
         return blocked
 
-    exam = next((e for e in load_exam_exams() if e['id'] == exam_id), None)
+    exam = get_exam(exam_id)
     if not exam:
         flash('Không tìm thấy đề!', 'error')
         return redirect(url_for('teacher_dashboard'))
@@ -2304,22 +5767,58 @@ def teacher_view_submissions(exam_id):
         flash('Bạn không có quyền xem bài nộp của đề này.', 'error')
         return redirect(url_for('teacher_dashboard'))
 
-    submissions = [
-        s for s in load_exam_submissions() if s['exam_id'] == exam_id
-    ]
-    users = load_exam_users()
+    filters = {
+        'student_id': request.args.get('student_id', ''),
+        'score': request.args.get('score', ''),
+        'sort': request.args.get('sort', 'time_desc'),
+    }
+    if filters['score'] not in EXAM_SUBMISSION_SCORE_BANDS:
+        filters['score'] = ''
+    if filters['sort'] not in EXAM_SUBMISSION_SORTS:
+        filters['sort'] = 'time_desc'
+    min_score, max_score = EXAM_SUBMISSION_SCORE_BANDS.get(filters['score'], (None, None))
+    page, next_after, prev_before, start, total = query_exam_submissions(
+        exam_id=exam_id,
+        student_id=filters['student_id'] or None,
+        min_score=min_score,
+        max_score=max_score,
+        sort=filters['sort'],
+        limit=request.args.get('limit', type=int),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
 
-    # Ghép thông tin học sinh
-    for sub in submissions:
-        student = next(
-            (s for s in users['students'] if s['id'] == sub['student_id']),
-            None)
-        sub['student_name'] = student['full_name'] if student else 'Unknown'
-        sub['student_class'] = student.get('class', '') if student else ''
+    all_submissions = submissions_for_exam(exam_id)
+    graded_scores = [float(s.get('score', 0) or 0) for s in all_submissions if is_submission_graded(s)]
+    summary = {
+        'count': len(all_submissions),
+        'average': sum(graded_scores) / len(graded_scores) if graded_scores else 0,
+        'excellent': len([score for score in graded_scores if score >= 8]),
+        'poor': len([score for score in graded_scores if score < 5]),
+    }
+
+    # Ghép thông tin học sinh qua một bảng tra theo id, chỉ gồm học sinh đã nộp bài cho đề này.
+    submitter_ids = list(dict.fromkeys(s.get('student_id') for s in all_submissions if s.get('student_id')))
+    students = {s.get('id'): s for s in find_exam_records_in('users', 'id', submitter_ids, 'students')}
+    submissions = []
+    for sub in page:
+        student = students.get(sub.get('student_id'))
+        submissions.append(dict(
+            sub,
+            student_name=student['full_name'] if student else 'Unknown',
+            student_class=student.get('class', '') if student else ''
+        ))
 
     return render_template('exam_system/teacher/view_submissions.html',
                            exam=exam,
                            submissions=submissions,
+                           summary=summary,
+                           students=sorted(students.values(), key=lambda s: s.get('full_name', '')),
+                           filters=filters,
+                           start=start,
+                           total=total,
+                           next_after=next_after,
+                           prev_before=prev_before,
                            class_obj=class_obj)
 
 
@@ -2329,23 +5828,17 @@ def teacher_view_submission(submission_id):
     if blocked:
         return blocked
 
-    submission = next(
-        (s for s in load_exam_submissions() if s['id'] == submission_id), None)
+    submission = get_exam_submission(submission_id)
     if not submission:
         flash('Không tìm thấy bài làm!', 'error')
         return redirect(url_for('teacher_dashboard'))
 
-    exam = next(
-        (e for e in load_exam_exams() if e['id'] == submission['exam_id']),
-        None)
+    exam = get_exam(submission['exam_id'])
     class_obj = get_teacher_class(exam.get('class_id')) if exam and exam.get('class_id') else None
     if not exam or exam.get('teacher_id') != session.get('exam_user_id') or (exam.get('class_id') and not class_obj):
         flash('Bạn không có quyền xem bài làm này.', 'error')
         return redirect(url_for('teacher_dashboard'))
-    users = load_exam_users()
-    student = next(
-        (s for s in users['students'] if s['id'] == submission['student_id']),
-        None)
+    student = get_student_by_id(submission['student_id'])
 
     return render_template('exam_system/teacher/view_submission_detail.html',
                            submission=submission,
@@ -2360,15 +5853,13 @@ def teacher_delete_exam(exam_id):
     if blocked:
         return blocked
 
-    exams = load_exam_exams()
-    exam = next((e for e in exams if e.get('id') == exam_id), None)
+    exam = get_exam(exam_id)
     if not exam or exam.get('teacher_id') != session.get('exam_user_id'):
         flash('Không tìm thấy đề hoặc bạn không có quyền xóa.', 'error')
         return redirect(url_for('teacher_dashboard'))
 
     class_id = exam.get('class_id')
-    exams = [e for e in exams if e['id'] != exam_id]
-    save_exam_exams(exams)
+    delete_exam_record('exams', exam_id)
 
     flash('Đã xóa đề kiểm tra!', 'success')
     if class_id:
@@ -2462,23 +5953,14 @@ def student_class_detail(class_id):
         return redirect(url_for('exam_student_login'))
 
     student_id = session.get('exam_user_id')
-    class_obj = next(
-        (
-            c for c in load_exam_classes()
-            if c.get('id') == class_id and student_in_class(c, student_id)
-        ),
-        None
-    )
-    if not class_obj:
+    class_obj = get_exam_class(class_id)
+    if not class_obj or not student_in_class(class_obj, student_id):
         flash('Bạn cần tham gia lớp trước khi xem nội dung lớp này.', 'error')
         return redirect(url_for('student_dashboard'))
 
-    lessons = [l for l in load_exam_lessons() if l.get('class_id') == class_id]
-    materials = [m for m in load_exam_materials() if m.get('class_id') == class_id]
-    exams = [
-        e for e in load_exam_exams()
-        if e.get('status') == 'active' and e.get('class_id') == class_id
-    ]
+    lessons = lessons_for_class(class_id)
+    materials = materials_for_class(class_id)
+    exams = [e for e in exams_for_class(class_id) if e.get('status') == 'active']
 
     return render_template('exam_system/student/class_detail.html',
                            class_obj=class_obj,
@@ -2494,14 +5976,8 @@ def student_class_learning_portal(class_id):
         return redirect(url_for('exam_student_login'))
 
     student_id = session.get('exam_user_id')
-    class_obj = next(
-        (
-            c for c in load_exam_classes()
-            if c.get('id') == class_id and student_in_class(c, student_id)
-        ),
-        None
-    )
-    if not class_obj:
+    class_obj = get_exam_class(class_id)
+    if not class_obj or not student_in_class(class_obj, student_id):
         flash('Bạn cần tham gia lớp trước khi xem báo cáo học tập.', 'error')
         return redirect(url_for('student_dashboard'))
 
@@ -2523,8 +5999,7 @@ def student_join_class():
 
     class_code = request.form.get('class_code', '').strip().upper()
     join_password = request.form.get('join_password', '').strip()
-    classes = load_exam_classes()
-    class_obj = next((c for c in classes if c.get('class_code') == class_code), None)
+    class_obj = get_exam_class_by_code(class_code)
     if not class_obj:
         flash('Không tìm thấy lớp học với mã này.', 'error')
         return redirect(url_for('student_dashboard'))
@@ -2540,11 +6015,15 @@ def student_join_class():
         return redirect(url_for('student_dashboard'))
 
     student_id = session.get('exam_user_id')
-    class_obj.setdefault('student_ids', [])
-    if student_id not in class_obj['student_ids']:
-        class_obj['student_ids'].append(student_id)
-        class_obj['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
-        save_exam_classes(classes)
+    if student_id not in class_obj.get('student_ids', []):
+        def join(classes):
+            # Chạy lại trên bản mới nhất nếu có học sinh khác tham gia cùng lúc.
+            current = find_exam_record_in('classes', classes, class_obj.get('id'))
+            if current and student_id not in current.setdefault('student_ids', []):
+                current['student_ids'].append(student_id)
+                current['updated_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
+
+        update_exam_collection('classes', join)
         flash('Đã tham gia lớp học.', 'success')
     else:
         flash('Bạn đã ở trong lớp này rồi.', 'info')
@@ -2556,14 +6035,13 @@ def student_view_lesson(lesson_id):
     if session.get('exam_user_type') != 'student':
         return redirect(url_for('exam_student_login'))
 
-    lesson = next((l for l in load_exam_lessons() if l['id'] == lesson_id),
-                  None)
+    lesson = get_exam_lesson(lesson_id)
     if not lesson:
         flash('Không tìm thấy bài giảng!', 'error')
         return redirect(url_for('student_dashboard'))
     class_obj = None
     if lesson.get('class_id'):
-        class_obj = next((c for c in load_exam_classes() if c.get('id') == lesson.get('class_id')), None)
+        class_obj = get_exam_class(lesson.get('class_id'))
         if not class_obj or not student_in_class(class_obj, session.get('exam_user_id')):
             flash('Bạn cần tham gia lớp để xem bài giảng này.', 'error')
             return redirect(url_for('student_dashboard'))
@@ -2578,12 +6056,12 @@ def student_take_exam(exam_id):
     if session.get('exam_user_type') != 'student':
         return redirect(url_for('exam_student_login'))
 
-    exam = next((e for e in load_exam_exams() if e['id'] == exam_id), None)
+    exam = get_exam(exam_id)
     if not exam:
         flash('Không tìm thấy đề!', 'error')
         return redirect(url_for('student_dashboard'))
     if exam.get('class_id'):
-        class_obj = next((c for c in load_exam_classes() if c.get('id') == exam.get('class_id')), None)
+        class_obj = get_exam_class(exam.get('class_id'))
         if not class_obj or not student_in_class(class_obj, session.get('exam_user_id')):
             flash('Bạn cần tham gia lớp để làm đề này.', 'error')
             return redirect(url_for('student_dashboard'))
@@ -2630,75 +6108,11 @@ Hãy đưa ra:
 
 Trả lời ngắn gọn, khuyến khích."""
 
-            try:
-                response = model.generate_content([prompt])
-                ai_feedback = clean_ai_output(response.text)
-            except:
-                ai_feedback = "Không có nhận xét từ AI."
-
-            submission = {
-                'id': submission_id,
-                'exam_id': exam_id,
-                'class_id': exam.get('class_id'),
-                'student_id': student_id,
-                'submitted_at': datetime.now().strftime("%d/%m/%Y %H:%M"),
-                'time_taken': int(time_taken),
-                'answers': answers,
-                'score': score,
-                'ai_feedback': ai_feedback,
-                'detailed_results': detailed_results
-            }
-
-        elif exam['type'] == 'essay':
-            essay_answers = {}
-            for q in exam['essay_questions']:
-                ans = request.form.get(f"essay_{q['id']}", '').strip()
-                essay_answers[str(q['id'])] = ans
-
-            # Chấm điểm tự luận bằng AI
-            total_points = 0
-            detailed_results = []
-
-            for q in exam['essay_questions']:
-                student_ans = essay_answers.get(str(q['id']), '')
-
-                prompt = f"""Đây là câu hỏi tự luận:
-
-Câu hỏi: {q['question']}
-Điểm tối đa: {q['points']}
-Đáp án gợi ý: {q.get('suggested_answer', 'Không có')}
-
-Câu trả lời của học sinh:
-{student_ans}
-
-Hãy chấm điểm (0-{q['points']}) và nhận xét ngắn gọn.
-Format: ĐIỂM: X/{q['points']}
-NHẬN XÉT: ..."""
-
-                try:
-                    response = model.generate_content([prompt])
-                    feedback = clean_ai_output(response.text)
-
-                    # Trích xuất điểm
-                    import re
-                    match = re.search(r'ĐIỂM:\s*(\d+\.?\d*)', feedback)
-                    q_score = float(match.group(1)) if match else 0
-                except:
-                    feedback = "Không chấm được."
-                    q_score = 0
-
-                total_points += q_score
-                detailed_results.append({
-                    'question_id': q['id'],
-                    'question': q['question'],
-                    'student_answer': student_ans,
-                    'points': q['points'],
-                    'score': q_score,
-                    'feedback': feedback
-                })
-
-            max_points = sum(q['points'] for q in exam['essay_questions'])
-            score = round((total_points / max_points) * 10, 2)
+            try:
+                # Prompt chỉ phụ thuộc số câu đúng/tổng số câu nên dùng lại được cho nhiều học sinh.
+                ai_feedback = clean_ai_output(generate_cached_ai_text([prompt]))
+            except:
+                ai_feedback = "Không có nhận xét từ AI."
 
             submission = {
                 'id': submission_id,
@@ -2707,15 +6121,42 @@ NHẬN XÉT: ..."""
                 'student_id': student_id,
                 'submitted_at': datetime.now().strftime("%d/%m/%Y %H:%M"),
                 'time_taken': int(time_taken),
-                'essay_answers': essay_answers,
+                'answers': answers,
                 'score': score,
-                'ai_feedback': f"Tổng điểm: {total_points}/{max_points}",
+                'ai_feedback': ai_feedback,
                 'detailed_results': detailed_results
             }
 
-        submissions = load_exam_submissions()
-        submissions.insert(0, submission)
-        save_exam_submissions(submissions)
+        elif exam['type'] == 'essay':
+            essay_answers = {}
+            for q in exam['essay_questions']:
+                ans = request.form.get(f"essay_{q['id']}", '').strip()
+                essay_answers[str(q['id'])] = ans
+
+            # Lưu bài ngay, AI chấm từng câu ở worker nền (run_essay_grading_job).
+            submission = {
+                'id': submission_id,
+                'exam_id': exam_id,
+                'class_id': exam.get('class_id'),
+                'student_id': student_id,
+                'submitted_at': datetime.now().strftime("%d/%m/%Y %H:%M"),
+                'time_taken': int(time_taken),
+                'essay_answers': essay_answers,
+                'score': 0,
+                'ai_feedback': '',
+                'detailed_results': [],
+                'grading': {
+                    'status': 'pending',
+                    'graded': 0,
+                    'total': len(exam['essay_questions']),
+                    'attempts': 0
+                }
+            }
+
+        insert_exam_record('submissions', submission)
+        if not is_submission_graded(submission):
+            enqueue_essay_grading_jobs([submission_id])
+            start_essay_grading_workers()
 
         flash('Đã nộp bài!', 'success')
         return redirect(
@@ -2729,8 +6170,7 @@ def student_view_result(submission_id):
     if session.get('exam_user_type') != 'student':
         return redirect(url_for('exam_student_login'))
 
-    submission = next(
-        (s for s in load_exam_submissions() if s['id'] == submission_id), None)
+    submission = get_exam_submission(submission_id)
     if not submission:
         flash('Không tìm thấy bài làm!', 'error')
         return redirect(url_for('student_dashboard'))
@@ -2738,32 +6178,50 @@ def student_view_result(submission_id):
         flash('Bạn không có quyền xem bài làm này.', 'error')
         return redirect(url_for('student_dashboard'))
 
-    exam = next(
-        (e for e in load_exam_exams() if e['id'] == submission['exam_id']),
-        None)
+    exam = get_exam(submission['exam_id'])
 
     return render_template('exam_system/student/view_result.html',
                            submission=submission,
                            exam=exam)
 
 
+@app.route('/exam_system/student/view_result/<submission_id>/status')
+def student_view_result_status(submission_id):
+    if session.get('exam_user_type') != 'student':
+        return jsonify({'error': 'unauthorized'}), 401
+
+    submission = get_exam_submission(submission_id)
+    if not submission or submission.get('student_id') != session.get('exam_user_id'):
+        return jsonify({'error': 'not_found'}), 404
+
+    grading = submission.get('grading') or {}
+    graded = grading.get('graded', len(submission.get('detailed_results', [])))
+    if not is_submission_graded(submission):
+        # Tiến độ của lần chấm đang chạy nằm ở hàng đợi cho đến khi bài nộp được ghi.
+        graded = max(graded, get_essay_grading_progress(submission_id) or 0)
+    return jsonify({
+        'status': grading.get('status', 'done'),
+        'graded': graded,
+        'total': grading.get('total', len(submission.get('detailed_results', []))),
+        'score': submission.get('score') if is_submission_graded(submission) else None
+    })
+
+
 @app.route('/exam_system/student/my_submissions')
 def student_my_submissions():
     if session.get('exam_user_type') != 'student':
         return redirect(url_for('exam_student_login'))
 
     student_id = session.get('exam_user_id')
-    submissions = [
-        s for s in load_exam_submissions() if s['student_id'] == student_id
-    ]
+    submissions = submissions_for_student(student_id)
 
-    exams = load_exam_exams()
     for sub in submissions:
-        exam = next((e for e in exams if e['id'] == sub['exam_id']), None)
+        exam = get_exam(sub['exam_id'])
         sub['exam_title'] = exam['title'] if exam else 'Unknown'
 
     return render_template('exam_system/student/my_submissions.html',
-                           submissions=submissions)
+                           submissions=submissions,
+                           graded_submissions=[s for s in submissions if is_submission_graded(s)])
 
 
 #################
@@ -2794,17 +6252,27 @@ def extract_text_from_pdf(pdf_path):
 #################
 def load_class_activities():
     """Load danh sách các phiên sinh hoạt lớp"""
-    try:
-        with open(CLASS_ACTIVITY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+    return read_json_file(CLASS_ACTIVITY_FILE, [])
 
 
 def save_class_activities(data):
     """Lưu danh sách sinh hoạt lớp"""
-    with open(CLASS_ACTIVITY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json_file(CLASS_ACTIVITY_FILE, data)
+
+
+def update_class_activity(activity_id, mutate):
+    """Sửa một phiên sinh hoạt trên bản mới nhất của file; trả về phiên đã sửa hoặc None nếu không còn."""
+    updated = []
+
+    def apply(activities):
+        for activity in activities:
+            if activity['id'] == activity_id:
+                mutate(activity)
+                updated.append(activity)
+                break
+
+    update_json_file(CLASS_ACTIVITY_FILE, [], apply)
+    return updated[0] if updated else None
 
 
 @app.route('/class_activity', methods=['GET'])
@@ -2844,9 +6312,8 @@ def new_class_activity():
             'ai_analysis': None
         }
 
-        activities = load_class_activities()
-        activities.insert(0, new_activity)
-        save_class_activities(activities)
+        update_json_file(CLASS_ACTIVITY_FILE, [],
+                         lambda activities: activities.insert(0, new_activity))
 
         flash('Đã tạo phiên sinh hoạt mới!', 'success')
         return redirect(
@@ -2868,19 +6335,10 @@ def load_chat_messages(activity_id):
 
 def save_chat_message(activity_id, message_data):
     """Lưu tin nhắn chat mới"""
-    try:
-        with open(CLASS_CHAT_FILE, 'r', encoding='utf-8') as f:
-            all_chats = json.load(f)
-    except FileNotFoundError:
-        all_chats = {}
-
-    if activity_id not in all_chats:
-        all_chats[activity_id] = []
-
-    all_chats[activity_id].append(message_data)
-
-    with open(CLASS_CHAT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(all_chats, f, ensure_ascii=False, indent=2)
+    update_json_file(
+        CLASS_CHAT_FILE, {},
+        lambda all_chats: all_chats.setdefault(activity_id, []).append(message_data)
+    )
 
 
 @app.route('/class_activity/<activity_id>/chat', methods=['GET'])
@@ -2977,6 +6435,7 @@ def class_activity_detail(activity_id):
                 url_for('class_activity_detail', activity_id=activity_id))
 
         # Xử lý từng file
+        new_images = []
         for uploaded_file in uploaded_files:
             if uploaded_file and uploaded_file.filename != '':
                 if not allowed_file(uploaded_file.filename):
@@ -2984,12 +6443,10 @@ def class_activity_detail(activity_id):
 
                 # Lưu file
                 file_id = str(uuid.uuid4())
-                filename = f"{file_id}_{secure_filename(uploaded_file.filename)}"
-                file_path = os.path.join(CLASS_ACTIVITY_IMAGES, filename)
-                uploaded_file.save(file_path)
+                filename, _ = store_upload(uploaded_file, CLASS_ACTIVITY_IMAGES)
 
                 # Thêm vào group
-                activity['groups'][group_name].append({
+                new_images.append({
                     'id':
                     file_id,
                     'filename':
@@ -2999,12 +6456,8 @@ def class_activity_detail(activity_id):
                 })
 
         # Cập nhật activity
-        for i, a in enumerate(activities):
-            if a['id'] == activity_id:
-                activities[i] = activity
-                break
-
-        save_class_activities(activities)
+        update_class_activity(
+            activity_id, lambda a: a['groups'][group_name].extend(new_images))
 
         flash(f'Đã upload ảnh cho {group_name}!', 'success')
         return redirect(
@@ -3117,11 +6570,10 @@ Dưới đây là báo cáo các tổ:
                     img_path = os.path.join(CLASS_ACTIVITY_IMAGES,
                                             img_data['filename'])
                     if os.path.exists(img_path):
-                        img = Image.open(img_path)
-                        analysis_prompt.append(img)
+                        analysis_prompt.append(load_ai_image(img_path))
 
         # Gọi Gemini phân tích
-        analysis_response = model.generate_content(analysis_prompt)
+        analysis_response = model.generate_content(analysis_prompt, priority='batch')
         ai_analysis = clean_ai_output(analysis_response.text)
 
         # Parse JSON
@@ -3299,7 +6751,7 @@ STYLING CSS:
 CHỈ TRẢ VỀ CODE HTML HOÀN CHỈNH, KHÔNG GIẢI THÍCH."""
 
         # Gọi Gemini tạo HTML
-        html_response = model.generate_content([html_prompt])
+        html_response = model.generate_content([html_prompt], priority='batch')
         html_content = clean_ai_output(html_response.text)
 
         # Loại bỏ markdown code blocks
@@ -3327,12 +6779,11 @@ CHỈ TRẢ VỀ CODE HTML HOÀN CHỈNH, KHÔNG GIẢI THÍCH."""
         activity['status'] = 'analyzed'
         activity['analyzed_at'] = datetime.now().strftime("%d/%m/%Y %H:%M")
 
-        for i, a in enumerate(activities):
-            if a['id'] == activity_id:
-                activities[i] = activity
-                break
-
-        save_class_activities(activities)
+        # Phân tích mất nhiều thời gian: chỉ ghi các trường kết quả lên bản mới nhất để không mất ảnh vừa upload.
+        analysis_fields = ('ai_analysis', 'analysis_data', 'status', 'analyzed_at', 'infographic_html')
+        update_class_activity(activity_id, lambda a: a.update({
+            field: activity[field] for field in analysis_fields if field in activity
+        }))
 
         flash('Đã phân tích và tạo infographic thành công!', 'success')
 
@@ -3366,25 +6817,24 @@ def class_activity_result(activity_id):
 @app.route('/class_activity/<activity_id>/delete', methods=['POST'])
 def delete_class_activity(activity_id):
     """Xóa phiên sinh hoạt"""
-    activities = load_class_activities()
-    activity = next((a for a in activities if a['id'] == activity_id), None)
+    removed = []
+
+    def remove_activity(activities):
+        removed.extend(a for a in activities if a['id'] == activity_id)
+        return [a for a in activities if a['id'] != activity_id]
 
-    if activity:
+    # Xóa activity
+    update_json_file(CLASS_ACTIVITY_FILE, [], remove_activity)
+
+    for activity in removed:
         # Xóa các file ảnh
         for group_name, images in activity['groups'].items():
             for img_data in images:
-                img_path = os.path.join(CLASS_ACTIVITY_IMAGES,
-                                        img_data['filename'])
                 try:
-                    if os.path.exists(img_path):
-                        os.remove(img_path)
+                    release_upload(CLASS_ACTIVITY_IMAGES, img_data['filename'])
                 except:
                     pass
 
-        # Xóa activity
-        activities = [a for a in activities if a['id'] != activity_id]
-        save_class_activities(activities)
-
         flash('Đã xóa phiên sinh hoạt!', 'success')
 
     return redirect(url_for('class_activity'))
@@ -3421,6 +6871,51 @@ QUY TẮC HIỂN THỊ CÔNG THỨC TOÁN:
 """
 
 
+# ---------------- KNOWLEDGE ASSETS ----------------
+# File kiến thức/prompt được đọc một lần khi khởi động và dựng sẵn phần đầu prompt;
+# request chỉ kiểm tra mtime (tối đa mỗi KNOWLEDGE_ASSET_CHECK_SECONDS) để nạp lại khi file đổi.
+KNOWLEDGE_ASSET_CHECK_SECONDS = float(os.environ.get("KNOWLEDGE_ASSET_CHECK_SECONDS", "2"))
+KNOWLEDGE_ASSETS = {}
+KNOWLEDGE_ASSETS_LOCK = Lock()
+
+
+def load_knowledge_asset(asset):
+    version = get_exam_file_version(asset['path'])
+    try:
+        with open(asset['path'], 'r', encoding='utf-8') as f:
+            text = f.read()
+    except (OSError, UnicodeDecodeError):
+        text = None
+    value = asset['build'](text) if asset['build'] else (text if text is not None else asset['missing'])
+    asset.update(version=version, value=value, checked_at=time.time())
+    return value
+
+
+def register_knowledge_asset(name, path, build=None, missing=''):
+    """build(text) dựng giá trị từ nội dung file (text là None khi thiếu file); không có build thì trả về nội dung hoặc missing.
+
+    File chỉ được đọc ở lần get_knowledge_asset đầu tiên, nên import app (kể cả từ script) không dựng index.
+    """
+    asset = {'path': path, 'build': build, 'missing': missing}
+    with KNOWLEDGE_ASSETS_LOCK:
+        KNOWLEDGE_ASSETS[name] = asset
+
+
+def get_knowledge_asset(name):
+    with KNOWLEDGE_ASSETS_LOCK:
+        asset = KNOWLEDGE_ASSETS[name]
+        if 'value' not in asset:
+            return load_knowledge_asset(asset)
+        now = time.time()
+        if now - asset['checked_at'] < KNOWLEDGE_ASSET_CHECK_SECONDS:
+            return asset['value']
+        asset['checked_at'] = now
+        if get_exam_file_version(asset['path']) == asset['version']:
+            return asset['value']
+        print(f"Reloading knowledge asset {name} from {asset['path']}")
+        return load_knowledge_asset(asset)
+
+
 def strip_json_fences(text):
     text = (text or '').strip()
     text = re.sub(r'^```(?:json)?\s*', '', text, flags=re.IGNORECASE)
@@ -4338,112 +7833,618 @@ def render_mindmap_html(data):
 </html>'''
 
 
-@app.route('/chatbot/create_mindmap', methods=['POST'])
-def create_chatbot_mindmap():
-    chat_history = session.get('chat_history', [])
-    topic = request.form.get('mindmap_topic', '').strip()
-    is_ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+@app.route('/chatbot/create_mindmap', methods=['POST'])
+def create_chatbot_mindmap():
+    topic = request.form.get('mindmap_topic', '').strip()
+    is_ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+    history_text = build_chat_memory_text(get_chat_id())
+    source_text = topic or history_text
+
+    if not source_text.strip():
+        message = 'Em hãy hỏi hoặc trao đổi một nội dung trước, sau đó bấm Tạo sơ đồ.'
+        if is_ajax_request:
+            return jsonify({
+                'success': False,
+                'bot': message
+            }), 400
+
+        append_chat_history('[Tạo sơ đồ tư duy]', message)
+        return redirect(url_for('chatbot'))
+
+    prompt = f"""
+Hãy tạo dữ liệu JSON cho một SƠ ĐỒ TƯ DUY học tập từ nội dung sau.
+Chỉ trả về JSON hợp lệ, không markdown.
+
+Yêu cầu sư phạm:
+- Luôn viết tiếng Việt có dấu đầy đủ trong mọi trường chữ: title, summary, note, children.title.
+- Tóm tắt đúng kiến thức đã trao đổi, không thêm đáp án giải hoàn chỉnh nếu là bài tập.
+- Mỗi nhánh ngắn gọn, rõ ý, dùng tiếng Việt tự nhiên.
+- Tạo 4 đến 6 nhánh chính, mỗi nhánh có 2 đến 3 ý con để sơ đồ thoáng, không rối.
+- Đặt title ngắn, summary một câu.
+- title và note chỉ viết chữ thường ngắn gọn, TUYỆT ĐỐI không chèn LaTeX vào title hoặc note.
+- Mọi công thức, ký hiệu Toán phải đặt riêng trong trường "formula".
+- Nếu nội dung có công thức Toán, BẮT BUỘC đưa công thức quan trọng vào trường "formula".
+- Công thức phải viết bằng LaTeX MathJax dạng INLINE \\(...\\), không dùng \\[...\\] trong sơ đồ vì ô nhỏ.
+- Vì đang trả về JSON, mỗi dấu backslash trong LaTeX nên viết thành \\\\, ví dụ "\\\\frac{{a}}{{b}}".
+- Với các mục như trung bình cộng, tổng, xác suất, đạo hàm, tích phân, hình học... hãy ưu tiên chèn công thức vào nhánh phù hợp.
+- Có thể gợi ý visual_style/palette nhưng không bắt buộc.
+
+Schema:
+{{
+  "title": "...",
+  "summary": "...",
+  "branches": [
+    {{
+      "title": "...",
+      "note": "...",
+      "formula": "\\\\(công thức nếu có\\\\)",
+      "children": [
+        {{"title": "...", "formula": "\\\\(công thức nếu có\\\\)"}},
+        {{"title": "...", "formula": ""}}
+      ]
+    }}
+  ]
+}}
+
+NỘI DUNG:
+{source_text[:6000]}
+"""
+
+    try:
+        if topic:
+            response_text = generate_cached_ai_text(
+                prompt,
+                validate=lambda text: load_mindmap_json(strip_json_fences(text))
+            )
+        else:
+            # Sơ đồ dựng từ lịch sử chat: không lưu hội thoại của học sinh vào cache AI dùng chung.
+            response_text = model.generate_content(prompt).text
+        raw_data = load_mindmap_json(strip_json_fences(response_text))
+    except Exception:
+        raw_data = {
+            'title': topic or 'Sơ đồ tư duy',
+            'summary': 'Tóm tắt từ nội dung trao đổi',
+            'branches': []
+        }
+
+    mindmap_data = normalize_mindmap_data(raw_data, source_text)
+    html_content = render_mindmap_html(mindmap_data)
+
+    os.makedirs(MINDMAP_DIR, exist_ok=True)
+    filename = f"mindmap_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.html"
+    file_path = os.path.join(MINDMAP_DIR, filename)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(html_content)
+
+    mindmap_url = url_for('static', filename=f'chatbot_mindmaps/{filename}')
+
+    if is_ajax_request:
+        return jsonify({
+            'success': True,
+            'url': mindmap_url,
+            'title': mindmap_data.get('title', 'Sơ đồ tư duy'),
+            'filename': filename
+        })
+
+    return redirect(mindmap_url)
+
+
+# ---------------- KNOWLEDGE RETRIEVAL ----------------
+# Chatbot chỉ đưa vào prompt vài đoạn kiến thức liên quan nhất tới câu hỏi (BM25 trên chữ đã bỏ dấu)
+# thay vì 800 ký tự đầu của data.txt. Index đầy đủ (data.txt + bài giảng + học liệu) được dựng sẵn
+# bằng scripts/build_knowledge_index.py; khi chưa có file index thì chỉ tra trong data.txt.
+KNOWLEDGE_INDEX_FILE = os.path.join('data', 'knowledge_index.json')
+KNOWLEDGE_RETRIEVAL_TOP_K = int(os.environ.get("KNOWLEDGE_RETRIEVAL_TOP_K", "4"))
+KNOWLEDGE_PASSAGE_CHARS = int(os.environ.get("KNOWLEDGE_PASSAGE_CHARS", "600"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize_search_text(text):
+    return re.findall(r'\w+', fold_search_text(text))
+
+
+def split_knowledge_passages(text, max_chars=None):
+    # Gom các đoạn (cách nhau bởi dòng trống) thành passage không quá max_chars ký tự.
+    max_chars = max_chars or KNOWLEDGE_PASSAGE_CHARS
+    passages = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n', str(text or '')):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            if current:
+                passages.append(current)
+                current = ''
+            passages.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:].strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            passages.append(current)
+            current = ''
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(current)
+    return passages
+
+
+def collect_knowledge_documents():
+    documents = []
+    try:
+        with open('data.txt', 'r', encoding='utf-8') as f:
+            documents.append({'source': 'data.txt', 'title': '', 'text': f.read()})
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    for lesson in load_exam_lessons():
+        documents.append({
+            'source': f"lesson:{lesson.get('id', '')}",
+            'title': lesson.get('title', ''),
+            'text': '\n\n'.join(
+                part for part in (lesson.get('description', ''), lesson.get('content', '')) if part
+            )
+        })
+    for material in load_exam_materials():
+        documents.append({
+            'source': f"material:{material.get('id', '')}",
+            'title': material.get('title', ''),
+            'text': material.get('description', '')
+        })
+    return documents
+
+
+def build_knowledge_index(documents):
+    passages = []
+    document_frequency = Counter()
+    for document in documents:
+        for text in split_knowledge_passages(document.get('text', '')):
+            terms = Counter(tokenize_search_text(f"{document.get('title', '')} {text}"))
+            if not terms:
+                continue
+            document_frequency.update(terms.keys())
+            passages.append({
+                'source': document.get('source', ''),
+                'title': document.get('title', ''),
+                'text': text,
+                'length': sum(terms.values()),
+                'terms': dict(terms)
+            })
+
+    total_length = sum(passage['length'] for passage in passages)
+    return {
+        'built_at': datetime.now().strftime("%d/%m/%Y %H:%M"),
+        'passages': passages,
+        'document_frequency': dict(document_frequency),
+        'average_length': total_length / len(passages) if passages else 0
+    }
+
+
+def load_knowledge_index_file(text):
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError as error:
+        print(f"Knowledge index load error: {error}")
+        return None
+
+
+def build_data_txt_knowledge_index(text):
+    return build_knowledge_index([{'source': 'data.txt', 'title': '', 'text': text or ''}])
+
+
+register_knowledge_asset('knowledge_index', KNOWLEDGE_INDEX_FILE, build=load_knowledge_index_file)
+register_knowledge_asset('data_txt_knowledge_index', 'data.txt', build=build_data_txt_knowledge_index)
+
+
+def search_knowledge_index(index, query, top_k=None):
+    """Trả về tối đa top_k passage có điểm BM25 cao nhất với query."""
+    top_k = KNOWLEDGE_RETRIEVAL_TOP_K if top_k is None else top_k
+    query_terms = set(tokenize_search_text(query))
+    passages = index.get('passages', []) if index else []
+    if not query_terms or not passages or top_k <= 0:
+        return []
+
+    document_frequency = index.get('document_frequency', {})
+    average_length = index.get('average_length') or 1
+    idf = {
+        term: math.log(1 + (len(passages) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+        for term in query_terms
+        if document_frequency.get(term)
+    }
+    if not idf:
+        return []
+
+    scored = []
+    for passage in passages:
+        terms = passage['terms']
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * passage['length'] / average_length)
+        score = sum(
+            weight * terms[term] * (BM25_K1 + 1) / (terms[term] + norm)
+            for term, weight in idf.items()
+            if term in terms
+        )
+        if score > 0:
+            scored.append((score, passage))
+    return [passage for _, passage in heapq.nlargest(top_k, scored, key=lambda item: item[0])]
+
+
+def retrieve_knowledge_passages(query, top_k=None):
+    index = get_knowledge_asset('knowledge_index') or get_knowledge_asset('data_txt_knowledge_index')
+    return search_knowledge_index(index, query, top_k)
+
+
+# ---------------- CHAT HISTORY STORE ----------------
+# Lịch sử chatbot nằm phía server (bảng chat_turns hoặc mỗi cuộc chat một file JSON),
+# cookie chỉ giữ chat_id nên không còn phình theo độ dài cuộc trò chuyện.
+CHAT_HISTORY_DIR = os.path.join('data', 'chat_sessions')
+CHAT_HISTORY_MAX_TURNS = int(os.environ.get("CHAT_HISTORY_MAX_TURNS", "200"))
+CHAT_HISTORY_RETENTION_DAYS = float(os.environ.get("CHAT_HISTORY_RETENTION_DAYS", "30"))
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", "30"))
+
+
+def chat_history_path(chat_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', chat_id or ''):
+        raise ValueError("Invalid chat id")
+    return os.path.join(CHAT_HISTORY_DIR, f"{chat_id}.json")
+
+
+def read_chat_file(chat_id):
+    data = read_json_file(chat_history_path(chat_id), {})
+    if not isinstance(data, dict):
+        data = {}
+    data.setdefault('next_seq', 0)
+    data.setdefault('turns', [])
+    return data
+
+
+def get_chat_id(create=False):
+    chat_id = session.get('chat_id')
+    legacy_history = session.get('chat_history')
+    if not chat_id and (create or legacy_history):
+        chat_id = uuid.uuid4().hex
+        session['chat_id'] = chat_id
+        prune_expired_chat_histories()
+    if legacy_history is not None:
+        # Lịch sử cũ còn nằm trong cookie: chuyển sang store một lần rồi bỏ khỏi session.
+        session.pop('chat_history', None)
+        if legacy_history:
+            store_chat_turns(chat_id, legacy_history)
+    return chat_id
+
+
+def load_chat_history(chat_id, limit=None, before=None):
+    """Các lượt chat theo thứ tự cũ -> mới; before/limit dùng để phân trang ngược từ lượt mới nhất."""
+    if not chat_id:
+        return []
+
+    if not exam_db_enabled():
+        turns = read_chat_file(chat_id)['turns']
+        if before is not None:
+            turns = [turn for turn in turns if turn.get('seq', 0) < before]
+        return turns[-limit:] if limit else turns
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, user_text, bot_text, timestamp FROM chat_turns
+                WHERE chat_id = %s AND (%s::BIGINT IS NULL OR id < %s)
+                ORDER BY id DESC
+                LIMIT %s
+                """,
+                (chat_id, before, before, limit)
+            )
+            rows = cur.fetchall()
+    return [
+        {'seq': row[0], 'user': row[1], 'bot': row[2], 'timestamp': row[3]}
+        for row in reversed(rows)
+    ]
+
+
+def store_chat_turns(chat_id, turns):
+    turns = [
+        {
+            'user': turn.get('user', ''),
+            'bot': turn.get('bot', ''),
+            'timestamp': turn.get('timestamp') or datetime.now().strftime("%H:%M")
+        }
+        for turn in turns
+    ]
+    if not exam_db_enabled():
+        with json_file_lock(chat_history_path(chat_id)):
+            data = read_chat_file(chat_id)
+            for turn in turns:
+                turn['seq'] = data['next_seq']
+                data['next_seq'] += 1
+                data['turns'].append(turn)
+            data['turns'] = data['turns'][-CHAT_HISTORY_MAX_TURNS:]
+            write_json_file(chat_history_path(chat_id), data)
+        return
+
+    from psycopg2.extras import execute_values
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                "INSERT INTO chat_turns (chat_id, user_text, bot_text, timestamp) VALUES %s",
+                [(chat_id, turn['user'], turn['bot'], turn['timestamp']) for turn in turns]
+            )
+            # Chỉ giữ CHAT_HISTORY_MAX_TURNS lượt mới nhất của mỗi cuộc chat.
+            cur.execute(
+                """
+                DELETE FROM chat_turns
+                WHERE chat_id = %s AND id <= (
+                    SELECT id FROM chat_turns WHERE chat_id = %s
+                    ORDER BY id DESC OFFSET %s LIMIT 1
+                )
+                """,
+                (chat_id, chat_id, CHAT_HISTORY_MAX_TURNS)
+            )
+
+
+def append_chat_history(user_text, bot_text, timestamp=None, chat_id=None):
+    chat_id = chat_id or get_chat_id(create=True)
+    store_chat_turns(chat_id, [{
+        'user': user_text,
+        'bot': bot_text,
+        'timestamp': timestamp
+    }])
+    schedule_chat_summary_refresh(chat_id)
+
+
+def clear_chat_history():
+    chat_id = session.pop('chat_id', None)
+    session.pop('chat_history', None)
+    if not chat_id:
+        return
+
+    if not exam_db_enabled():
+        path = chat_history_path(chat_id)
+        with json_file_lock(path):
+            remove_temp_file(path)
+        remove_temp_file(f"{os.path.abspath(path)}.lock")
+        return
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chat_turns WHERE chat_id = %s", (chat_id,))
+            cur.execute("DELETE FROM chat_summaries WHERE chat_id = %s", (chat_id,))
+
+
+def prune_expired_chat_histories():
+    # Chạy khi tạo cuộc chat mới: bỏ các cuộc chat/lượt chat quá hạn lưu trữ.
+    if CHAT_HISTORY_RETENTION_DAYS <= 0:
+        return
+    try:
+        if not exam_db_enabled():
+            cutoff = time.time() - CHAT_HISTORY_RETENTION_DAYS * 24 * 60 * 60
+            if not os.path.isdir(CHAT_HISTORY_DIR):
+                return
+            for filename in os.listdir(CHAT_HISTORY_DIR):
+                path = os.path.join(CHAT_HISTORY_DIR, filename)
+                if filename.endswith('.json') and os.path.getmtime(path) < cutoff:
+                    remove_temp_file(path)
+                    remove_temp_file(f"{os.path.abspath(path)}.lock")
+            return
+
+        ensure_exam_store_table()
+        with exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    DELETE FROM chat_turns WHERE chat_id IN (
+                        SELECT chat_id FROM chat_turns
+                        GROUP BY chat_id
+                        HAVING MAX(created_at) < NOW() - %s * INTERVAL '1 day'
+                    )
+                    """,
+                    (CHAT_HISTORY_RETENTION_DAYS,)
+                )
+                cur.execute(
+                    "DELETE FROM chat_summaries WHERE updated_at < NOW() - %s * INTERVAL '1 day'",
+                    (CHAT_HISTORY_RETENTION_DAYS,)
+                )
+    except Exception as error:
+        print(f"Chat history cleanup error: {error}")
+
+
+# ---------------- CHAT MEMORY ----------------
+# Prompt chatbot/sơ đồ tư duy chỉ gồm vài lượt gần nhất nguyên văn + bản tóm tắt các lượt cũ hơn,
+# nên độ dài prompt không tăng theo độ dài cuộc trò chuyện.
+CHAT_MEMORY_RECENT_TURNS = int(os.environ.get("CHAT_MEMORY_RECENT_TURNS", "6"))
+CHAT_MEMORY_SUMMARY_BATCH = int(os.environ.get("CHAT_MEMORY_SUMMARY_BATCH", "4"))
+CHAT_MEMORY_SUMMARY_CHARS = int(os.environ.get("CHAT_MEMORY_SUMMARY_CHARS", "1500"))
+CHAT_MEMORY_TURN_CHARS = int(os.environ.get("CHAT_MEMORY_TURN_CHARS", "1200"))
+_chat_summary_refreshing = set()
+_chat_summary_refreshing_lock = Lock()
+
+
+def load_chat_summary(chat_id):
+    if not chat_id:
+        return {'text': '', 'upto_seq': -1}
+
+    if not exam_db_enabled():
+        summary = read_chat_file(chat_id).get('summary') or {}
+        return {'text': summary.get('text', ''), 'upto_seq': summary.get('upto_seq', -1)}
+
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT summary, upto_seq FROM chat_summaries WHERE chat_id = %s", (chat_id,))
+            row = cur.fetchone()
+    if not row:
+        return {'text': '', 'upto_seq': -1}
+    return {'text': row[0], 'upto_seq': row[1]}
+
+
+def store_chat_summary(chat_id, text, upto_seq):
+    if not exam_db_enabled():
+        with json_file_lock(chat_history_path(chat_id)):
+            data = read_chat_file(chat_id)
+            if not data['turns']:
+                # Cuộc chat đã bị xóa trong lúc đang tóm tắt.
+                return
+            data['summary'] = {'text': text, 'upto_seq': upto_seq}
+            write_json_file(chat_history_path(chat_id), data)
+        return
 
-    history_text = '\n'.join(
-        f"Học sinh: {item.get('user', '')}\nAI: {item.get('bot', '')}"
-        for item in chat_history[-6:]
+    ensure_exam_store_table()
+    with exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO chat_summaries (chat_id, summary, upto_seq, updated_at)
+                SELECT %s, %s, %s, NOW()
+                WHERE EXISTS (SELECT 1 FROM chat_turns WHERE chat_id = %s)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    summary = EXCLUDED.summary,
+                    upto_seq = EXCLUDED.upto_seq,
+                    updated_at = EXCLUDED.updated_at
+                WHERE chat_summaries.upto_seq < EXCLUDED.upto_seq
+                """,
+                (chat_id, text, upto_seq, chat_id)
+            )
+
+
+def format_chat_turns(turns):
+    return '\n'.join(
+        f"Học sinh: {turn.get('user', '')[:CHAT_MEMORY_TURN_CHARS]}\n"
+        f"AI: {turn.get('bot', '')[:CHAT_MEMORY_TURN_CHARS]}"
+        for turn in turns
     )
-    source_text = topic or history_text
 
-    if not source_text.strip():
-        message = 'Em hãy hỏi hoặc trao đổi một nội dung trước, sau đó bấm Tạo sơ đồ.'
-        if is_ajax_request:
-            return jsonify({
-                'success': False,
-                'bot': message
-            }), 400
 
-        session['chat_history'] = [{
-            'user': '[Tạo sơ đồ tư duy]',
-            'bot': message,
-            'timestamp': datetime.now().strftime("%H:%M")
-        }]
-        session.modified = True
-        return redirect(url_for('chatbot'))
+def build_chat_memory_text(chat_id):
+    """Tóm tắt các lượt cũ + CHAT_MEMORY_RECENT_TURNS lượt gần nhất, rỗng nếu chưa trò chuyện."""
+    recent_turns = load_chat_history(chat_id, limit=CHAT_MEMORY_RECENT_TURNS) if CHAT_MEMORY_RECENT_TURNS > 0 else []
+    summary = load_chat_summary(chat_id)['text']
+    parts = []
+    if summary:
+        parts.append(f"Tóm tắt các lượt trước:\n{summary}")
+    if recent_turns:
+        parts.append(f"Các lượt gần nhất:\n{format_chat_turns(recent_turns)}")
+    return '\n\n'.join(parts)
+
+
+def refresh_chat_summary(chat_id):
+    summary = load_chat_summary(chat_id)
+    turns = load_chat_history(chat_id)
+    if CHAT_MEMORY_RECENT_TURNS > 0:
+        turns = turns[:-CHAT_MEMORY_RECENT_TURNS]
+    pending = [turn for turn in turns if turn.get('seq', 0) > summary['upto_seq']]
+    if len(pending) < max(1, CHAT_MEMORY_SUMMARY_BATCH):
+        return False
 
+    # Gộp bản tóm tắt cũ với các lượt vừa rời khỏi cửa sổ gần nhất, không tóm tắt lại từ đầu.
     prompt = f"""
-Hãy tạo dữ liệu JSON cho một SƠ ĐỒ TƯ DUY học tập từ nội dung sau.
-Chỉ trả về JSON hợp lệ, không markdown.
-
-Yêu cầu sư phạm:
-- Luôn viết tiếng Việt có dấu đầy đủ trong mọi trường chữ: title, summary, note, children.title.
-- Tóm tắt đúng kiến thức đã trao đổi, không thêm đáp án giải hoàn chỉnh nếu là bài tập.
-- Mỗi nhánh ngắn gọn, rõ ý, dùng tiếng Việt tự nhiên.
-- Tạo 4 đến 6 nhánh chính, mỗi nhánh có 2 đến 3 ý con để sơ đồ thoáng, không rối.
-- Đặt title ngắn, summary một câu.
-- title và note chỉ viết chữ thường ngắn gọn, TUYỆT ĐỐI không chèn LaTeX vào title hoặc note.
-- Mọi công thức, ký hiệu Toán phải đặt riêng trong trường "formula".
-- Nếu nội dung có công thức Toán, BẮT BUỘC đưa công thức quan trọng vào trường "formula".
-- Công thức phải viết bằng LaTeX MathJax dạng INLINE \\(...\\), không dùng \\[...\\] trong sơ đồ vì ô nhỏ.
-- Vì đang trả về JSON, mỗi dấu backslash trong LaTeX nên viết thành \\\\, ví dụ "\\\\frac{{a}}{{b}}".
-- Với các mục như trung bình cộng, tổng, xác suất, đạo hàm, tích phân, hình học... hãy ưu tiên chèn công thức vào nhánh phù hợp.
-- Có thể gợi ý visual_style/palette nhưng không bắt buộc.
+Bạn đang ghi nhớ một cuộc trò chuyện giữa học sinh và trợ lý học tập.
+Hãy cập nhật bản tóm tắt bên dưới với các lượt trao đổi mới.
+- Viết tiếng Việt có dấu, tối đa {CHAT_MEMORY_SUMMARY_CHARS // 5} từ, dạng gạch đầu dòng.
+- Giữ lại chủ đề, bài tập, công thức, chỗ học sinh còn vướng và những gì đã hướng dẫn.
+- Chỉ trả về bản tóm tắt mới, không thêm lời dẫn.
 
-Schema:
-{{
-  "title": "...",
-  "summary": "...",
-  "branches": [
-    {{
-      "title": "...",
-      "note": "...",
-      "formula": "\\\\(công thức nếu có\\\\)",
-      "children": [
-        {{"title": "...", "formula": "\\\\(công thức nếu có\\\\)"}},
-        {{"title": "...", "formula": ""}}
-      ]
-    }}
-  ]
-}}
+TÓM TẮT HIỆN TẠI:
+{summary['text'] or '(chưa có)'}
 
-NỘI DUNG:
-{source_text[:6000]}
+CÁC LƯỢT MỚI:
+{format_chat_turns(pending)}
 """
+    # Không đi qua cache AI: prompt chứa hội thoại riêng nên không bao giờ trùng, và bản lưu trong cache sẽ còn lại
+    # sau khi học sinh xóa lịch sử. Bản tóm tắt đã được lưu theo upto_seq.
+    text = clean_ai_output(model.generate_content(prompt, priority='batch').text)
+    store_chat_summary(chat_id, text[:CHAT_MEMORY_SUMMARY_CHARS], pending[-1]['seq'])
+    return True
+
 
+def _refresh_chat_summary_task(chat_id):
     try:
-        ai_response = model.generate_content(prompt)
-        raw_json = strip_json_fences(ai_response.text)
-        raw_data = load_mindmap_json(raw_json)
-    except Exception:
-        raw_data = {
-            'title': topic or 'Sơ đồ tư duy',
-            'summary': 'Tóm tắt từ nội dung trao đổi',
-            'branches': []
-        }
+        with exam_cache_scope():
+            refresh_chat_summary(chat_id)
+    except Exception as error:
+        print(f"Chat summary refresh error for {chat_id}: {error}")
+    finally:
+        with _chat_summary_refreshing_lock:
+            _chat_summary_refreshing.discard(chat_id)
+
+
+def schedule_chat_summary_refresh(chat_id):
+    # Tóm tắt chạy nền trên executor AI để không làm chậm câu trả lời của lượt hiện tại.
+    if CHAT_MEMORY_SUMMARY_BATCH <= 0:
+        return
+    with _chat_summary_refreshing_lock:
+        if chat_id in _chat_summary_refreshing:
+            return
+        _chat_summary_refreshing.add(chat_id)
+    get_ai_call_executor().submit(_refresh_chat_summary_task, chat_id)
+
+
+def build_chatbot_system_prompt(query=''):
+    system_prompt = TUTOR_PERSONA_PROMPT + MATH_FORMAT_RULES
+    passages = retrieve_knowledge_passages(query)
+    if passages:
+        system_prompt += "\nKien thuc lien quan:\n" + '\n---\n'.join(
+            f"[{passage['title']}]\n{passage['text']}" if passage['title'] else passage['text']
+            for passage in passages
+        )
+    return system_prompt
 
-    mindmap_data = normalize_mindmap_data(raw_data, source_text)
-    html_content = render_mindmap_html(mindmap_data)
 
-    os.makedirs(MINDMAP_DIR, exist_ok=True)
-    filename = f"mindmap_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.html"
-    file_path = os.path.join(MINDMAP_DIR, filename)
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(html_content)
+def prepare_chatbot_contents(user_message, uploaded_file):
+    """Trả về (contents gửi Gemini hoặc None, câu trả lời sẵn khi không cần gọi AI, file tạm cần xóa)."""
+    system_prompt = build_chatbot_system_prompt(user_message)
+    memory_text = build_chat_memory_text(get_chat_id())
+    if memory_text:
+        system_prompt += f"\n\nNgữ cảnh cuộc trò chuyện (chỉ để tham khảo, không nhắc lại):\n{memory_text}"
 
-    mindmap_url = url_for('static', filename=f'chatbot_mindmaps/{filename}')
+    # Xử lý nếu có file đính kèm
+    if uploaded_file and uploaded_file.filename != '':
+        file_ext = uploaded_file.filename.rsplit('.', 1)[1].lower()
 
-    if is_ajax_request:
-        return jsonify({
-            'success': True,
-            'url': mindmap_url,
-            'title': mindmap_data.get('title', 'Sơ đồ tư duy'),
-            'filename': filename
-        })
+        # Lưu file tạm
+        temp_filename = f"temp_{uuid.uuid4()}_{secure_filename(uploaded_file.filename)}"
+        temp_path = os.path.join(app.config['UPLOAD_FOLDER'],
+                                 temp_filename)
+        uploaded_file.save(temp_path)
 
-    return redirect(mindmap_url)
+        # Xử lý theo loại file
+        if file_ext == 'pdf':
+            # Đọc text từ PDF
+            pdf_text = extract_text_from_pdf(temp_path)
+            full_prompt = f"{system_prompt}\n\nHọc sinh gửi file PDF với nội dung:\n{pdf_text}\n\nCâu hỏi: {user_message if user_message else 'Hãy phân tích nội dung file này và hướng dẫn cách làm'}"
+            return [full_prompt], None, temp_path
+
+        if file_ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
+            # Đọc ảnh
+            img = load_ai_image(temp_path, document=True)
+            full_prompt = f"{system_prompt}\n\nHọc sinh gửi ảnh bài tập/đề thi.\n\nQUAN TRỌNG: Hãy kiểm tra kỹ xem học sinh đã làm bài chưa (có đánh dấu, khoanh tròn, ghi đáp án không).\n- Nếu ĐÃ LÀM: Chấm bài, chỉ ra đúng/sai và giải thích.\n- Nếu CHƯA LÀM: CHỈ hướng dẫn phương pháp, KHÔNG cho đáp án.\n\nCâu hỏi thêm: {user_message if user_message else 'Hãy phân tích và hướng dẫn em'}"
+            return [img, full_prompt], None, temp_path
+
+        return None, "Định dạng file không được hỗ trợ. Chỉ chấp nhận ảnh (.png, .jpg, .jpeg) hoặc PDF.", temp_path
+
+    # Chỉ có text message
+    if user_message:
+        full_prompt = f"{system_prompt}\n\nHọc sinh hỏi: {user_message}\n\nLƯU Ý: Chỉ hướng dẫn phương pháp, không đưa đáp án trực tiếp."
+        return [full_prompt], None, None
+    return None, "Vui lòng nhập câu hỏi hoặc gửi file.", None
+
+
+def remove_temp_file(path):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 # Route cho chatbot
 @app.route('/chatbot', methods=['GET', 'POST'])
 def chatbot():
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-
     response_text = None
 
     if request.method == 'POST':
@@ -4452,139 +8453,21 @@ def chatbot():
         is_ajax_request = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
         user_display = user_message if user_message else '[Da gui file]'
 
-        # Đọc dữ liệu từ data.txt
-        knowledge_base = ""
-        try:
-            with open('data.txt', 'r', encoding='utf-8') as f:
-                knowledge_base = f.read()
-        except FileNotFoundError:
-            knowledge_base = "Không tìm thấy file data.txt"
-
-        # Xây dựng prompt chi tiết cho AI
-        system_prompt = f"""Bạn là trợ lý AI thông minh hỗ trợ học sinh trong học tập.
-
-KIẾN THỨC CƠ SỞ (từ data.txt):
-{knowledge_base}
-
-VAI TRÒ CỦA BẠN:
-- Bạn là giáo viên/gia sư AI thân thiện, kiên nhẫn và nhiệt tình
-- Hướng dẫn học sinh tự giải quyết vấn đề, phát triển tư duy độc lập
-- Phân tích bài làm, hình ảnh bài tập học sinh gửi lên
-- KHÔNG đưa ra đáp án trực tiếp - chỉ gợi ý và hướng dẫn cách giải
-
-NGUYÊN TẮC QUAN TRỌNG:
-1. KHI HỌC SINH HỎI BÀI (chưa làm):
-   - TUYỆT ĐỐI KHÔNG đưa đáp án trực tiếp
-   - TUYỆT ĐỐI KHÔNG giải chi tiết từng bước ra kết quả
-   - CHỈ hướng dẫn phương pháp, công thức, định lý cần dùng
-   - CHỈ gợi ý hướng tư duy, cách tiếp cận bài toán
-   - Khuyến khích học sinh tự thực hiện các bước tính toán
-
-2. KHI HỌC SINH GỬI ẢNH BÀI LÀM/ĐỀ TRẮC NGHIỆM:
-   - Kiểm tra xem học sinh đã làm bài chưa (có khoanh/viết đáp án không)
-   - NẾU ĐÃ LÀM (có đánh dấu/khoanh/ghi đáp án):
-     * Chỉ ra câu nào đúng, câu nào sai
-     * Giải thích tại sao sai và cách suy nghĩ đúng
-     * Hướng dẫn cách cải thiện
-   - NẾU CHƯA LÀM (đề trắng, chưa khoanh):
-     * TUYỆT ĐỐI KHÔNG cho đáp án
-     * CHỈ hướng dẫn kiến thức, phương pháp để giải từng câu
-     * Gợi ý cách phân tích, loại trừ đáp án
-     * Khuyến khích học sinh tự làm trước
-
-CÁCH TRẢ LỜI:
-1. Luôn trả lời bằng tiếng Việt
-2. Với câu hỏi chưa làm:
-   - "Để giải bài này, em cần biết công thức/định lý..."
-   - "Hướng tiếp cận: Bước 1... Bước 2... Em thử làm xem"
-   - "Gợi ý: Em hãy chú ý đến... và áp dụng..."
-
-3. Với bài đã làm:
-   - "Câu 1: Em làm đúng/sai. Giải thích:..."
-   - "Câu 2: Đáp án của em là... nhưng đáp án đúng là... vì..."
-
-4. Với văn/ngữ văn:
-   - Gợi ý cách phân tích tác phẩm, nhân vật
-   - Hướng dẫn cấu trúc bài văn
-   - KHÔNG viết sẵn đoạn văn mẫu
-
-QUY TẮC TRÌNH BÀY:
-- KHÔNG dùng **, ***, ##, ###, ````
-- Công thức toán viết văn bản thường: (x + 2)/(x - 3) hoặc x^2 + 3x + 2
-- Xuống dòng rõ ràng giữa các ý
-- Dùng số thứ tự 1. 2. 3. hoặc dấu gạch đầu dòng -
-- Giữ văn phong thân thiện, động viên
-
-LƯU Ý:
-- Luôn khuyến khích học sinh: "Em hãy thử làm theo hướng dẫn này nhé!"
-- Nếu học sinh yêu cầu đáp án trực tiếp, giải thích: "Thầy/cô sẽ hướng dẫn em cách làm để em tự rèn luyện tư duy nhé!"
-
-Hãy ưu tiên sử dụng thông tin từ KIẾN THỨC CƠ SỞ khi trả lời các câu hỏi liên quan.
-"""
-        system_prompt = (
-            TUTOR_PERSONA_PROMPT
-            + MATH_FORMAT_RULES
-            + "\nKien thuc co so ngan gon:\n"
-            + knowledge_base[:800]
-        )
-
         try:
-            # Xử lý nếu có file đính kèm
-            if uploaded_file and uploaded_file.filename != '':
-                file_ext = uploaded_file.filename.rsplit('.', 1)[1].lower()
-
-                # Lưu file tạm
-                temp_filename = f"temp_{uuid.uuid4()}_{secure_filename(uploaded_file.filename)}"
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'],
-                                         temp_filename)
-                uploaded_file.save(temp_path)
-
-                # Xử lý theo loại file
-                if file_ext == 'pdf':
-                    # Đọc text từ PDF
-                    pdf_text = extract_text_from_pdf(temp_path)
-                    full_prompt = f"{system_prompt}\n\nHọc sinh gửi file PDF với nội dung:\n{pdf_text}\n\nCâu hỏi: {user_message if user_message else 'Hãy phân tích nội dung file này và hướng dẫn cách làm'}"
-                    response = model.generate_content([full_prompt])
-                    response_text = response.text
-
-                elif file_ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
-                    # Đọc ảnh
-                    img = Image.open(temp_path)
-                    full_prompt = f"{system_prompt}\n\nHọc sinh gửi ảnh bài tập/đề thi.\n\nQUAN TRỌNG: Hãy kiểm tra kỹ xem học sinh đã làm bài chưa (có đánh dấu, khoanh tròn, ghi đáp án không).\n- Nếu ĐÃ LÀM: Chấm bài, chỉ ra đúng/sai và giải thích.\n- Nếu CHƯA LÀM: CHỈ hướng dẫn phương pháp, KHÔNG cho đáp án.\n\nCâu hỏi thêm: {user_message if user_message else 'Hãy phân tích và hướng dẫn em'}"
-                    response = model.generate_content([img, full_prompt])
+            contents, response_text, temp_path = prepare_chatbot_contents(user_message, uploaded_file)
+            try:
+                if contents is not None:
+                    response = model.generate_content(contents)
                     response_text = response.text
-
-                else:
-                    response_text = "Định dạng file không được hỗ trợ. Chỉ chấp nhận ảnh (.png, .jpg, .jpeg) hoặc PDF."
-
+            finally:
                 # Xóa file tạm
-                try:
-                    os.remove(temp_path)
-                except:
-                    pass
-
-            else:
-                # Chỉ có text message
-                if user_message:
-                    full_prompt = f"{system_prompt}\n\nHọc sinh hỏi: {user_message}\n\nLƯU Ý: Chỉ hướng dẫn phương pháp, không đưa đáp án trực tiếp."
-                    response = model.generate_content([full_prompt])
-                    response_text = response.text
-                else:
-                    response_text = "Vui lòng nhập câu hỏi hoặc gửi file."
+                remove_temp_file(temp_path)
 
             # Làm sạch output
             response_text = clean_ai_output(response_text)
 
             # Lưu vào lịch sử chat
-            session['chat_history'].append({
-                'user':
-                user_message if user_message else '[Đã gửi file]',
-                'bot':
-                response_text,
-                'timestamp':
-                datetime.now().strftime("%H:%M")
-            })
-            session.modified = True
+            append_chat_history(user_message if user_message else '[Đã gửi file]', response_text)
 
         except Exception as e:
             response_text = f"Lỗi: {sanitize_gemini_error(e)}"
@@ -4597,15 +8480,89 @@ Hãy ưu tiên sử dụng thông tin từ KIẾN THỨC CƠ SỞ khi trả lờ
             'timestamp': datetime.now().strftime("%H:%M")
         })
 
+    chat_history = load_chat_history(get_chat_id(), limit=CHAT_HISTORY_PAGE_SIZE + 1)
+    has_more_history = len(chat_history) > CHAT_HISTORY_PAGE_SIZE
     return render_template('chatbot.html',
-                           chat_history=session.get('chat_history', []),
+                           chat_history=chat_history[-CHAT_HISTORY_PAGE_SIZE:],
+                           has_more_history=has_more_history,
                            response=response_text)
 
 
+@app.route('/chatbot/history')
+def chatbot_history():
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 1), 100)
+    turns = load_chat_history(get_chat_id(), limit=limit + 1, before=before)
+    return jsonify({
+        'turns': turns[-limit:],
+        'has_more': len(turns) > limit
+    })
+
+
+def format_sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route('/chatbot/stream', methods=['POST'])
+def chatbot_stream():
+    """Như /chatbot nhưng gửi từng đoạn trả lời qua Server-Sent Events ngay khi Gemini sinh ra."""
+    user_message = request.form.get('message', '').strip()
+    uploaded_file = request.files.get('file')
+    user_display = user_message if user_message else '[Da gui file]'
+    # Tạo chat_id trước khi stream để cookie được gửi kèm header của response.
+    chat_id = get_chat_id(create=True)
+
+    try:
+        contents, ready_text, temp_path = prepare_chatbot_contents(user_message, uploaded_file)
+    except Exception as e:
+        contents, ready_text, temp_path = None, f"Lỗi: {sanitize_gemini_error(e)}", None
+
+    def generate():
+        try:
+            if contents is None:
+                response_text = ready_text
+            else:
+                pieces = []
+                for chunk in model.generate_content_stream(contents):
+                    piece = getattr(chunk, 'text', None) or ''
+                    if piece:
+                        pieces.append(piece)
+                        yield format_sse_event('delta', {'text': piece})
+                response_text = ''.join(pieces)
+
+            if str(response_text).lower().startswith(('loi:', 'lỗi:')):
+                yield format_sse_event('error', {'bot': response_text, 'user': user_display})
+                return
+
+            # Làm sạch output
+            response_text = clean_ai_output(response_text)
+            timestamp = datetime.now().strftime("%H:%M")
+
+            # Lưu vào lịch sử chat
+            append_chat_history(
+                user_message if user_message else '[Đã gửi file]', response_text, timestamp, chat_id
+            )
+            yield format_sse_event('done', {
+                'user': user_display,
+                'bot': response_text,
+                'timestamp': timestamp
+            })
+        except Exception as e:
+            yield format_sse_event('error', {'bot': f"Lỗi: {sanitize_gemini_error(e)}", 'user': user_display})
+        finally:
+            # Xóa file tạm
+            remove_temp_file(temp_path)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/clear_chat', methods=['POST'])
 def clear_chat():
-    session['chat_history'] = []
-    session.modified = True
+    clear_chat_history()
     return redirect(url_for('chatbot'))
 
 
@@ -4763,7 +8720,7 @@ Student message:
 """
 
     try:
-        response = model.generate_content([prompt])
+        response = model.generate_content([prompt], priority='triage')
         triage_result = parse_ai_json_response(response.text)
     except Exception:
         triage_result = fallback_result
@@ -4808,15 +8765,39 @@ def build_escalation_support_response(triage_result):
     )
 
 
+HEALTH_QUESTIONS_FILE = 'health_questions.json'
+
+
+def build_health_consult_prefix(health_knowledge):
+    if health_knowledge is None:
+        health_knowledge = "Không có dữ liệu sức khỏe."
+    return f"""Bạn là chuyên gia tư vấn sức khỏe cho học sinh.
+
+KIẾN THỨC VỀ SỨC KHỎE:
+{health_knowledge}
+
+VAI TRÒ:
+- Tư vấn các vấn đề sức khỏe phổ biến ở học sinh
+- Tâm lý học đường, stress, lo âu
+- Dinh dưỡng, vận động, giấc ngủ
+- Sức khỏe sinh sản (phù hợp lứa tuổi)
+
+QUY TẮC:
+1. Trả lời bằng tiếng Việt, thân thiện, dễ hiểu
+2. Không thay thế bác sĩ - khuyên gặp bác sĩ nếu nghiêm trọng
+3. Đưa lời khuyên phù hợp lứa tuổi học sinh
+4. Tôn trọng, không phán xét
+5. KHÔNG dùng **, ##, ````"""
+
+
+register_knowledge_asset('health_consult_prompt', 'health_data.txt', build=build_health_consult_prefix)
+
+
 # Route trang tư vấn sức khỏe
 @app.route('/health_support', methods=['GET', 'POST'])
 def health_support():
     # Load câu hỏi từ file
-    try:
-        with open('health_questions.json', 'r', encoding='utf-8') as f:
-            questions = json.load(f)
-    except FileNotFoundError:
-        questions = []
+    questions = read_json_file(HEALTH_QUESTIONS_FILE, [])
 
     ai_response = None
 
@@ -4864,31 +8845,7 @@ def health_support():
                 triage_result)
         elif consult_type == 'ai':
             try:
-                # Đọc kiến thức về sức khỏe
-                health_knowledge = ""
-                try:
-                    with open('health_data.txt', 'r', encoding='utf-8') as f:
-                        health_knowledge = f.read()
-                except FileNotFoundError:
-                    health_knowledge = "Không có dữ liệu sức khỏe."
-
-                prompt = f"""Bạn là chuyên gia tư vấn sức khỏe cho học sinh.
-
-KIẾN THỨC VỀ SỨC KHỎE:
-{health_knowledge}
-
-VAI TRÒ:
-- Tư vấn các vấn đề sức khỏe phổ biến ở học sinh
-- Tâm lý học đường, stress, lo âu
-- Dinh dưỡng, vận động, giấc ngủ
-- Sức khỏe sinh sản (phù hợp lứa tuổi)
-
-QUY TẮC:
-1. Trả lời bằng tiếng Việt, thân thiện, dễ hiểu
-2. Không thay thế bác sĩ - khuyên gặp bác sĩ nếu nghiêm trọng
-3. Đưa lời khuyên phù hợp lứa tuổi học sinh
-4. Tôn trọng, không phán xét
-5. KHÔNG dùng **, ##, ````
+                prompt = f"""{get_knowledge_asset('health_consult_prompt')}
 
 Học sinh hỏi: {question}
 
@@ -4903,15 +8860,9 @@ Hãy tư vấn chi tiết, có lời khuyên cụ thể."""
                 ai_response = f"❌ Lỗi: {str(e)}"
                 new_question['ai_response'] = ai_response
 
-        # Lưu câu hỏi
-        questions.insert(0, new_question)  # Thêm vào đầu danh sách
-
-        # Giữ tối đa 100 câu hỏi
-        if len(questions) > 100:
-            questions = questions[:100]
-
-        with open('health_questions.json', 'w', encoding='utf-8') as f:
-            json.dump(questions, f, ensure_ascii=False, indent=2)
+        # Lưu câu hỏi: thêm vào đầu danh sách, giữ tối đa 100 câu hỏi
+        update_json_file(HEALTH_QUESTIONS_FILE, [],
+                         lambda questions: ([new_question] + questions)[:100])
 
         flash('Câu hỏi đã được gửi!', 'success')
         if needs_escalation:
@@ -4983,31 +8934,28 @@ def expert_answer(question_id):
         flash('Vui lòng nhập câu trả lời!', 'error')
         return redirect(url_for('health_support'))
 
-    try:
-        with open('health_questions.json', 'r', encoding='utf-8') as f:
-            questions = json.load(f)
-    except FileNotFoundError:
-        questions = []
+    with json_file_lock(HEALTH_QUESTIONS_FILE):
+        questions = read_json_file(HEALTH_QUESTIONS_FILE, [])
 
-    # Tìm câu hỏi
-    question = next((q for q in questions if q['id'] == question_id), None)
+        # Tìm câu hỏi
+        question = next((q for q in questions if q['id'] == question_id), None)
 
-    if question:
-        expert_response = {
-            'expert_name': session.get('expert_name'),
-            'specialty': session.get('expert_specialty', 'Sức khỏe'),
-            'answer': answer,
-            'timestamp': datetime.now().strftime("%d/%m/%Y %H:%M")
-        }
+        if question:
+            expert_response = {
+                'expert_name': session.get('expert_name'),
+                'specialty': session.get('expert_specialty', 'Sức khỏe'),
+                'answer': answer,
+                'timestamp': datetime.now().strftime("%d/%m/%Y %H:%M")
+            }
 
-        question['expert_responses'].append(expert_response)
-        question['status'] = 'answered'
-        if question.get('needs_escalation'):
-            question['handling_status'] = 'contacted'
+            question['expert_responses'].append(expert_response)
+            question['status'] = 'answered'
+            if question.get('needs_escalation'):
+                question['handling_status'] = 'contacted'
 
-        with open('health_questions.json', 'w', encoding='utf-8') as f:
-            json.dump(questions, f, ensure_ascii=False, indent=2)
+            write_json_file(HEALTH_QUESTIONS_FILE, questions)
 
+    if question:
         flash('Đã gửi câu trả lời!', 'success')
     else:
         flash('Không tìm thấy câu hỏi!', 'error')
@@ -5033,24 +8981,19 @@ def health_case_status(question_id):
         flash('Trang thai xu ly khong hop le!', 'error')
         return redirect(url_for('health_support'))
 
-    try:
-        with open('health_questions.json', 'r', encoding='utf-8') as f:
-            questions = json.load(f)
-    except FileNotFoundError:
-        questions = []
-
-    question = next((q for q in questions if q['id'] == question_id), None)
+    with json_file_lock(HEALTH_QUESTIONS_FILE):
+        questions = read_json_file(HEALTH_QUESTIONS_FILE, [])
+        question = next((q for q in questions if q['id'] == question_id), None)
 
-    if not question:
-        flash('Khong tim thay ca canh bao!', 'error')
-        return redirect(url_for('health_support'))
+        if not question:
+            flash('Khong tim thay ca canh bao!', 'error')
+            return redirect(url_for('health_support'))
 
-    question['handling_status'] = new_status
-    if new_status == 'closed':
-        question['status'] = 'answered'
+        question['handling_status'] = new_status
+        if new_status == 'closed':
+            question['status'] = 'answered'
 
-    with open('health_questions.json', 'w', encoding='utf-8') as f:
-        json.dump(questions, f, ensure_ascii=False, indent=2)
+        write_json_file(HEALTH_QUESTIONS_FILE, questions)
 
     flash(f"Da cap nhat trang thai: {allowed_statuses[new_status]}", 'success')
     return redirect(url_for('health_support'))
@@ -5063,8 +9006,7 @@ def generate_feedback(text):
     """Tạo feedback từ text bằng AI"""
     try:
         prompt = f"Đây là nội dung bài làm của học sinh:\n\n{text}\n\nHãy phân tích, chỉ ra lỗi sai và đề xuất cải thiện. Trả lời bằng tiếng Việt."
-        response = model.generate_content([prompt])
-        return response.text
+        return generate_cached_ai_text([prompt])
     except Exception as e:
         return f"❌ Lỗi khi tạo feedback: {str(e)}"
 
@@ -5083,8 +9025,7 @@ Hãy chấm điểm theo các tiêu chí sau:
 4. Thái độ học tập (0–10)
 
 Sau đó, tổng kết điểm trung bình và đưa ra nhận xét ngắn gọn. Trả lời bằng tiếng Việt."""
-        response = model.generate_content([prompt])
-        return response.text
+        return generate_cached_ai_text([prompt])
     except Exception as e:
         return f"❌ Lỗi khi chấm điểm: {str(e)}"
 
@@ -5164,12 +9105,8 @@ def submit_score():
     if not bai:
         return jsonify({"status": "error", "message": "No bai found"})
 
-    if not os.path.exists("scores.json"):
-        with open("scores.json", "w", encoding="utf-8") as f:
-            json.dump([], f)
-
-    with open("scores.json", "r+", encoding="utf-8") as f:
-        scores = json.load(f)
+    with json_file_lock("scores.json"):
+        scores = read_json_file("scores.json", [])
         now = datetime.now().strftime("%d/%m/%Y %H:%M")
 
         existing = next((s for s in scores
@@ -5194,9 +9131,7 @@ def submit_score():
         others = [s for s in scores if s.get("bai") != bai]
         final_scores = others + top50
 
-        f.seek(0)
-        json.dump(final_scores, f, ensure_ascii=False, indent=2)
-        f.truncate()
+        write_json_file("scores.json", final_scores)
 
     return jsonify({"status": "ok"})
 
@@ -5257,55 +9192,54 @@ def load_projects():
 
 
 def load_project_images():
-    try:
-        with open(PROJECT_IMAGES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return {}
+    data = read_json_file(PROJECT_IMAGES_FILE, {})
+    return data if isinstance(data, dict) else {}
 
 
 def save_project_images(data):
-    with open(PROJECT_IMAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json_file(PROJECT_IMAGES_FILE, data)
+
+
+def add_project_image(project_key, image):
+    """Thêm ảnh vào danh sách của project_key trên bản mới nhất của file, trả về danh sách sau khi thêm."""
+    all_images = update_json_file(
+        PROJECT_IMAGES_FILE, {},
+        lambda data: data.setdefault(project_key, []).append(image)
+    )
+    return all_images[project_key]
 
 
 def load_general_images():
-    try:
-        with open(GENERAL_IMAGES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except:
-        return []
+    data = read_json_file(GENERAL_IMAGES_FILE, [])
+    return data if isinstance(data, list) else []
 
 
 def save_general_images(data):
-    with open(GENERAL_IMAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json_file(GENERAL_IMAGES_FILE, data)
 
 
 def load_geometry_stem_problems():
-    try:
-        with open(GEOMETRY_STEM_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-    except:
-        return []
+    data = read_json_file(GEOMETRY_STEM_FILE, [])
+    return data if isinstance(data, list) else []
 
 
 def save_geometry_stem_problems(data):
-    with open(GEOMETRY_STEM_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json_file(GEOMETRY_STEM_FILE, data)
+
+
+register_knowledge_asset(
+    'geometry_stem_critic_prompt',
+    GEOMETRY_STEM_PROMPT_FILE,
+    missing=(
+        "Bạn là Tri-hand, chuyên gia phản biện đề bài Hình học STEM. "
+        "Không giải bài, chỉ kiểm tra yếu tố Hình học, số liệu vật lý, "
+        "dữ kiện còn thiếu và gợi ý học sinh tự chỉnh sửa."
+    )
+)
 
 
 def load_geometry_stem_prompt():
-    try:
-        with open(GEOMETRY_STEM_PROMPT_FILE, 'r', encoding='utf-8') as f:
-            return f.read()
-    except:
-        return (
-            "Bạn là Tri-hand, chuyên gia phản biện đề bài Hình học STEM. "
-            "Không giải bài, chỉ kiểm tra yếu tố Hình học, số liệu vật lý, "
-            "dữ kiện còn thiếu và gợi ý học sinh tự chỉnh sửa."
-        )
+    return get_knowledge_asset('geometry_stem_critic_prompt')
 
 
 def parse_rating(value):
@@ -5392,9 +9326,8 @@ Hãy phản biện theo đúng vai trò chuyên gia Hình học STEM. Không gi
     except Exception as e:
         ai_review = f"Lỗi AI phản biện: {sanitize_gemini_error(e)}"
 
-    problems = load_geometry_stem_problems()
     problem_id = str(uuid.uuid4())
-    problems.append({
+    new_problem = {
         "id": problem_id,
         "author": author,
         "title": title,
@@ -5409,22 +9342,23 @@ Hãy phản biện theo đúng vai trò chuyên gia Hình học STEM. Không gi
         "average_score": None,
         "average_breakdown": {},
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M")
-    })
-    save_geometry_stem_problems(problems)
+    }
+    update_json_file(GEOMETRY_STEM_FILE, [], lambda problems: problems.append(new_problem))
     flash("AI đã phản biện bản nháp. Nếu thấy ổn, em có thể đăng đề cho cả lớp.")
     return redirect(url_for('geometry_stem', focus=problem_id))
 
 
 @app.route('/geometry_stem/<problem_id>/publish', methods=['POST'])
 def geometry_stem_publish(problem_id):
-    problems = load_geometry_stem_problems()
-    for problem in problems:
-        if problem.get('id') == problem_id:
-            problem['status'] = 'published'
-            problem['published_at'] = datetime.now().strftime("%Y-%m-%d %H:%M")
-            save_geometry_stem_problems(problems)
-            flash("Đã đăng đề bài cho cả lớp cùng giải và đánh giá.")
-            return redirect(url_for('geometry_stem', focus=problem_id))
+    with json_file_lock(GEOMETRY_STEM_FILE):
+        problems = load_geometry_stem_problems()
+        for problem in problems:
+            if problem.get('id') == problem_id:
+                problem['status'] = 'published'
+                problem['published_at'] = datetime.now().strftime("%Y-%m-%d %H:%M")
+                save_geometry_stem_problems(problems)
+                flash("Đã đăng đề bài cho cả lớp cùng giải và đánh giá.")
+                return redirect(url_for('geometry_stem', focus=problem_id))
 
     flash("Không tìm thấy đề bài.")
     return redirect(url_for('geometry_stem'))
@@ -5457,17 +9391,18 @@ def geometry_stem_rate(problem_id):
         rating['originality'] + rating['application'] + rating['clarity'] + rating['integrity']
     ) / 4, 2)
 
-    problems = load_geometry_stem_problems()
-    for problem in problems:
-        if problem.get('id') == problem_id:
-            if problem.get('status') != 'published':
-                flash("Đề bài này chưa được đăng cho lớp đánh giá.")
+    with json_file_lock(GEOMETRY_STEM_FILE):
+        problems = load_geometry_stem_problems()
+        for problem in problems:
+            if problem.get('id') == problem_id:
+                if problem.get('status') != 'published':
+                    flash("Đề bài này chưa được đăng cho lớp đánh giá.")
+                    return redirect(url_for('geometry_stem', focus=problem_id))
+                problem.setdefault('ratings', []).append(rating)
+                update_geometry_stem_average(problem)
+                save_geometry_stem_problems(problems)
+                flash("Đã ghi nhận đánh giá của em.")
                 return redirect(url_for('geometry_stem', focus=problem_id))
-            problem.setdefault('ratings', []).append(rating)
-            update_geometry_stem_average(problem)
-            save_geometry_stem_problems(problems)
-            flash("Đã ghi nhận đánh giá của em.")
-            return redirect(url_for('geometry_stem', focus=problem_id))
 
     flash("Không tìm thấy đề bài.")
     return redirect(url_for('geometry_stem'))
@@ -5558,9 +9493,8 @@ Phương trình $2x^2 - 3x - 5 = 0$ có:
 Trả lời bằng tiếng Việt, thân thiện."""
 
     try:
-        response = model.generate_content([prompt])
         # KHÔNG dùng clean_ai_output vì cần giữ nguyên LaTeX
-        ai_feedback = response.text
+        ai_feedback = generate_cached_ai_text([prompt])
     except Exception as e:
         ai_feedback = f"❌ Lỗi: {str(e)}"
 
@@ -5595,18 +9529,19 @@ def project(project_id):
                                    feedback="❌ Thiếu ảnh hoặc tên nhóm.")
 
         image_id = str(uuid.uuid4())
-        filename = f"{image_id}_{image.filename}"
+        filename, content_hash = store_upload(image, app.config['UPLOAD_FOLDER'])
         image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        image.save(image_path)
 
         try:
-            img = Image.open(image_path)
             prompt = (
                 f"Đây là ảnh bài làm của học sinh. "
                 f"Hãy phân tích nội dung, chỉ ra lỗi sai nếu có, và đề xuất cải thiện, chấm bài làm trên thang 10."
             )
-            response = model.generate_content([img, prompt])
-            ai_feedback = response.text
+            # Ảnh trùng nội dung đã được phân tích thì dùng lại nhận xét, không gọi AI lại.
+            ai_feedback = generate_cached_ai_text(
+                lambda: [load_ai_image(image_path), prompt],
+                cache_key=upload_analysis_cache_key(content_hash, 'project_feedback')
+            )
         except Exception as e:
             ai_feedback = f"❌ Lỗi khi xử lý ảnh: {str(e)}"
 
@@ -5618,9 +9553,7 @@ def project(project_id):
             "ai_feedback": ai_feedback,
             "comments": []
         }
-        images.append(new_image)
-        all_images[project_id] = images
-        save_project_images(all_images)
+        images = add_project_image(project_id, new_image)
 
     return render_template('project.html',
                            project=project_info,
@@ -5647,41 +9580,42 @@ def comment(project_id, image_id):
         flash("Điểm phải là số hợp lệ.")
         return redirect(url_for('project', project_id=project_id))
 
-    all_images = load_project_images()
-    images = all_images.get(project_id)
-
-    if images is None:
-        flash("Đề bài không tồn tại.")
-        return redirect(url_for('home'))
+    with json_file_lock(PROJECT_IMAGES_FILE):
+        all_images = load_project_images()
+        images = all_images.get(project_id)
 
-    target_image = next((img for img in images if img.get("id") == image_id),
-                        None)
+        if images is None:
+            flash("Đề bài không tồn tại.")
+            return redirect(url_for('home'))
 
-    if target_image is None:
-        flash("Không tìm thấy ảnh để bình luận.")
-        return redirect(url_for('project', project_id=project_id))
+        target_image = next((img for img in images if img.get("id") == image_id),
+                            None)
 
-    for c in target_image.get("comments", []):
-        if (c["student_name"] == student_name
-                and c["comment_text"] == comment_text
-                and c.get("score") == score):
-            flash("Bình luận đã tồn tại.")
+        if target_image is None:
+            flash("Không tìm thấy ảnh để bình luận.")
             return redirect(url_for('project', project_id=project_id))
 
-    target_image.setdefault("comments", []).append({
-        "student_name": student_name,
-        "comment_text": comment_text,
-        "score": score
-    })
+        for c in target_image.get("comments", []):
+            if (c["student_name"] == student_name
+                    and c["comment_text"] == comment_text
+                    and c.get("score") == score):
+                flash("Bình luận đã tồn tại.")
+                return redirect(url_for('project', project_id=project_id))
 
-    scores = [
-        c["score"] for c in target_image.get("comments", []) if "score" in c
-    ]
-    avg_score = round(sum(scores) / len(scores), 2) if scores else 0
-    target_image["average_score"] = avg_score
+        target_image.setdefault("comments", []).append({
+            "student_name": student_name,
+            "comment_text": comment_text,
+            "score": score
+        })
+
+        scores = [
+            c["score"] for c in target_image.get("comments", []) if "score" in c
+        ]
+        avg_score = round(sum(scores) / len(scores), 2) if scores else 0
+        target_image["average_score"] = avg_score
 
-    all_images[project_id] = images
-    save_project_images(all_images)
+        all_images[project_id] = images
+        save_project_images(all_images)
 
     flash(f"Bình luận đã được thêm. Điểm trung bình hiện tại: {avg_score}")
     return redirect(url_for('project', project_id=project_id))
@@ -5711,9 +9645,8 @@ def upload_image():
 
         file_ext = uploaded_file.filename.rsplit('.', 1)[1].lower()
         file_id = str(uuid.uuid4())
-        filename = f"{file_id}_{uploaded_file.filename}"
+        filename, content_hash = store_upload(uploaded_file, app.config['UPLOAD_FOLDER'])
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        uploaded_file.save(file_path)
 
         try:
             if file_ext == 'pdf':
@@ -5726,11 +9659,9 @@ def upload_image():
                     score_feedback = generate_score_feedback(text)
 
             elif file_ext in ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp']:
-                img = Image.open(file_path)
-
                 # ===== PROMPT CẢI THIỆN CHO PHẢN HỒI AI =====
-                ai_response = model.generate_content([
-                    img,
+                ai_response_text = generate_cached_ai_text(lambda: [
+                    load_ai_image(file_path, document=True),
                     """Bạn là giáo viên đang chấm bài học sinh. Hãy phân tích bài làm trong ảnh và đưa ra nhận xét chi tiết.
 
 NHIỆM VỤ:
@@ -5763,12 +9694,12 @@ Lỗi sai:
 Cần ghi rõ "hoặc" khi tách nhân tử. Luôn viết tập nghiệm ở cuối.
 
 Trả lời bằng tiếng Việt, ngắn gọn, dễ hiểu."""
-                ])
-                ai_feedback = clean_ai_output(ai_response.text)
+                ], cache_key=upload_analysis_cache_key(content_hash, 'image_feedback'))
+                ai_feedback = clean_ai_output(ai_response_text)
 
                 # ===== PROMPT CẢI THIỆN CHO CHẤM ĐIỂM =====
-                score_response = model.generate_content([
-                    img,
+                score_response_text = generate_cached_ai_text(lambda: [
+                    load_ai_image(file_path, document=True),
                     """Hãy chấm điểm bài làm của học sinh theo 4 tiêu chí sau:
 
 TIÊU CHÍ CHẤM ĐIỂM:
@@ -5796,8 +9727,8 @@ Nhận xét chung:
 Bài làm khá tốt, phương pháp đúng. Cần cẩn thận hơn ở bước tính toán cuối cùng để tránh sai số.
 
 Trả lời bằng tiếng Việt."""
-                ])
-                score_feedback = clean_ai_output(score_response.text)
+                ], cache_key=upload_analysis_cache_key(content_hash, 'image_score'))
+                score_feedback = clean_ai_output(score_response_text)
 
             else:
                 ai_feedback = "❌ Định dạng file không hỗ trợ."
@@ -5825,10 +9756,7 @@ Trả lời bằng tiếng Việt."""
             new_image["scores"].append(ai_score)
             new_image["average_score"] = ai_score
 
-        images.append(new_image)
-
-        all_images["general"] = images
-        save_project_images(all_images)
+        images = add_project_image("general", new_image)
 
     for img in images:
         if "scores" in img and img["scores"]:
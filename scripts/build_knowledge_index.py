@@ -0,0 +1,34 @@
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def load_app():
+    # Dùng chung cách tách đoạn và tokenize với app.py để index khớp với lúc tra cứu.
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import app as webapp
+    return webapp
+
+
+def main():
+    load_dotenv(ROOT / ".env")
+    webapp = load_app()
+    with webapp.app.test_request_context():
+        documents = webapp.collect_knowledge_documents()
+        index = webapp.build_knowledge_index(documents)
+
+    webapp.write_json_file(webapp.KNOWLEDGE_INDEX_FILE, index)
+    print(
+        f"indexed {len(index['passages'])} passages from {len(documents)} documents "
+        f"into {webapp.KNOWLEDGE_INDEX_FILE}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,10 @@
 import argparse
 import json
 import os
+import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-import psycopg2
 
 
 ROOT = Path(__file__).resolve().parents[1]
@@ -18,24 +18,23 @@ COLLECTIONS = {
 }
 
 
-def normalize_database_url(url):
-    if url and url.startswith("postgres://"):
-        return "postgresql://" + url[len("postgres://"):]
-    return url
-
-
-def connect(database_url):
-    dsn = normalize_database_url(database_url)
-    kwargs = {"connect_timeout": 10}
-    if "sslmode=" not in dsn:
-        kwargs["sslmode"] = os.environ.get("DATABASE_SSLMODE", "require")
-    return psycopg2.connect(dsn, **kwargs)
+def load_app():
+    # Dùng chung schema và logic đọc từng dòng với app.py để hai bên không lệch nhau.
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import app as webapp
+    return webapp
 
 
 def main():
     load_dotenv(ROOT / ".env")
     parser = argparse.ArgumentParser(
-        description="Export exam system PostgreSQL/Supabase collections to JSON files."
+        description="Export exam system PostgreSQL/Supabase or SQLite collections to JSON files."
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("postgres", "sqlite"),
+        help="Source store. Defaults to EXAM_STORE_BACKEND, or postgres.",
     )
     parser.add_argument(
         "--output-dir",
@@ -43,31 +42,52 @@ def main():
         help="Directory to write JSON files into. Defaults to ./data.",
     )
     args = parser.parse_args()
+    backend = args.backend or os.environ.get("EXAM_STORE_BACKEND") or "postgres"
+    os.environ["EXAM_STORE_BACKEND"] = backend
 
     database_url = os.environ.get("DATABASE_URL") or os.environ.get("SUPABASE_DATABASE_URL")
-    if not database_url:
+    if backend == "postgres" and not database_url:
         raise SystemExit("Missing DATABASE_URL or SUPABASE_DATABASE_URL.")
 
-    output_dir = Path(args.output_dir)
+    output_dir = Path(args.output_dir).resolve()
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    with connect(database_url) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT collection, payload
-                FROM exam_system_store
-                WHERE collection = ANY(%s)
-                ORDER BY collection
-                """,
-                (list(COLLECTIONS.keys()),),
-            )
-            rows = cur.fetchall()
+    webapp = load_app()
+    rows = []
+    if backend == "sqlite":
+        if not os.path.exists(webapp.EXAM_SQLITE_PATH):
+            raise SystemExit(f"Missing SQLite database {webapp.EXAM_SQLITE_PATH}.")
+        conn = webapp.get_exam_sqlite_connection()
+        conn.executescript(webapp.EXAM_SQLITE_SCHEMA)
+        conn.execute("BEGIN")
+        for (collection,) in conn.execute(
+            "SELECT collection FROM exam_store_collections ORDER BY collection"
+        ).fetchall():
+            if collection in COLLECTIONS:
+                rows.append((collection, webapp.fetch_exam_sqlite_rows(conn, collection)))
+        conn.commit()
+    else:
+        with webapp.get_exam_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(webapp.EXAM_STORE_SCHEMA)
+                cur.execute(
+                    """
+                    SELECT collection
+                    FROM exam_store_collections
+                    WHERE collection = ANY(%s)
+                    ORDER BY collection
+                    """,
+                    (list(COLLECTIONS.keys()),),
+                )
+                for (collection,) in cur.fetchall():
+                    rows.append((collection, webapp.fetch_exam_collection_rows(cur, collection)))
 
     for collection, payload in rows:
         filename = COLLECTIONS[collection].name
         path = output_dir / filename
         path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+        # Log cũ của chế độ JSON sẽ bị phát lại đè lên bản export nếu còn để lại.
+        Path(webapp.exam_collection_log_path(str(path))).unlink(missing_ok=True)
         size = len(payload) if hasattr(payload, "__len__") else 1
         print(f"exported {collection}: {size} -> {path}")
 
@@ -1,11 +1,9 @@
 import argparse
-import json
 import os
+import sys
 from pathlib import Path
 
 from dotenv import load_dotenv
-from psycopg2.extras import Json
-import psycopg2
 
 
 ROOT = Path(__file__).resolve().parents[1]
@@ -19,66 +17,23 @@ COLLECTIONS = {
 }
 
 
-def normalize_database_url(url):
-    if url and url.startswith("postgres://"):
-        return "postgresql://" + url[len("postgres://"):]
-    return url
-
-
-def load_json(path, fallback):
-    if not path.exists():
-        return fallback
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-def connect(database_url):
-    dsn = normalize_database_url(database_url)
-    kwargs = {"connect_timeout": 10}
-    if "sslmode=" not in dsn:
-        kwargs["sslmode"] = os.environ.get("DATABASE_SSLMODE", "require")
-    return psycopg2.connect(dsn, **kwargs)
-
-
-def ensure_table(conn):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS exam_system_store (
-                collection TEXT PRIMARY KEY,
-                payload JSONB NOT NULL,
-                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            )
-            """
-        )
-
-
-def collection_exists(conn, collection):
-    with conn.cursor() as cur:
-        cur.execute(
-            "SELECT 1 FROM exam_system_store WHERE collection = %s",
-            (collection,),
-        )
-        return cur.fetchone() is not None
-
-
-def upsert_collection(conn, collection, payload):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO exam_system_store (collection, payload, updated_at)
-            VALUES (%s, %s, NOW())
-            ON CONFLICT (collection)
-            DO UPDATE SET payload = EXCLUDED.payload, updated_at = NOW()
-            """,
-            (collection, Json(payload)),
-        )
+def load_app():
+    # Dùng chung schema và logic ghi từng dòng với app.py để hai bên không lệch nhau.
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import app as webapp
+    return webapp
 
 
 def main():
     load_dotenv(ROOT / ".env")
     parser = argparse.ArgumentParser(
-        description="Import exam system JSON data into PostgreSQL/Supabase."
+        description="Import exam system JSON data into PostgreSQL/Supabase or SQLite."
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("postgres", "sqlite"),
+        help="Target store. Defaults to EXAM_STORE_BACKEND, or postgres.",
     )
     parser.add_argument(
         "--force",
@@ -86,9 +41,11 @@ def main():
         help="Overwrite collections that already exist in the database.",
     )
     args = parser.parse_args()
+    backend = args.backend or os.environ.get("EXAM_STORE_BACKEND") or "postgres"
+    os.environ["EXAM_STORE_BACKEND"] = backend
 
     database_url = os.environ.get("DATABASE_URL") or os.environ.get("SUPABASE_DATABASE_URL")
-    if not database_url:
+    if backend == "postgres" and not database_url:
         raise SystemExit("Missing DATABASE_URL or SUPABASE_DATABASE_URL.")
 
     fallbacks = {
@@ -100,16 +57,56 @@ def main():
         "materials": [],
     }
 
-    with connect(database_url) as conn:
-        ensure_table(conn)
+    webapp = load_app()
+
+    def import_collections(existing, sync):
+        imported = []
         for collection, path in COLLECTIONS.items():
-            if collection_exists(conn, collection) and not args.force:
+            if collection in existing and not args.force:
                 print(f"skip {collection}: already exists")
                 continue
-            payload = load_json(path, fallbacks[collection])
-            upsert_collection(conn, collection, payload)
+            # Đọc snapshot kèm các thay đổi còn nằm trong file .log.
+            payload = webapp.read_exam_collection_file(collection, str(path), fallbacks[collection])
+            sync(collection, payload)
+            imported.append(collection)
             size = len(payload) if hasattr(payload, "__len__") else 1
             print(f"imported {collection}: {size}")
+        # Thống kê cộng dồn tính trên dữ liệu cũ: bỏ đi để dashboard tính lại từ dữ liệu vừa import.
+        return any(collection in webapp.EXAM_CLASS_STATS_COLLECTIONS for collection in imported)
+
+    if backend == "sqlite":
+        # Không đi qua exam_sqlite_transaction: lần mở đầu tiên của app sẽ tự bootstrap từ JSON, bỏ qua --force.
+        conn = webapp.get_exam_sqlite_connection()
+        conn.executescript(webapp.EXAM_SQLITE_SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            existing = {row[0] for row in conn.execute("SELECT collection FROM exam_store_collections")}
+            stats_stale = import_collections(
+                existing,
+                lambda collection, payload: webapp.sync_exam_sqlite_rows(conn, collection, payload)
+            )
+            if stats_stale:
+                webapp.clear_class_stats(conn)
+                print("cleared class statistics")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        print(f"database: {webapp.EXAM_SQLITE_PATH}")
+        return
+
+    with webapp.get_exam_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(webapp.EXAM_STORE_SCHEMA)
+            cur.execute("SELECT collection FROM exam_store_collections")
+            existing = {row[0] for row in cur.fetchall()}
+            stats_stale = import_collections(
+                existing,
+                lambda collection, payload: webapp.sync_exam_collection_rows(cur, collection, payload)
+            )
+            if stats_stale:
+                webapp.clear_class_stats(cur)
+                print("cleared class statistics")
 
 
 if __name__ == "__main__":
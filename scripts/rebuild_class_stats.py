@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+
+ROOT = Path(__file__).resolve().parents[1]
+COMPARED_FIELDS = (
+    "student_count",
+    "lesson_count",
+    "exam_count",
+    "material_count",
+    "submission_count",
+    "avg_score",
+)
+
+
+def load_app():
+    # Dùng chung logic tính thống kê với app.py để kết quả rebuild khớp với dashboard.
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import app as webapp
+    return webapp
+
+
+def main():
+    load_dotenv(ROOT / ".env")
+    parser = argparse.ArgumentParser(
+        description="Recompute per-class exam statistics from the stored collections."
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only compare stored statistics with recomputed ones, do not write.",
+    )
+    args = parser.parse_args()
+
+    webapp = load_app()
+    # Chạy trong request context để các collection và index chỉ được đọc/dựng một lần.
+    with webapp.app.test_request_context():
+        previous = dict(webapp.load_class_stats_rows())
+        classes = webapp.load_exam_classes()
+        rows = [webapp.compute_class_stats_row(class_obj) for class_obj in classes]
+
+        mismatches = 0
+        missing = 0
+        for row in rows:
+            stored = previous.get(row["class_id"])
+            if stored is None:
+                # Lớp chưa có dòng thống kê sẽ được tính khi dashboard đọc lần đầu, không phải lỗi.
+                missing += 1
+                continue
+            expected = webapp.class_stats_from_row(row)
+            actual = webapp.class_stats_from_row(stored)
+            diffs = [
+                f"{field}: {actual[field]} -> {expected[field]}"
+                for field in COMPARED_FIELDS
+                if actual[field] != expected[field]
+            ]
+            if diffs:
+                print(f"mismatch {row['class_id']}: " + ", ".join(diffs))
+                mismatches += 1
+
+        print(
+            f"checked {len(rows)} classes, {mismatches} differ from stored statistics, "
+            f"{missing} not materialized yet"
+        )
+        if args.check:
+            if mismatches:
+                raise SystemExit(1)
+            return
+
+        webapp.store_class_stats_rows(rows, replace_all=True)
+        print(f"rebuilt statistics for {len(rows)} classes")
+
+
+if __name__ == "__main__":
+    main()